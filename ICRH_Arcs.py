@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Arc and trip detection in the Fast Data amplitude (7853) boards.
+
+An event starts when, on one side (G/D) of a quadrant, the VSWR rises above
+VSWR_ON (with RF on), the reflected power rises suddenly, or the incident
+power drops suddenly (trip). It ends when the VSWR is back below VSWR_OFF
+(hysteresis) and no sudden variation is seen. The detection is vectorized
+and can be fed chunk by chunk (e.g. from ICRH_FastData.iter_fast_data).
+
+The events of all the shots are stored in a persistent index, so that they
+can be searched across the campaign without parsing the data again:
+
+    python ICRH_Arcs.py -p data/Fast_Data            # index the new shots
+    python ICRH_Arcs.py -p data/Fast_Data --list     # print all the events
+"""
+import os
+import argparse
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+import ICRH_FastData as fast
+import ICRH_Derived as derived
+import ICRH_Summary as summary
+
+# Default detection thresholds
+VSWR_ON = 3  # VSWR starting an event
+VSWR_OFF = 2  # VSWR below which an event can end
+PR_RISE = 200  # rise of the reflected power between two samples [kW], above the Pr noise
+PI_DROP = 100  # drop of the incident power between two samples [kW]
+POWER_MIN = 1  # incident power below which the VSWR is not considered [kW]
+MIN_DURATION = 0  # minimum duration of an event [s] (single sample arcs last 0 s)
+
+# Event index database, stored in the Fast Data directory
+EVENT_INDEX_FILENAME = '.arc_events.sqlite'
+
+EVENT_COLUMNS = ['shot', 'quadrant', 'side', 't_start', 't_end', 'Pi_max', 'Pr_max', 'VSWR_max']
+
+
+class ArcDetector():
+    '''
+    Detector of the events of one side of a quadrant.
+
+    process() can be called on successive chunks of the signals: an event in
+    progress at the end of a chunk is continued in the next one. flush()
+    closes the event in progress at the end of the data.
+    '''
+    def __init__(self, vswr_on=VSWR_ON, vswr_off=VSWR_OFF, pr_rise=PR_RISE,
+                 pi_drop=PI_DROP, power_min=POWER_MIN, min_duration=MIN_DURATION):
+        self.vswr_on = vswr_on
+        self.vswr_off = vswr_off
+        self.pr_rise = pr_rise
+        self.pi_drop = pi_drop
+        self.power_min = power_min
+        self.min_duration = min_duration
+        # state carried from one chunk to the next
+        self.active = False
+        self.current = None
+        self.last_Pi = None
+        self.last_Pr = None
+
+    def process(self, t, Pi, Pr, VSWR):
+        '''
+        Process a chunk of the time [s], incident and reflected powers [kW]
+        and VSWR arrays. Returns the list of the events ended in this chunk,
+        as dictionaries (t_start, t_end, Pi_max, Pr_max, VSWR_max).
+        '''
+        n = len(t)
+        if n == 0:
+            return []
+        # sample to sample variations, continued from the previous chunk
+        dPi = np.diff(Pi, prepend=Pi[0] if self.last_Pi is None else self.last_Pi)
+        dPr = np.diff(Pr, prepend=Pr[0] if self.last_Pr is None else self.last_Pr)
+        self.last_Pi, self.last_Pr = Pi[-1], Pr[-1]
+        sudden = (dPr > self.pr_rise) | (-dPi > self.pi_drop)
+        on = ((VSWR > self.vswr_on) & (Pi > self.power_min)) | sudden
+        off = ~(VSWR > self.vswr_off) & ~sudden
+
+        # hysteresis: the state is given by the last sample which was on or off
+        last = np.maximum.accumulate(np.where(on | off, np.arange(n), -1))
+        state = np.where(last >= 0, on[np.maximum(last, 0)], self.active)
+        events = []
+        if self.active and not state[0]:
+            # the event in progress ended with the previous chunk
+            events.append(self.current)
+            self.active, self.current = False, None
+        previous = np.concatenate(([self.active], state[:-1]))
+        starts = np.flatnonzero(state & ~previous)
+        ends = np.flatnonzero(~state & previous)  # first sample after each event
+        if self.active:
+            starts = np.concatenate(([0], starts))
+        if state[-1]:
+            ends = np.concatenate((ends, [n]))
+        if len(starts) == 0:
+            return self.select(events)
+
+        # peak values of each segment
+        bounds = np.empty(2*len(starts), dtype=np.intp)
+        bounds[0::2], bounds[1::2] = starts, ends
+        bounds = bounds[:-1] if bounds[-1] == n else bounds
+        peaks = {name: np.maximum.reduceat(values, bounds)[0::2]
+                 for name, values in (('Pi_max', Pi), ('Pr_max', Pr), ('VSWR_max', VSWR))}
+
+        for index, (start, end) in enumerate(zip(starts, ends)):
+            event = {'t_start': float(t[start]), 't_end': float(t[end - 1])}
+            event.update({name: float(peak[index]) for name, peak in peaks.items()})
+            if index == 0 and self.active:
+                # continuation of the event in progress
+                event['t_start'] = self.current['t_start']
+                for name in peaks:
+                    event[name] = max(event[name], self.current[name])
+            if end == n:
+                self.current = event
+            else:
+                events.append(event)
+        self.active = bool(state[-1])
+        if not self.active:
+            self.current = None
+        return self.select(events)
+
+    def flush(self):
+        '''Close and return the event in progress at the end of the data, if any'''
+        events = [self.current] if self.active else []
+        self.active, self.current = False, None
+        return self.select(events)
+
+    def select(self, events):
+        '''Return the events lasting at least min_duration'''
+        return [event for event in events if event['t_end'] - event['t_start'] >= self.min_duration]
+
+
+def detect_shot_events(shot, path='data/Fast_Data', chunksize=None, **thresholds):
+    '''
+    Return the DataFrame of the events of a shot (see EVENT_COLUMNS), for all
+    the quadrants and sides. With chunksize, the amplitude boards are streamed
+    by chunks of rows instead of being loaded at once.
+    '''
+    data = fast.FastData(shot, shot_files=fast.get_shot_filenames(shot, path), use_cache=not chunksize)
+    events = []
+    for quadrant in derived.QUADRANTS:
+        name = f'{quadrant}_amplitude'
+        if chunksize:
+            if name not in data.board_files:
+                continue
+            chunks = (derived.derive_amplitude(chunk) for chunk in data.iter_board(name, chunksize))
+        elif data.has_board(name):
+            chunks = [derived.derive_amplitude(getattr(data, name))]
+        else:
+            continue
+        detectors = {'G': ArcDetector(**thresholds), 'D': ArcDetector(**thresholds)}
+        for signals in chunks:
+            for side, detector in detectors.items():
+                for event in detector.process(signals['t'], signals['Pi'+side],
+                                              signals['Pr'+side], signals['VSWR_'+side]):
+                    events.append(dict(event, shot=shot, quadrant=quadrant, side=side))
+        for side, detector in detectors.items():
+            events.extend(dict(event, shot=shot, quadrant=quadrant, side=side)
+                          for event in detector.flush())
+    # same order whether the events were found chunk by chunk or at once
+    events = pd.DataFrame(events, columns=EVENT_COLUMNS)
+    return events.sort_values(['quadrant', 'side', 't_start'], kind='stable', ignore_index=True)
+
+
+class EventIndex():
+    '''
+    Persistent index (SQLite) of the events of all the shots, with the total
+    size of the files of each processed shot to detect the shots to process again.
+    '''
+    def __init__(self, path='data/Fast_Data'):
+        self.db_filename = os.path.join(path, EVENT_INDEX_FILENAME)
+        with closing(self._connect()) as con, con:
+            con.execute('''CREATE TABLE IF NOT EXISTS events (
+                               shot INTEGER, quadrant TEXT, side TEXT, t_start REAL, t_end REAL,
+                               Pi_max REAL, Pr_max REAL, VSWR_max REAL)''')
+            con.execute('CREATE INDEX IF NOT EXISTS events_shot ON events (shot)')
+            con.execute('CREATE TABLE IF NOT EXISTS shots (shot INTEGER PRIMARY KEY, files_size INTEGER)')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_filename, timeout=10)
+
+    def processed_shots(self):
+        '''Return {shot: files_size} of the shots already processed'''
+        with closing(self._connect()) as con:
+            return dict(con.execute('SELECT shot, files_size FROM shots'))
+
+    def add(self, shot, events, files_size=None):
+        '''Replace the events of a shot'''
+        with closing(self._connect()) as con, con:
+            con.execute('DELETE FROM events WHERE shot = ?', (shot,))
+            con.executemany(f'INSERT INTO events ({", ".join(EVENT_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            events[EVENT_COLUMNS].itertuples(index=False, name=None))
+            con.execute('INSERT OR REPLACE INTO shots (shot, files_size) VALUES (?, ?)', (shot, files_size))
+
+    def query(self, shots=None, quadrant=None, side=None, vswr_min=None):
+        '''Return the DataFrame of the events matching the given criteria'''
+        conditions, parameters = [], []
+        if shots is not None:
+            conditions.append(f'shot IN ({", ".join("?"*len(shots))})')
+            parameters.extend(shots)
+        for column, value in (('quadrant', quadrant), ('side', side)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if vswr_min is not None:
+            conditions.append('VSWR_max >= ?')
+            parameters.append(vswr_min)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(f'SELECT * FROM events{where} ORDER BY shot DESC, t_start',
+                                     con, params=parameters)
+
+
+def _detect(shot, path, chunksize):
+    return shot, detect_shot_events(shot, path, chunksize)
+
+def index_shots(path='data/Fast_Data', max_workers=None, chunksize=None, force=False):
+    '''
+    Detect in parallel the events of the shots which have not been processed
+    yet (or whose files have changed), and store them in the event index.
+    '''
+    index = EventIndex(path)
+    processed = {} if force else index.processed_shots()
+    sizes = summary.get_shot_sizes(path)
+    shots = sorted((shot for shot in sizes if processed.get(shot) != sizes[shot]), reverse=True)
+    print(f'{len(shots)} shots to process')
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_detect, shot, path, chunksize) for shot in shots]
+        for future in as_completed(futures):
+            try:
+                shot, events = future.result()
+            except Exception as e:
+                print(f'Error in detecting the events: {e}')
+                continue
+            index.add(shot, events, sizes[shot])
+            print(f'Shot {shot}: {len(events)} events')
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description='Arc and trip events of the Fast Data shots')
+    parser.add_argument('-p', '--path', default='data/Fast_Data', help='Fast Data directory')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-c', '--chunksize', type=int, default=None, help='stream the boards by chunks of rows')
+    parser.add_argument('-f', '--force', action='store_true', help='process again all the shots')
+    parser.add_argument('--list', action='store_true', help='print the indexed events')
+    args = parser.parse_args()
+    if args.list:
+        print(EventIndex(args.path).query().to_string(index=False))
+    else:
+        index_shots(args.path, args.workers, args.chunksize, args.force)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the data loading and processing.
+
+Synthetic files are generated in the exact formats of the acquisition
+(tab separated values with a trailing tab, 18 '#' header rows for the
+conditioning files) at several sizes, then the following steps are timed:
+    - parsing of the 7853 and 7851 boards and of the conditioning files
+    - FastData construction and loading of a whole shot (without, then with, the binary cache)
+    - derived signals computed for the plots (ICRH_Derived.derive_fast_data)
+    - copy of the files with copy_remote_files_to_local, through local
+      stand-ins of ssh and scp (scp per file and tar batch)
+
+The results are saved as JSON into benchmarks/, and a previous run can be
+given to compare against:
+
+    python ICRH_Benchmark.py -s small medium
+    python ICRH_Benchmark.py -s small --compare benchmarks/2026-10-18_12-00-00.json
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import ICRH_FastData as fast
+import ICRH_Conditioning as condi
+import ICRH_Derived as derived
+import ICRH_FileIO as io
+
+# Number of rows of the generated files
+SIZES = {'small': 10000, 'medium': 200000, 'large': 2000000}
+
+# Sampling period of the fast acquisition [µs]
+SAMPLING_PERIOD = 10
+
+RESULTS_PATH = 'benchmarks'
+
+# Local stand-ins of the remote commands: the "remote" commands are run locally
+# and scp copies the local file named after the 'host:' prefix
+FAKE_SSH_COMMAND = ['env']
+FAKE_SCP_COMMAND = ['sh', '-c', 'cp -p "${2#*:}" "$3"', 'scp']
+
+
+def pulse(nb_rows, rng, amplitude):
+    '''Return a noisy trapezoidal pulse of nb_rows samples'''
+    ramp = max(nb_rows // 10, 1)
+    shape = np.minimum(1, np.minimum(np.arange(nb_rows), nb_rows - np.arange(nb_rows)) / ramp)
+    return amplitude * shape * (1 + 0.02 * rng.standard_normal(nb_rows))
+
+def write_rows(filename, columns, header=''):
+    '''Write integer columns as tab separated rows with a trailing tab'''
+    with open(filename, 'w') as fh:
+        fh.write(header)
+        np.savetxt(fh, np.column_stack(columns).astype(np.int64), fmt='%d', delimiter='\t', newline='\t\n')
+
+def write_fast_data_7853(filename, nb_rows, seed=0):
+    '''Write a synthetic 7853 board file: PiG, PrG, PiD, PrD, V1-V4, Consigne, t'''
+    rng = np.random.default_rng(seed)
+    columns = []
+    for _ in range(2):
+        Pi = np.abs(pulse(nb_rows, rng, 5000))  # 500 kW in 0.1 kW
+        Pr = 0.05 * Pi * np.abs(1 + rng.standard_normal(nb_rows))
+        # a few arcs: reflected power close to the incident one
+        arcs = rng.integers(0, nb_rows, max(nb_rows // 100000, 1))
+        Pr[arcs] = 0.9 * Pi[arcs]
+        columns += [Pi, Pr]
+    voltages = [30 * np.sqrt(columns[0]) * (1 + 0.05 * rng.standard_normal(nb_rows)) for _ in range(4)]
+    consigne = 2 * pulse(nb_rows, rng, 5000)
+    t = np.arange(nb_rows) * SAMPLING_PERIOD
+    write_rows(filename, columns + voltages + [consigne, t])
+
+def write_fast_data_7851(filename, nb_rows, seed=0):
+    '''Write a synthetic 7851 board file: Ph1-Ph7 [centidegree], t'''
+    rng = np.random.default_rng(seed)
+    phases = [(rng.uniform(0, 36000) + np.cumsum(rng.normal(0, 5, nb_rows))) % 36000 for _ in range(7)]
+    t = np.arange(nb_rows) * SAMPLING_PERIOD + SAMPLING_PERIOD // 2
+    write_rows(filename, phases + [t])
+
+def write_conditioning_file(filename, nb_rows, seed=0):
+    '''Write a synthetic conditioning file, with its 18 header rows'''
+    rng = np.random.default_rng(seed)
+    header = ''.join(f'# Parameter {index} = {rng.integers(0, 100)}\n' for index in range(condi.HEADER_ROWS - 1))
+    header += '#' + '\t'.join(condi.COLUMNS[:-1]) + '\n'
+    t = np.arange(nb_rows) * 1000
+    Pi = np.abs(pulse(nb_rows, rng, 1000))
+    columns = [t, Pi, 0.05 * Pi, Pi, 0.05 * Pi]
+    columns += [30 * np.sqrt(Pi) for _ in range(4)]
+    columns += [rng.uniform(0, 36000, nb_rows) for _ in range(2)]
+    columns += [Pi, rng.uniform(3000, 4000, nb_rows), rng.uniform(3000, 4000, nb_rows)]
+    columns += [np.zeros(nb_rows), np.zeros(nb_rows)]
+    write_rows(filename, columns, header)
+
+def generate_shot(path, shot, nb_rows, seed=0):
+    '''Write the 6 board files of a synthetic shot. Returns the file names'''
+    os.makedirs(path, exist_ok=True)
+    filenames = []
+    for board in fast.BOARDS:
+        filename = os.path.join(path, f'shot_{shot}_{board}.dat')
+        if board % 2 == 0:
+            write_fast_data_7853(filename, nb_rows, seed + board)
+        else:
+            write_fast_data_7851(filename, nb_rows, seed + board)
+        filenames.append(filename)
+    return filenames
+
+def timeit(function, repeat=3, setup=None):
+    '''Return the list of the durations [s] of repeat calls of function (after setup, not timed)'''
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def run_benchmarks(sizes=('small', 'medium'), repeat=3, work_path=None):
+    '''
+    Generate the synthetic data of each size and time each step.
+    Returns the list of the results {'name', 'size', 'nb_rows', 'best', 'mean', 'repeat'}.
+    '''
+    work_path = work_path or tempfile.mkdtemp(prefix='icrh_benchmark_')
+    results = []
+    try:
+        for size in sizes:
+            nb_rows = SIZES[size]
+            print(f'Generating {size} files ({nb_rows} rows)...')
+            remote_path = os.path.join(work_path, size, 'remote')
+            shot_files = generate_shot(remote_path, 1, nb_rows)
+            cond_filename = os.path.join(remote_path, '2017-02-27_14-42-12.csv')
+            write_conditioning_file(cond_filename, nb_rows)
+            cache_path = os.path.join(remote_path, fast.CACHE_DIR)
+            local_path = os.path.join(work_path, size, 'local')
+
+            def clear_cache():
+                shutil.rmtree(cache_path, ignore_errors=True)
+
+            def clear_local():
+                shutil.rmtree(local_path, ignore_errors=True)
+                os.makedirs(local_path)
+
+            data = fast.FastData(1, use_cache=False, shot_files=shot_files)
+            data.load(max_workers=1)
+            remote_files = sorted(file for file in os.listdir(remote_path) if not file.startswith('.'))
+            steps = [
+                ('parse_7853', lambda: fast.read_fast_data_7853(shot_files[0]), None),
+                ('parse_7851', lambda: fast.read_fast_data_7851(shot_files[1]), None),
+                ('parse_conditioning', lambda: condi.read_conditoning_data(cond_filename), None),
+                ('fastdata_load', lambda: fast.FastData(1, use_cache=True, shot_files=shot_files).load(), clear_cache),
+                ('fastdata_load_cached', lambda: fast.FastData(1, use_cache=True, shot_files=shot_files).load(), None),
+                ('derived_signals', lambda: derived.derive_fast_data(data), None),
+                ('copy_scp', lambda: io.copy_remote_files_to_local(remote_files, local_path + '/', remote_path,
+                                                                   scp_command=FAKE_SCP_COMMAND, progress=None),
+                 clear_local),
+                ('copy_batch', lambda: io.copy_remote_files_to_local(remote_files, local_path + '/', remote_path,
+                                                                     batch=True, ssh_command=FAKE_SSH_COMMAND,
+                                                                     progress=None),
+                 clear_local),
+            ]
+            for name, function, setup in steps:
+                durations = timeit(function, repeat, setup)
+                results.append({'name': name, 'size': size, 'nb_rows': nb_rows,
+                                'best': min(durations), 'mean': float(np.mean(durations)), 'repeat': repeat})
+                print(f'{name:>22} {size:>7}: best {min(durations):.4f} s, mean {np.mean(durations):.4f} s')
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    return results
+
+def get_environment():
+    '''Return the description of the benchmark environment (versions, commit)'''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.node(), 'cpu_count': os.cpu_count()}
+
+def save_results(results, output_path=RESULTS_PATH):
+    '''Save the results and their environment into a new JSON file. Returns its name'''
+    os.makedirs(output_path, exist_ok=True)
+    filename = os.path.join(output_path, datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.json')
+    with open(filename, 'w') as fh:
+        json.dump({'environment': get_environment(), 'results': results}, fh, indent=1)
+    return filename
+
+def compare_results(results, reference_filename):
+    '''Return a DataFrame of the best durations compared to a previous run'''
+    with open(reference_filename, 'r') as fh:
+        reference = pd.DataFrame(json.load(fh)['results'])
+    table = pd.DataFrame(results).merge(reference[['name', 'size', 'best']], on=['name', 'size'],
+                                        how='left', suffixes=('', '_reference'))
+    table['speedup'] = table['best_reference'] / table['best']
+    return table[['name', 'size', 'best_reference', 'best', 'speedup']]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the ICRH data loading and processing')
+    parser.add_argument('-s', '--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES),
+                        help='sizes of the generated files')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of runs of each step')
+    parser.add_argument('-o', '--output', default=RESULTS_PATH, help='results directory')
+    parser.add_argument('-c', '--compare', default=None, help='previous results file to compare with')
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, args.repeat)
+    print(f'Results saved in {save_results(results, args.output)}')
+    if args.compare:
+        print(compare_results(results, args.compare).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
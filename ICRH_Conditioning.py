@@ -6,47 +6,155 @@ Created on Mon Feb 27 13:19:21 2017
 
 Data files (.csv) are located on dfci:/media/ssd/Conditionnement/
 """
+import os
+from io import BytesIO
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-def read_conditoning_data(filename):
+import ICRH_FileIO as io
+import ICRH_FastData as fast
+
+# Number of header lines before the data rows
+HEADER_ROWS = 18
+
+# last element '_' to avoid pandas crashing (trailing tab)
+COLUMNS = ('Temps',
+           'PiG','PrG','PiD','PrD',
+           'V1','V2','V3','V4',
+           'Ph(V1-V3)','Ph(V2-V4)',
+           'Consigne_mes', 'Vide_gauche', 'Vide_droit',
+           'reserve1', 'reserve2', '_')
+DTYPES = {column: 'float64' for column in COLUMNS}
+
+# Physical (scale, unit) of the raw columns: physical = raw * scale
+CHANNEL_SCALES = {'Temps': (1e-6, 's'),
+                  'PiG': (0.1, 'kW'), 'PrG': (0.1, 'kW'), 'PiD': (0.1, 'kW'), 'PrD': (0.1, 'kW'),
+                  'V1': (1, 'V'), 'V2': (1, 'V'), 'V3': (1, 'V'), 'V4': (1, 'V'),
+                  'Ph(V1-V3)': (0.01, 'deg'), 'Ph(V2-V4)': (0.01, 'deg'),
+                  'Consigne_mes': (0.5, 'kW'),
+                  'Vide_gauche': (1, 'mV'), 'Vide_droit': (1, 'mV')}
+
+def parse_metadata(lines):
     """
-    Import and return the ICRH Conditioning data into a pandas DataFrame
+    Return the metadata dictionary from the header lines '# key = value',
+    stopping at the first line which is not a comment (first data row)
     """
+    para_dic = {}
+    for line in lines:
+        if not line.startswith('#'):    # check the first character
+            break
+        para = line[1:].split('=')     # remove first '#' and seperate string by '='
+        if len(para) == 2:
+            para_dic[ para[0].strip()] = para[1].strip()
+    return para_dic
 
-    data = pd.read_csv(filename, delimiter='\t', skiprows=18, 
-                names=('Temps',
-                       'PiG','PrG','PiD','PrD',
-                       'V1','V2','V3','V4', 
-                       'Ph(V1-V3)','Ph(V2-V4)',
-                       'Consigne_mes', 'Vide_gauche', 'Vide_droit',
-                       'reserve1', 'reserve2', '_'),
-                index_col='Temps') # last element '_' to avoid pandas crashing
+def parse_data(buffer, compact=False):
+    """
+    Parse the data rows of a conditioning file (file object positioned on the
+    first data row, or buffer of complete rows) into a pandas DataFrame.
+    With compact=True, the raw values (phases in centidegree) are kept in the
+    smallest dtypes, see ICRH_FastData.compact_frame and physical().
+    """
+    data = pd.read_csv(buffer, delimiter='\t', names=COLUMNS, dtype=DTYPES,
+                       index_col='Temps', engine='c')
+    if compact:
+        return fast.compact_frame(data)
     # convert phase in degree and wrap it between 0° and 359°
     data['Ph(V1-V3)'] /= 100
     data['Ph(V2-V4)'] /= 100
     #data['Ph(V1-V3)'] %= 360
     #data['Ph(V2-V4)'] %= 360
-    return data 
+    return data
+
+def empty_data():
+    """ Return an empty conditioning DataFrame """
+    return pd.DataFrame({column: pd.Series(dtype=DTYPES[column]) for column in COLUMNS[1:]},
+                        index=pd.Index([], dtype=DTYPES['Temps'], name='Temps'))
+
+def read_conditioning_file(filename, compact=False):
+    """
+    Import and return the ICRH Conditioning data (pandas DataFrame) and
+    metadata (dictionary) of a file, reading it only once.
+    The file can be compressed (see ICRH_FileIO.open_data_file).
+    compact is passed to parse_data().
+    """
+    with io.open_data_file(filename, 'rt') as fh:
+        header = [fh.readline() for _ in range(HEADER_ROWS)]
+        metadata = parse_metadata(header)
+        # the file object is now positioned on the first data row
+        data = parse_data(fh, compact)
+    return data, metadata
+
+class ConditioningFollower():
+    """
+    Follow a conditioning file while it is being written.
+
+    The byte offset already read is remembered, so that each call to
+    read_new_rows() only parses the complete rows appended since the
+    previous call. The current local copy is read, as the sync may have
+    replaced the plain copy with a compressed one (or the reverse).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.metadata = {}
+
+    def read_new_rows(self):
+        """ Return the DataFrame of the rows appended since the last call """
+        self.filename = io.find_local_file(io.uncompressed_name(os.path.basename(self.filename)),
+                                           os.path.dirname(self.filename))
+        with io.open_data_file(self.filename, 'rb') as fh:
+            if io.is_compressed(self.filename):
+                # the uncompressed size is only known by reading up to the offset
+                size = fh.seek(self.offset)
+            else:
+                size = os.fstat(fh.fileno()).st_size
+            if size < self.offset:
+                # file rewritten: start again from the beginning
+                self.offset = 0
+                fh.seek(0)
+            if self.offset == 0:
+                header = [fh.readline() for _ in range(HEADER_ROWS)]
+                if not header[-1].endswith(b'\n'):
+                    return empty_data()  # header not complete yet
+                self.metadata = parse_metadata(line.decode(errors='replace') for line in header)
+                self.offset = fh.tell()
+            fh.seek(self.offset)
+            new_bytes = fh.read()
+        # parse only the complete rows, the last one may still be written
+        end = new_bytes.rfind(b'\n') + 1
+        if end == 0:
+            return empty_data()
+        self.offset += end
+        return parse_data(BytesIO(new_bytes[:end]))
+
+def read_conditoning_data(filename, compact=False):
+    """
+    Import and return the ICRH Conditioning data into a pandas DataFrame
+    """
+    data, _ = read_conditioning_file(filename, compact)
+    return data
+
+def physical(data, column, dtype=np.float32):
+    """
+    Return the physical values of a column of compact conditioning data
+    (see CHANNEL_SCALES), 'Temps' being the time in s
+    """
+    values = data.index.values if column == 'Temps' else data[column].values
+    return fast.physical(values, column, CHANNEL_SCALES, dtype)
 
 def read_conditioning_metadata(filename):
     """
     Import and return the ICRH Conditioning metadata into a dictionary
     """
-    para_dic = {}
-    with  open(filename,'r') as cmt_file:    # open file
-        for line in cmt_file:    # read each line
-            if line[0] == '#':    # check the first character
-                line = line[1:]    # remove first '#'
-                para = line.split('=')     # seperate string by '='
-                if len(para) == 2:
-                    para_dic[ para[0].strip()] = para[1].strip()
-    return para_dic    
+    with io.open_data_file(filename, 'rt') as cmt_file:
+        return parse_metadata(cmt_file)
 
 def plot_conditionning_data(data):
     """
     Plot the ICRH Conditoning data into a single figure. 
-    Expect a pandas DataFrame as input
+    Expect a pandas DataFrame as input. Returns the figure
     """
     fig, ax = plt.subplots(2,2, sharex=True)
     time = data.index/1e3 # display time in ms
@@ -59,9 +167,9 @@ def plot_conditionning_data(data):
     ax[0,0].set_ylabel('Power [kW]')
     ax[1,0].set_ylabel('Voltage [V]')
     plt.tight_layout()
+    return fig
 
 if __name__ == '__main__':
-    import ICRH_FileIO as io
     # Copy the recent data file into the local directory
     remote_file_list = io.list_remote_files()
     io.copy_remote_files_to_local(remote_file_list, local_data_path = 'data/Cond_Data')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Level of detail (LOD) decimation of long signals for plotting.
+
+A MinMaxPyramid is built once per signal: each level keeps, for blocks of
+FACTOR**level samples, the minimum and the maximum of the signal (at their
+own time), so that arcs and spikes remain visible at every level. Plots then
+only request the level matching the visible time range and their width in
+pixels. The finest levels (blocks of less than MIN_BLOCK samples) are not
+built: the raw samples are drawn instead, and the pyramid (int32 indices)
+takes about a third of the memory of a float32 signal.
+"""
+import numpy as np
+
+# Number of samples of a level merged into one block of the next level
+FACTOR = 4
+
+# Signals shorter than this are not decimated
+MIN_SIZE = 4096
+
+# Minimum number of samples of the blocks of the finest level built
+MIN_BLOCK = 16
+
+
+class MinMaxPyramid():
+    """
+    Min/max decimation pyramid of a signal y(t), t being sorted.
+    """
+    def __init__(self, t, y, factor=FACTOR, min_size=MIN_SIZE, min_block=MIN_BLOCK):
+        self.t = np.asarray(t)
+        self.y = np.asarray(y)
+        self.factor = factor
+        # level of the finest blocks built, the first one of self.levels
+        self.first_level = 1
+        while factor**self.first_level < min_block:
+            self.first_level += 1
+        # each level: (argmin, min, argmax, max) per block, argmin/argmax
+        # being indices in the raw signal
+        self.levels = []
+        index = np.arange(len(self.y), dtype=np.int32 if len(self.y) < 2**31 else np.int64)
+        mins, argmins, maxs, argmaxs = self.y, index, self.y, index
+        block = factor**self.first_level
+        while len(mins) > min_size // 2:
+            argmins, mins = self._reduce(argmins, mins, np.argmin, np.inf, block)
+            argmaxs, maxs = self._reduce(argmaxs, maxs, np.argmax, -np.inf, block)
+            self.levels.append((argmins, mins, argmaxs, maxs))
+            block = factor
+
+    def _reduce(self, arg, values, arg_function, fill, block):
+        """ Reduce the (arg, values) of a level by blocks of block samples """
+        nb_blocks = -(-len(values) // block)
+        padded = np.full(nb_blocks * block, fill, dtype=np.result_type(values, np.float32))
+        padded[:len(values)] = values
+        padded = padded.reshape(nb_blocks, block)
+        position = arg_function(padded, axis=1)
+        block_index = np.arange(nb_blocks) * block + position
+        return arg[block_index], values[block_index]
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for level in self.levels for array in level)
+
+    def level_for(self, nb_samples, pixels):
+        """
+        Return the coarsest level keeping at least one block per pixel, or 0
+        (raw samples) if it is finer than the first level built
+        """
+        level = 0
+        while (level < self.first_level + len(self.levels) - 1
+               and nb_samples / self.factor**(level + 1) >= pixels):
+            level += 1
+        return level if level >= self.first_level else 0
+
+    def select(self, x0=None, x1=None, pixels=1000):
+        """
+        Return the (t, y) arrays to plot for the time range [x0, x1] on a
+        width of pixels: the raw samples if they are few enough, otherwise
+        the interleaved minima and maxima of the matching level.
+        """
+        i0 = 0 if x0 is None else max(np.searchsorted(self.t, x0) - 1, 0)
+        i1 = len(self.t) if x1 is None else min(np.searchsorted(self.t, x1) + 1, len(self.t))
+        level = self.level_for(i1 - i0, max(int(pixels), 1))
+        if level == 0:
+            return self.t[i0:i1], self.y[i0:i1]
+        argmins, mins, argmaxs, maxs = self.levels[level - self.first_level]
+        block = self.factor**level
+        b0, b1 = max(i0 // block - 1, 0), min(-(-i1 // block) + 1, len(mins))
+        argmins, mins, argmaxs, maxs = argmins[b0:b1], mins[b0:b1], argmaxs[b0:b1], maxs[b0:b1]
+        # two points per block, in time order
+        min_first = argmins <= argmaxs
+        index = np.empty(2 * len(mins), dtype=argmins.dtype)
+        values = np.empty(2 * len(mins), dtype=mins.dtype)
+        index[0::2] = np.where(min_first, argmins, argmaxs)
+        index[1::2] = np.where(min_first, argmaxs, argmins)
+        values[0::2] = np.where(min_first, mins, maxs)
+        values[1::2] = np.where(min_first, maxs, mins)
+        return self.t[index], values
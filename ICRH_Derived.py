@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Derived quantities of the ICRH data: VSWR, phase combinations, transformer
+pressure, computed from the raw acquisition values.
+
+The functions work in place as much as possible (out= arguments) and in the
+requested dtype (float32 by default), in order to limit the number and the
+size of the temporary arrays. They can be used from the GUIs, the notebooks
+or batch scripts.
+"""
+import numpy as np
+
+import ICRH_Instrument as instrument
+
+# default dtype of the derived signals
+DTYPE = np.float32
+
+# VSWR above this value are considered unphysical and set to 0
+VSWR_MAX = 40
+
+# Quadrants equipped with fast acquisition boards
+QUADRANTS = ('Q1', 'Q2', 'Q4')
+
+# Columns of the 7853 boards
+POWERS = ['PiG', 'PrG', 'PiD', 'PrD']
+VOLTAGES = ['V1', 'V2', 'V3', 'V4']
+
+
+def vswr(Pi, Pr, out=None, vswr_max=VSWR_MAX, dtype=DTYPE):
+    """
+    Return the VSWR from the incident and reflected powers (any, but same, unit):
+        VSWR = |(1 + sqrt(Pr/Pi)) / (1 - sqrt(Pr/Pi))|
+    Unphysical values (undefined or above vswr_max) are set to 0.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma = np.divide(Pr, Pi, out=out, dtype=dtype)
+        np.sqrt(gamma, out=gamma)
+        denominator = np.subtract(1, gamma, dtype=dtype)
+        np.add(gamma, 1, out=gamma)
+        np.divide(gamma, denominator, out=gamma)
+        np.abs(gamma, out=gamma)
+        # NaN are also filtered by the comparison
+        gamma[~(gamma < vswr_max)] = 0
+    return gamma
+
+def phase_combination(Pha, Phb, Phc, out=None, scale=1/100, dtype=DTYPE):
+    """
+    Return the phase combination (Pha + Phb - Phc) in degree, wrapped between
+    0° and 360°. The raw phases are in centidegrees (scale=1/100).
+    """
+    out = np.add(Pha, Phb, out=out, dtype=dtype)
+    np.subtract(out, Phc, out=out)
+    np.multiply(out, scale, out=out)
+    np.mod(out, 360, out=out)
+    return out
+
+def transformer_pressure(vacuum, out=None, dtype=DTYPE):
+    """
+    Return the pressure in the transformer [Pa] from the vacuum gauge voltage [mV]:
+        p = 10**(1.667*V*1e-3 - 9.333)
+    """
+    out = np.multiply(vacuum, 1.667e-3, out=out, dtype=dtype)
+    np.subtract(out, 9.333, out=out)
+    np.power(10, out, out=out)
+    return out
+
+def derive_amplitude(amplitude, dtype=DTYPE):
+    """
+    Return the derived signals of a 7853 board DataFrame, as a dictionary:
+        - 't': time [s]
+        - 'PiG', 'PrG', 'PiD', 'PrD': powers [kW]
+        - 'Consigne': power setpoint, in the same scale as the powers
+        - 'VSWR_G', 'VSWR_D': VSWR of the left and right sides
+        - 'V1', 'V2', 'V3', 'V4': probe voltages
+    """
+    signals = {'t': np.divide(amplitude.index.values, 1e6)}
+    # all the powers converted at once, in a single contiguous array
+    powers = np.array(amplitude[POWERS].to_numpy().T, dtype=dtype, order='C')
+    powers *= 0.1
+    signals.update(zip(POWERS, powers))
+    signals['Consigne'] = np.multiply(amplitude['Consigne'].values, 1/20, dtype=dtype)
+    # the power scaling cancels out in Pr/Pi
+    vswrs = np.empty((2, len(amplitude)), dtype=dtype)
+    signals['VSWR_G'] = vswr(powers[0], powers[1], out=vswrs[0], dtype=dtype)
+    signals['VSWR_D'] = vswr(powers[2], powers[3], out=vswrs[1], dtype=dtype)
+    voltages = np.array(amplitude[VOLTAGES].to_numpy().T, dtype=dtype, order='C')
+    signals.update(zip(VOLTAGES, voltages))
+    return signals
+
+def derive_phase(phase, dtype=DTYPE):
+    """
+    Return the derived signals of a 7851 board DataFrame, as a dictionary:
+        - 't': time [s]
+        - 'Ph_G': Ph4 + Ph1 - Ph6 [deg]
+        - 'Ph_D': Ph5 + Ph1 - Ph7 [deg]
+    """
+    signals = {'t': np.divide(phase.index.values, 1e6)}
+    phases = np.empty((2, len(phase)), dtype=dtype)
+    signals['Ph_G'] = phase_combination(phase['Ph4'].values, phase['Ph1'].values,
+                                        phase['Ph6'].values, out=phases[0], dtype=dtype)
+    signals['Ph_D'] = phase_combination(phase['Ph5'].values, phase['Ph1'].values,
+                                        phase['Ph7'].values, out=phases[1], dtype=dtype)
+    return signals
+
+@instrument.timed('derive', lambda args: {'shot': getattr(args['fast_data'], 'shot', None)})
+def derive_fast_data(fast_data, quadrants=QUADRANTS, dtype=DTYPE):
+    """
+    Return the derived signals of all the quadrants of a FastData object:
+        {quadrant: {'amplitude': derive_amplitude(...), 'phase': derive_phase(...)}}
+    Missing or empty boards are skipped.
+    """
+    signals = {}
+    for quadrant in quadrants:
+        signals[quadrant] = {}
+        if fast_data.has_board(f'{quadrant}_amplitude'):
+            signals[quadrant]['amplitude'] = derive_amplitude(getattr(fast_data, f'{quadrant}_amplitude'), dtype)
+        if fast_data.has_board(f'{quadrant}_phase'):
+            signals[quadrant]['phase'] = derive_phase(getattr(fast_data, f'{quadrant}_phase'), dtype)
+    return signals
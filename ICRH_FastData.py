@@ -16,12 +16,60 @@ Data files (.dat) are located on dfci:/media/ssd/Fast_Data/
 """
 import os
 import glob
+import json
+import sqlite3
+import threading
+import multiprocessing
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
 import ICRH_FileIO as io
+import ICRH_Instrument as instrument
+
+# Binary cache of the parsed boards, stored next to the .dat files
+CACHE_DIR = '.cache'
+# Version of the cache layout: older caches are ignored and written again
+# (version 3: compact boards are no longer cached)
+CACHE_VERSION = 3
+
+# Below this total size of files to parse (in bytes), boards are read serially
+# as starting worker processes would cost more than the parsing itself
+PARALLEL_MIN_SIZE = 4*1024**2
+# Period of the checks of the cancel flag of read_boards() [s]
+CANCEL_POLL = 0.1
+
+# Columns of the board files (the last empty one comes from the trailing tab)
+COLUMNS_7851 = ('Ph1', 'Ph2', 'Ph3', 'Ph4', 'Ph5', 'Ph6', 'Ph7', 't', '')
+COLUMNS_7853 = ('PiG', 'PrG', 'PiD', 'PrD',
+                'V1', 'V2', 'V3', 'V4', 'Consigne', 't', '')
+
+# Physical (scale, unit) of the raw fixed-point channels: physical = raw * scale
+CHANNEL_SCALES = {'PiG': (0.1, 'kW'), 'PrG': (0.1, 'kW'), 'PiD': (0.1, 'kW'), 'PrD': (0.1, 'kW'),
+                  'V1': (1, 'mV'), 'V2': (1, 'mV'), 'V3': (1, 'mV'), 'V4': (1, 'mV'),
+                  'Consigne': (0.05, 'kW'),
+                  'Ph1': (0.01, 'deg'), 'Ph2': (0.01, 'deg'), 'Ph3': (0.01, 'deg'), 'Ph4': (0.01, 'deg'),
+                  'Ph5': (0.01, 'deg'), 'Ph6': (0.01, 'deg'), 'Ph7': (0.01, 'deg'),
+                  't': (1e-6, 's')}
+
+# Default number of rows per chunk for the streaming readers
+CHUNKSIZE = 1000000
+
+# Persistent index of the shot files, stored in the Fast Data directory
+SHOT_INDEX_FILENAME = '.shot_index.sqlite'
+
+# Default memory budget of a ShotCache [bytes]
+CACHE_MAX_BYTES = 2*1024**3
+
+# Board number -> FastData attribute
+BOARDS = {0: 'Q1_amplitude', 1: 'Q1_phase',
+          2: 'Q2_amplitude', 3: 'Q2_phase',
+          4: 'Q4_amplitude', 5: 'Q4_phase'}
 
 def get_shot_filenames(shot, path='data/Fast_Data'):
     '''Returns the filenames associated to a shot number'''
-    file_list = glob.glob(os.path.join(path, 'shot_'+str(shot)+'*'))
+    file_list = glob.glob(os.path.join(path, 'shot_'+str(shot)+'_*'))
     return file_list
 
 def get_shot_list(file_list):
@@ -55,7 +103,7 @@ def read_fast_data_7851(filename):
     try:
         phases = pd.read_csv(filename, delimiter='\t',
                      index_col='t', 
-                     names=('Ph1', 'Ph2', 'Ph3', 'Ph4', 'Ph5', 'Ph6', 'Ph7', 't', ''))
+                     names=COLUMNS_7851)
         return phases
     except Exception as e:
         print(f'Error in reading phase (7851) file {filename}: {e}')
@@ -71,34 +119,683 @@ def read_fast_data_7853(filename):
     try:
         amplitudes = pd.read_csv(filename, delimiter='\t',
                        index_col='t',
-                       names=('PiG', 'PrG', 'PiD', 'PrD',
-                              'V1', 'V2', 'V3', 'V4', 'Consigne', 't',
-                               ''))
+                       names=COLUMNS_7853)
         return amplitudes
     except Exception as e:
         print(f'Error in reading amplitude (7853) file {filename}: {e}')
         return None
 
+def get_board_number(filename):
+    '''
+    Return the board number (0 to 5) of a Fast Data file name shot_XXX_N.dat
+    '''
+    return int(os.path.basename(filename).split('.')[0].split('_')[2])
+
+def iter_fast_data(filename, chunksize=CHUNKSIZE, dtype='float32'):
+    '''
+    Iterate over a Fast Data board file (7853 or 7851) by DataFrames of
+    chunksize rows, so that the memory used does not depend on the file length.
+
+    The measurements are converted to dtype (float32 by default) and the
+    trailing empty column is dropped. Time in µs
+    '''
+    names = COLUMNS_7853 if get_board_number(filename) % 2 == 0 else COLUMNS_7851
+    channels = [name for name in names if name not in ('t', '')]
+    return pd.read_csv(filename, delimiter='\t', index_col='t',
+                       names=names, usecols=channels + ['t'],
+                       dtype={channel: dtype for channel in channels},
+                       chunksize=chunksize)
+
+def decimate(df, factor, how='minmax'):
+    '''
+    Reduce a DataFrame by blocks of factor rows:
+        - 'minmax': two rows per block, the minimum (at the block start time)
+          and the maximum (at the block end time) of each channel, so that
+          spikes remain visible
+        - 'mean': mean of each block (at the block start time)
+        - 'first': first row of each block
+    '''
+    if how == 'first':
+        return df.iloc[::factor]
+    t = df.index.values
+    blocks = df.groupby(np.arange(len(df)) // factor)
+    if how == 'mean':
+        reduced = blocks.mean()
+        reduced.index = pd.Index(t[::factor], name=df.index.name)
+        return reduced
+    if how == 'minmax':
+        mins, maxs = blocks.min(), blocks.max()
+        mins.index = pd.Index(t[::factor], name=df.index.name)
+        maxs.index = pd.Index(t[np.minimum(np.arange(len(maxs))*factor + factor - 1, len(t) - 1)],
+                              name=df.index.name)
+        # interleave the min and max rows
+        reduced = pd.concat([mins, maxs], keys=[0, 1])
+        order = np.argsort(np.tile(np.arange(len(mins)), 2) * 2 + np.repeat([0, 1], len(mins)))
+        return reduced.iloc[order].droplevel(0)
+    raise ValueError(f'Unknown decimation method {how}')
+
+def read_fast_data_decimated(filename, factor, how='minmax', chunksize=CHUNKSIZE, dtype='float32'):
+    '''
+    Import a Fast Data board file, reducing it on the fly by blocks of factor
+    rows (see decimate()) while it is read by chunks. The memory used is
+    bounded by the chunk size, whatever the file length.
+    '''
+    # chunks made of whole blocks
+    chunksize = max(chunksize // factor, 1) * factor
+    try:
+        chunks = [decimate(chunk, factor, how)
+                  for chunk in iter_fast_data(filename, chunksize, dtype)]
+    except Exception as e:
+        print(f'Error in reading file {filename}: {e}')
+        return None
+    if not chunks:
+        return None
+    return pd.concat(chunks)
+
+def align(t, index, values, method='nearest', dtype='float32'):
+    '''
+    Resample signals sampled at index onto the times t, both sorted:
+        - 'nearest': value of the nearest sample
+        - 'asof': value of the last sample at or before t (NaN before the first one)
+        - 'linear': linear interpolation (edge values held outside)
+    values is an array of shape (nb_signals, len(index)); the positions are
+    found once by binary search for all the signals.
+    Returns an array of shape (nb_signals, len(t)).
+    '''
+    values = np.asarray(values)
+    if len(index) == 0:
+        return np.full((len(values), len(t)), np.nan, dtype=dtype)
+    # position of the last sample at or before each t
+    position = np.searchsorted(index, t, side='right') - 1
+    if method == 'asof':
+        aligned = values[:, np.maximum(position, 0)].astype(dtype)
+        aligned[:, position < 0] = np.nan
+        return aligned
+    before = np.clip(position, 0, len(index) - 1)
+    after = np.minimum(before + 1, len(index) - 1)
+    if method == 'nearest':
+        nearest = np.where(np.abs(index[after] - t) < np.abs(t - index[before]), after, before)
+        return values[:, nearest].astype(dtype)
+    if method == 'linear':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.clip((t - index[before]) / (index[after] - index[before]), 0, 1)
+        weight = np.nan_to_num(weight).astype(dtype)  # identical samples
+        aligned = values[:, before].astype(dtype)
+        aligned += weight * (values[:, after] - aligned)
+        return aligned
+    raise ValueError(f'Unknown alignment method {method}')
+
+def compact_series(series):
+    '''
+    Return a series in the smallest signed integer dtype holding its values,
+    or in float32 if they are not all integers. Arithmetic on these raw
+    values stays in their dtype and can overflow (e.g. the sum of two int16
+    phases): compute with physical() instead.
+    '''
+    if series.dtype.kind in 'iuf' and series.dtype.itemsize <= 4:
+        return series  # already compact
+    compact = pd.to_numeric(series, downcast='integer')
+    if compact.dtype.kind == 'f' and compact.dtype.itemsize > 4:
+        compact = compact.astype(np.float32)
+    return compact
+
+def compact_frame(df):
+    '''
+    Return a compact copy of a board or conditioning DataFrame: columns and
+    index in the smallest dtypes holding the raw fixed-point values (see
+    compact_series), and without the empty columns from the trailing tab.
+    Physical values are obtained on demand with physical().
+    '''
+    columns = {column: compact_series(df[column]) for column in df.columns
+               if not (column in ('', '_') and df[column].isna().all())}
+    compact = pd.DataFrame(columns)
+    compact.index = pd.Index(compact_series(df.index.to_series()).values, name=df.index.name)
+    return compact
+
+def physical(values, name, scales=CHANNEL_SCALES, dtype=np.float32):
+    '''
+    Return the physical values (raw * scale) of a raw channel, as a single
+    fused multiplication into dtype, or the raw array itself if it has no scale
+    and is already of dtype. See CHANNEL_SCALES for the scales and units.
+    '''
+    values = np.asarray(values)
+    scale, _ = scales.get(name, (1, ''))
+    if scale == 1 and values.dtype == dtype:
+        return values
+    return np.multiply(values, scale, dtype=dtype)
+
+def get_cache_filenames(filename):
+    '''
+    Return the (values, index, header) cache file names associated to a board file
+    '''
+    cache_path = os.path.join(os.path.dirname(filename), CACHE_DIR)
+    basename = os.path.basename(filename)
+    return (os.path.join(cache_path, basename + '.npy'),
+            os.path.join(cache_path, basename + '.index.npy'),
+            os.path.join(cache_path, basename + '.json'))
+
+def write_cache(filename, df):
+    '''
+    Save a parsed board DataFrame into the binary cache.
+
+    The columns are stored as a single 2D array (columns x rows, in the
+    parsed dtype) and the index as another array, which are memory-mapped
+    back without copy. The empty columns (trailing tab) are only listed in
+    the header, with the column names and the size/mtime of the source file,
+    in order to detect a stale cache.
+    '''
+    values_file, index_file, header_file = get_cache_filenames(filename)
+    os.makedirs(os.path.dirname(values_file), exist_ok=True)
+    stat = os.stat(filename)
+    empty = [column for column in df.columns if df[column].isna().all()]
+    columns = [column for column in df.columns if column not in empty]
+    header = {'version': CACHE_VERSION,
+              'source_size': stat.st_size,
+              'source_mtime_ns': stat.st_mtime_ns,
+              'index_name': df.index.name,
+              'columns': [str(column) for column in columns],
+              'empty_columns': [str(column) for column in empty]}
+    with io.atomic_write(values_file) as fh:
+        np.save(fh, np.ascontiguousarray(df[columns].to_numpy().T))
+    with io.atomic_write(index_file) as fh:
+        np.save(fh, df.index.values)
+    # the header last: it validates the arrays
+    with io.atomic_write(header_file, 'wt') as fh:
+        json.dump(header, fh)
+
+def read_cache(filename):
+    '''
+    Return the board DataFrame from the binary cache (memory-mapped, read-only
+    columns), or None if the cache does not exist or is outdated with respect
+    to the source file.
+    '''
+    values_file, index_file, header_file = get_cache_filenames(filename)
+    try:
+        with open(header_file, 'r') as fh:
+            header = json.load(fh)
+        stat = os.stat(filename)
+        if (header['version'] != CACHE_VERSION or header['source_size'] != stat.st_size or
+                header['source_mtime_ns'] != stat.st_mtime_ns):
+            return None
+        values = np.load(values_file, mmap_mode='r')
+        index = np.load(index_file, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+    df = pd.DataFrame(values.T, index=pd.Index(index, name=header['index_name'], copy=False),
+                      columns=header['columns'], copy=False)
+    for column in header['empty_columns']:
+        df[column] = np.nan
+    return df
+
+def delete_cache(filenames):
+    '''Remove the cache files of board files, e.g. when the board files are deleted'''
+    for filename in filenames:
+        for cache_file in get_cache_filenames(filename):
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+
+def board_fields(arguments):
+    '''Instrumentation fields of a board read: shot, file name and size'''
+    name = os.path.basename(arguments['filename'])
+    return {'shot': int(name.split('_')[1]), 'file': name,
+            'bytes': instrument.files_size([arguments['filename']])}
+
+@instrument.timed('read_board', board_fields)
+def read_board(filename, use_cache=True, decimation=None, how='minmax', compact=False):
+    '''
+    Import a Fast Data board file (7853 or 7851 depending on its number),
+    using the binary cache when it is up to date.
+
+    If decimation is given, the file is streamed and reduced by blocks of
+    decimation rows instead (see read_fast_data_decimated), without cache.
+    With compact=True, the raw values are returned in the smallest dtypes
+    (see compact_frame). The cache always holds the values as parsed, as it
+    is shared by all the readers.
+    '''
+    if decimation:
+        df = read_fast_data_decimated(filename, decimation, how)
+    else:
+        df = read_cache(filename) if use_cache else None
+        if df is None:
+            if get_board_number(filename) % 2 == 0:
+                df = read_fast_data_7853(filename)
+            else:
+                df = read_fast_data_7851(filename)
+            if use_cache and df is not None:
+                try:
+                    write_cache(filename, df)
+                except OSError as e:
+                    print(f'Unable to write the cache of {filename}: {e}')
+    return compact_frame(df) if compact and df is not None else df
+
+def get_mp_context():
+    '''
+    Return the multiprocessing context of the parsing processes. They are not
+    forked from the (possibly multithreaded, e.g. Qt) calling process but from
+    a fork server which has already imported this module, or spawned.
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+def parse_board(filename, use_cache=True, decimation=None, how='minmax', compact=False,
+                instrumented=False):
+    '''
+    Task of the parsing processes of read_boards(). With the cache, the
+    board is only written into it and True is returned if it could be parsed:
+    the calling process maps the cache back instead of receiving the whole
+    DataFrame. Otherwise the DataFrame is returned.
+
+    If instrumented, (result, records) is returned, records being the
+    instrumentation records of the read, to be emitted by the calling process.
+    '''
+    if instrumented:
+        return instrument.collect(parse_board, filename, use_cache, decimation, how, compact)
+    if use_cache and not decimation:
+        return read_board(filename, use_cache) is not None
+    return read_board(filename, use_cache, decimation, how, compact)
+
+def read_boards(filenames, max_workers=None, use_cache=True, min_size=PARALLEL_MIN_SIZE,
+                decimation=None, how='minmax', compact=False, cancel=None):
+    '''
+    Import several board files and return a dictionary filename -> DataFrame.
+
+    Boards which are not in the cache are parsed in a pool of max_workers
+    processes (default: one per CPU, see get_mp_context and parse_board),
+    unless their total size is below min_size bytes, in which case they are
+    parsed serially. decimation, how and compact are passed to read_board().
+
+    When cancel (e.g. a threading.Event) is set, the boards being parsed are
+    completed but the others are not started, and are left out of the
+    dictionary: the processes are freed for another load.
+    '''
+    boards = {}
+    to_parse = []
+    for filename in filenames:
+        df = read_cache(filename) if use_cache and not decimation else None
+        if df is not None:
+            boards[filename] = compact_frame(df) if compact else df
+        else:
+            to_parse.append(filename)
+
+    total_size = sum(os.stat(filename).st_size for filename in to_parse)
+    if len(to_parse) < 2 or total_size < min_size or max_workers == 1:
+        for filename in to_parse:
+            if cancel and cancel.is_set():
+                break
+            boards[filename] = read_board(filename, use_cache, decimation, how, compact)
+    else:
+        max_workers = min(max_workers or os.cpu_count() or 1, len(to_parse))
+        instrumented = instrument.is_enabled()
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_mp_context()) as executor:
+            futures = {executor.submit(parse_board, filename, use_cache, decimation, how, compact,
+                                       instrumented): filename for filename in to_parse}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=CANCEL_POLL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename, result = futures[future], future.result()
+                    if instrumented:
+                        result, records = result
+                        for record in records:
+                            instrument.emit(record)
+                    if isinstance(result, bool):
+                        # parsed into the cache, or unreadable
+                        df = read_cache(filename) if result else None
+                        if result and df is None:  # cache not writable
+                            df = read_board(filename, False)
+                        boards[filename] = compact_frame(df) if compact and df is not None else df
+                    else:
+                        boards[filename] = result
+                if cancel and cancel.is_set():
+                    # only the boards being parsed remain
+                    pending = {future for future in pending if not future.cancel()}
+    return boards
+
+def is_fast_data_file(filename):
+    '''Return True if the file name looks like shot_XXX_N.dat'''
+    fn_split = os.path.basename(filename).split('_')
+    return (len(fn_split) == 3 and fn_split[0] == 'shot' and fn_split[1].isdigit()
+            and io.uncompressed_name(fn_split[2]).endswith('.dat'))
+
+class ShotIndex():
+    '''
+    Persistent index (SQLite) of the local Fast Data files: shot -> board
+    files, with their size, mtime, empty flag and parse status.
+
+    The index is updated incrementally, either from the list of files just
+    copied by the sync or from a single scan of the directory, so that the
+    shot list and the empty shots are obtained from one query.
+    '''
+    def __init__(self, path='data/Fast_Data'):
+        self.path = path
+        self.db_filename = os.path.join(path, SHOT_INDEX_FILENAME)
+        # empty index for a local directory not created yet (before the first sync)
+        os.makedirs(path, exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute('''CREATE TABLE IF NOT EXISTS files (
+                               filename TEXT PRIMARY KEY, shot INTEGER, board INTEGER,
+                               size INTEGER, mtime_ns INTEGER, empty INTEGER,
+                               parsed INTEGER)''')
+            con.execute('CREATE INDEX IF NOT EXISTS files_shot ON files (shot)')
+
+    def _connect(self):
+        # one connection per operation, so the index can be used from any thread
+        return sqlite3.connect(self.db_filename, timeout=10)
+
+    def _row(self, filename, stat):
+        # a compressed empty file is not empty on disk
+        empty = stat.st_size == 0 or (io.is_compressed(filename) and io.is_empty(filename, self.path))
+        return (filename, int(filename.split('_')[1]), get_board_number(filename),
+                stat.st_size, stat.st_mtime_ns, int(empty))
+
+    def update(self, filenames=None):
+        '''
+        Update the index. If filenames (without path) are given, only these
+        files are (re)indexed, e.g. the files just copied by the sync (remote
+        names: their local copy is indexed, plain or compressed).
+        Otherwise the directory is scanned once, and only the new, modified
+        or removed files are changed in the index.
+        '''
+        with closing(self._connect()) as con, con:
+            if filenames is not None:
+                rows, removed = [], []
+                for filename in filenames:
+                    if not is_fast_data_file(filename):
+                        continue
+                    copies = io.local_copy_names(io.uncompressed_name(filename))
+                    filename = os.path.basename(io.find_local_file(copies[0], self.path))
+                    # the other (plain or compressed) copies have been replaced
+                    removed.extend((name,) for name in copies if name != filename)
+                    try:
+                        rows.append(self._row(filename, os.stat(os.path.join(self.path, filename))))
+                    except FileNotFoundError:
+                        removed.append((filename,))
+            else:
+                known = {filename: (size, mtime_ns) for filename, size, mtime_ns
+                         in con.execute('SELECT filename, size, mtime_ns FROM files')}
+                rows = []
+                with os.scandir(self.path) as entries:
+                    for entry in entries:
+                        if not entry.is_file() or not is_fast_data_file(entry.name):
+                            continue
+                        stat = entry.stat()
+                        if known.pop(entry.name, None) != (stat.st_size, stat.st_mtime_ns):
+                            rows.append(self._row(entry.name, stat))
+                removed = [(filename,) for filename in known]
+            # (re)indexed files have to be parsed again
+            con.executemany('''INSERT OR REPLACE INTO files
+                               (filename, shot, board, size, mtime_ns, empty, parsed)
+                               VALUES (?, ?, ?, ?, ?, ?, NULL)''', rows)
+            con.executemany('DELETE FROM files WHERE filename = ?', removed)
+
+    def remove(self, filenames):
+        '''Remove files (without path) from the index'''
+        with closing(self._connect()) as con, con:
+            con.executemany('DELETE FROM files WHERE filename = ?',
+                            [(filename,) for filename in filenames])
+
+    def shots(self):
+        '''
+        Return the list of (shot, empty) tuples, most recent shot first.
+        empty is True if at least one of the shot files is empty.
+        '''
+        with closing(self._connect()) as con:
+            return [(shot, bool(empty)) for shot, empty in
+                    con.execute('SELECT shot, MAX(empty) FROM files GROUP BY shot ORDER BY shot DESC')]
+
+    def empty_shots(self):
+        '''Return the set of shots for which at least one file is empty'''
+        return {shot for shot, empty in self.shots() if empty}
+
+    def shot_files(self, shot):
+        '''Return the file names (with path) of a shot, sorted by board number'''
+        with closing(self._connect()) as con:
+            return [os.path.join(self.path, filename) for (filename,) in
+                    con.execute('SELECT filename FROM files WHERE shot = ? ORDER BY board', (shot,))]
+
+    def set_parse_status(self, filenames, ok=True):
+        '''Record if files (with or without path) have been successfully parsed'''
+        with closing(self._connect()) as con, con:
+            con.executemany('UPDATE files SET parsed = ? WHERE filename = ?',
+                            [(int(ok), os.path.basename(filename)) for filename in filenames])
+
+    def parse_status(self, shot):
+        '''Return {filename: True/False/None (not parsed yet)} for a shot'''
+        with closing(self._connect()) as con:
+            return {filename: None if parsed is None else bool(parsed) for filename, parsed in
+                    con.execute('SELECT filename, parsed FROM files WHERE shot = ?', (shot,))}
+
 class FastData():
-    '''Fast Data structure'''
-    def __init__(self, shot):
+    '''
+    Fast Data structure
+
+    The boards (Q1_amplitude, Q1_phase, ..., Q4_phase) are read on first
+    access of the corresponding attribute and then kept. Accessing a board
+    which is missing, empty or unreadable raises an AttributeError.
+
+    With decimation=N, the boards are streamed and reduced by blocks of N rows
+    (see read_fast_data_decimated) to keep the memory bounded for long pulses.
+
+    With compact=True, the boards keep the raw fixed-point values of the
+    acquisition in small integer dtypes (see compact_frame); the physical
+    values of a channel are computed on demand with physical().
+
+    With preload=True, all the boards are loaded at creation (see load()),
+    until cancel (e.g. a threading.Event) is set.
+    '''
+    def __init__(self, shot, use_cache=True, preload=False, max_workers=None,
+                 decimation=None, how='minmax', shot_files=None, compact=False, cancel=None):
         self.shot = shot
-        self.shot_files = get_shot_filenames(shot)
-
-        for filename in self.shot_files:
-            print(f'Reading file {filename}')
-            if '_0.dat' in filename:
-                self.Q1_amplitude = read_fast_data_7853(filename)
-            if '_1.dat' in filename:
-                self.Q1_phase = read_fast_data_7851(filename)
-            if '_2.dat' in filename:
-                self.Q2_amplitude = read_fast_data_7853(filename)
-            if '_3.dat' in filename:
-                self.Q2_phase = read_fast_data_7851(filename)
-            if '_4.dat' in filename:
-                self.Q4_amplitude = read_fast_data_7853(filename)
-            if '_5.dat' in filename:
-                self.Q4_phase = read_fast_data_7851(filename)
+        self.use_cache = use_cache
+        self.decimation = decimation
+        self.how = how
+        self.compact = compact
+        # the shot files can be given, e.g. from a ShotIndex, to avoid a glob
+        self.shot_files = shot_files if shot_files is not None else get_shot_filenames(shot)
+        self.board_files = {BOARDS[get_board_number(filename)]: filename
+                            for filename in self.shot_files}
+        # boards which could not be loaded, and why
+        self.board_errors = {}
+        # data computed from the boards and kept with the shot
+        # (derived signals, decimation pyramids, ...)
+        self.derived = {}
+        if preload:
+            self.load(max_workers=max_workers, cancel=cancel)
+
+    def __getattr__(self, name):
+        # only called when the board has not been loaded yet
+        if name not in BOARDS.values() or 'board_files' not in self.__dict__:
+            raise AttributeError(name)
+        if name in self.board_errors:
+            raise AttributeError(self.board_errors[name])
+        filename = self.board_files.get(name)
+        if filename is None:
+            self.board_errors[name] = f'No {name} file for shot {self.shot}'
+            raise AttributeError(self.board_errors[name])
+        print(f'Reading file {filename}')
+        self._set_board(name, read_board(filename, self.use_cache, self.decimation, self.how,
+                                         self.compact))
+        if name in self.board_errors:
+            raise AttributeError(self.board_errors[name])
+        return self.__dict__[name]
+
+    def _set_board(self, name, df):
+        if df is None or df.empty:
+            self.board_errors[name] = f'{name} of shot {self.shot} is empty or unreadable ({self.board_files[name]})'
+        else:
+            setattr(self, name, df)
+
+    def load(self, boards=None, max_workers=None, cancel=None):
+        '''
+        Load at once the given boards (default: all the boards of the shot),
+        parsing them in parallel. See read_boards(): the boards skipped once
+        cancel is set are read on first access.
+        '''
+        names = [name for name in (boards or BOARDS.values())
+                 if name in self.board_files and name not in self.__dict__
+                 and name not in self.board_errors]
+        filenames = [self.board_files[name] for name in names]
+        print(f'Reading files {filenames}')
+        dfs = read_boards(filenames, max_workers=max_workers, use_cache=self.use_cache,
+                          decimation=self.decimation, how=self.how, compact=self.compact,
+                          cancel=cancel)
+        for name, filename in zip(names, filenames):
+            if filename in dfs:
+                self._set_board(name, dfs[filename])
+
+    def has_board(self, name):
+        '''Return True if the board can be loaded and contains data'''
+        try:
+            getattr(self, name)
+            return True
+        except AttributeError:
+            return False
+
+    def iter_board(self, name, chunksize=CHUNKSIZE, dtype='float32'):
+        '''
+        Iterate over a board by chunks of rows, without keeping it in memory
+        (see iter_fast_data).
+        '''
+        if name not in self.board_files:
+            raise AttributeError(f'No {name} file for shot {self.shot}')
+        return iter_fast_data(self.board_files[name], chunksize, dtype)
+
+    def align(self, channels, timebase=None, method='nearest', cache=False, dtype='float32'):
+        '''
+        Resample channels of several boards onto a common timebase (see align()).
+
+        channels is a list of (board, column), e.g. [('Q1_amplitude', 'PiG'),
+        ('Q1_phase', 'Ph4')]. The timebase is the time index of a board (by
+        default the one of the first channel) or an array of times in µs.
+        Returns (t, values), values being of shape (len(channels), len(t)).
+        With cache=True, the result is kept in self.derived (board timebases only).
+        '''
+        if timebase is None:
+            timebase = channels[0][0]
+        key = ('aligned', tuple(channels), timebase, method) if isinstance(timebase, str) else None
+        if cache and key in self.derived:
+            return self.derived[key]
+        t = getattr(self, timebase).index.values if isinstance(timebase, str) else np.asarray(timebase)
+        values = np.empty((len(channels), len(t)), dtype=dtype)
+        # all the channels of a board are resampled together
+        boards = {}
+        for row, (board, column) in enumerate(channels):
+            boards.setdefault(board, []).append((row, column))
+        for board, columns in boards.items():
+            df = getattr(self, board)
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
+            rows, names = zip(*columns)
+            values[list(rows)] = align(t, df.index.values, df[list(names)].to_numpy().T, method, dtype)
+        if cache and key is not None:
+            self.derived[key] = (t, values)
+        return t, values
+
+    def physical(self, board, column, dtype=np.float32):
+        '''
+        Return the physical values of a channel of a board, e.g.
+        physical('Q1_amplitude', 'PiG') in kW (see CHANNEL_SCALES), and 't'
+        for the time in s.
+        '''
+        df = getattr(self, board)
+        values = df.index.values if column == 't' else df[column].values
+        return physical(values, column, dtype=dtype)
+
+    def loaded_boards(self):
+        '''Return the names of the boards already loaded in memory'''
+        return [name for name in BOARDS.values() if name in self.__dict__]
+
+    def memory_usage(self):
+        '''Return the memory used by the loaded boards and the derived data [bytes]'''
+        return nbytes([getattr(self, name) for name in self.loaded_boards()]) + nbytes(self.derived)
+
+def nbytes(obj):
+    '''
+    Return the memory size [bytes] of DataFrames, arrays or objects with a
+    nbytes attribute, possibly nested in dictionaries, lists or tuples.
+    '''
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, dict):
+        return sum(nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(value) for value in obj)
+    return int(getattr(obj, 'nbytes', 0))
+
+class ShotCache():
+    '''
+    Memory bounded LRU cache of FastData objects.
+
+    The size of each shot is measured (see FastData.memory_usage) when it is
+    put in the cache, and again through update_size() when data are added to
+    it. The least recently used shots are evicted when the total size exceeds
+    max_bytes; the most recent shot is always kept.
+    '''
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.shots = OrderedDict()
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the cache can be filled from background threads
+        self.lock = threading.RLock()
+
+    def __contains__(self, shot):
+        return shot in self.shots
+
+    def __len__(self):
+        return len(self.shots)
+
+    def get(self, shot):
+        '''Return the FastData of a shot (most recently used), or None if not cached'''
+        with self.lock:
+            if shot not in self.shots:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.shots.move_to_end(shot)
+            return self.shots[shot]
+
+    def put(self, shot, data):
+        '''Add (or replace) a shot in the cache, evicting the least recently used ones'''
+        with self.lock:
+            self.shots[shot] = data
+            self.shots.move_to_end(shot)
+            self.update_size(shot)
+
+    def update_size(self, shot):
+        '''Measure again the size of a cached shot, then evict if over budget'''
+        with self.lock:
+            if shot in self.shots:
+                self.sizes[shot] = self.shots[shot].memory_usage()
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.nbytes > self.max_bytes and len(self.shots) > 1:
+                shot, _ = self.shots.popitem(last=False)
+                del self.sizes[shot]
+                self.evictions += 1
+
+    def pop(self, shot, default=None):
+        with self.lock:
+            self.sizes.pop(shot, None)
+            return self.shots.pop(shot, default)
+
+    @property
+    def nbytes(self):
+        return sum(self.sizes.values())
+
+    def stats(self):
+        '''Return a one-line summary of the cache usage'''
+        return (f'Cache: {len(self.shots)} shots, {self.nbytes/1024**2:.0f}/{self.max_bytes/1024**2:.0f} MB, '
+                f'{self.hits} hits, {self.misses} misses, {self.evictions} evictions')
 
 
 if __name__ == '__main__':
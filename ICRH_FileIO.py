@@ -8,12 +8,185 @@ Created on Thu Mar 30 11:42:47 2017
 import subprocess
 import os
 import glob
+import json
+import shutil
+import tarfile
+import hashlib
+import shlex
+import gzip
+import io
+from contextlib import contextmanager
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import ICRH_Instrument as instrument
+
+# Remote acquisition computer and the commands used to reach it. The commands
+# can be replaced by local stand-ins, e.g. SSH_COMMAND = ['env'] runs the
+# "remote" commands on the local machine (and REMOTE_HOST = '' with
+# SCP_COMMAND = ['cp'] copies local files). ssh joins its arguments into a
+# remote shell command: the remote paths are quoted with shlex.quote.
+REMOTE_HOST = 'dfci@dfci'
+SSH_COMMAND = ['ssh', REMOTE_HOST]
+SCP_COMMAND = ['scp']
+
+# Maximum number of files transferred in a single batch (command line length)
+BATCH_MAX_FILES = 500
+
+# Sync manifest, stored in the local data directory (hidden file: not listed)
+MANIFEST_FILENAME = '.sync_manifest.json'
+
+# Compressions of the local copies, by suffix added to the file names.
+# zstd requires the optional zstandard package.
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+def is_compressed(file):
+    """ Return True if the file name has a compression suffix """
+    return file.endswith(tuple(COMPRESSION_SUFFIXES.values()))
+
+def uncompressed_name(file):
+    """ Return the file name without its compression suffix (i.e. the remote name) """
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if file.endswith(suffix):
+            return file[:-len(suffix)]
+    return file
+
+def compressed_name(file, compression=None):
+    """ Return the name of the local copy of a file with the given compression """
+    return file + COMPRESSION_SUFFIXES[compression] if compression else file
+
+def local_copy_names(file):
+    """ Return the possible names of the local copy of a file (remote name): plain or compressed """
+    return [file] + [file + suffix for suffix in COMPRESSION_SUFFIXES.values()]
+
+def find_local_file(file, local_data_path=''):
+    """
+    Return the path of the local copy of a file (remote name), either plain
+    or compressed, or the plain path if there is no local copy
+    """
+    for name in local_copy_names(file):
+        path = os.path.join(local_data_path, name)
+        if os.path.exists(path):
+            return path
+    return os.path.join(local_data_path, file)
+
+def open_data_file(path, mode='rb', compression=None):
+    """
+    Open a local data file, decompressing (or compressing, in write mode) it
+    on the fly according to its suffix, or to compression if given.
+    mode is 'rb', 'rt', 'wb' or 'wt'.
+    """
+    if compression is None:
+        compression = next((name for name, suffix in COMPRESSION_SUFFIXES.items()
+                            if path.endswith(suffix)), None)
+    if compression == 'gzip':
+        # fast compression level: the files are written during the sync
+        return gzip.open(path, mode, compresslevel=1) if 'w' in mode else gzip.open(path, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('The zstandard package is required for zstd compressed files')
+        if 'w' in mode:
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(stream) if 't' in mode else stream
+    return open(path, mode)
+
+@contextmanager
+def atomic_write(path, mode='wb', compression=None):
+    """
+    Open a hidden temporary file next to path (see open_data_file), which is
+    renamed into path once written, so that a reader never sees a partially
+    written file. The temporary file is removed if the writing fails.
+    """
+    directory, name = os.path.split(path)
+    part_path = os.path.join(directory, '.'+name+'.part')
+    try:
+        with open_data_file(part_path, mode, compression) as fh:
+            yield fh
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+def remove_other_copies(file, local_data_path, keep):
+    """ Remove the local copies of a file (remote name) other than the path keep """
+    for name in local_copy_names(file):
+        path = os.path.join(local_data_path, name)
+        if path != keep and os.path.exists(path):
+            os.remove(path)
+
+def compress_file(path, compression='gzip'):
+    """
+    Compress a local file (see atomic_write), keeping its modification
+    time, and remove the uncompressed one. Returns the new path.
+    """
+    new_path = compressed_name(path, compression)
+    with open(path, 'rb') as src, atomic_write(new_path, 'wb', compression) as dst:
+        shutil.copyfileobj(src, dst, 1024**2)
+    stat = os.stat(path)
+    os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(path)
+    return new_path
+
+def decompress_file(path):
+    """ Decompress a local file, keeping its modification time. Returns the new path """
+    new_path = uncompressed_name(path)
+    with open_data_file(path, 'rb') as src, atomic_write(new_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024**2)
+    stat = os.stat(path)
+    os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(path)
+    return new_path
+
+def has_content_size(path, size):
+    """
+    Return True if the content of a local file (once decompressed) has the
+    given size. For gzip, the size is read from the trailer of the file, which
+    holds it modulo 2**32.
+    """
+    if path.endswith(COMPRESSION_SUFFIXES['gzip']):
+        with open(path, 'rb') as fh:
+            fh.seek(-4, os.SEEK_END)
+            return int.from_bytes(fh.read(4), 'little') == size % 2**32
+    if is_compressed(path):
+        content_size = 0
+        with open_data_file(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024**2), b''):
+                content_size += len(block)
+        return content_size == size
+    return os.path.getsize(path) == size
+
+def migrate_local_files(local_data_path='data/', compression='gzip', progress=None):
+    """
+    One-off compression of the existing uncompressed files of a local mirror,
+    e.g. migrate_local_files('data/Fast_Data', 'gzip'). The sync manifest
+    refers to the remote names and stays valid; a mirror without manifest
+    yet gets it seeded from the uncompressed sizes at the next sync.
+    Returns the list of the compressed files.
+    """
+    compressed = []
+    files = [file for file in list_local_files(local_data_path) if not is_compressed(file)]
+    for index, file in enumerate(files, 1):
+        path = os.path.join(local_data_path, file)
+        if not os.path.isfile(path):
+            continue
+        compress_file(path, compression)
+        compressed.append(file)
+        if progress:
+            progress(file, index, len(files))
+    return compressed
+
+@instrument.timed('list_remote', result_fields=lambda files, args: {'nb_files': len(files)})
 def list_remote_files(remote_path='/home/dfci/media/ssd/Conditionnement/'):
     """
     Returns a list of the remote files (.csv) located in the remote acquisition computer.
     """
-    ls = subprocess.Popen(['ssh', 'dfci@dfci', 'ls', remote_path ], 
+    ls = subprocess.Popen(SSH_COMMAND + ['ls', shlex.quote(remote_path)],
                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                           universal_newlines=True) # deals with Python3 string
     out, err =  ls.communicate()
@@ -22,6 +195,68 @@ def list_remote_files(remote_path='/home/dfci/media/ssd/Conditionnement/'):
     remote_file_list = sorted(remote_file_list, reverse=True) # Most recent first
     return remote_file_list
 
+def stat_remote_files(remote_path='/home/dfci/media/ssd/Conditionnement/', ssh_command=None):
+    """
+    Returns a dictionary {filename: {'size': bytes, 'mtime': seconds}} of the
+    remote files, obtained from a single remote find/stat call. Raises an
+    OSError if the listing failed (e.g. remote computer not reachable).
+    """
+    ssh_command = ssh_command or SSH_COMMAND
+    find = subprocess.Popen(ssh_command + ['find', shlex.quote(remote_path), '-maxdepth', '1', '-type', 'f',
+                                           '-exec', 'stat', '-c', '%s:%Y:%n', '{}', '+'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    out, err = find.communicate()
+    if find.returncode != 0:
+        raise OSError(f'Unable to list the remote files of {remote_path}: {err.strip()}')
+    remote_files = {}
+    for line in out.splitlines():
+        size, mtime, path = line.split(':', 2)
+        remote_files[os.path.basename(path)] = {'size': int(size), 'mtime': int(mtime)}
+    return remote_files
+
+def checksum_remote_files(file_list, remote_path, ssh_command=None):
+    """
+    Returns a dictionary {filename: md5} of a list of remote files, from a single md5sum call.
+    """
+    ssh_command = ssh_command or SSH_COMMAND
+    if not file_list:
+        return {}
+    md5 = subprocess.Popen(ssh_command + ['md5sum'] + [shlex.quote(os.path.join(remote_path, file))
+                                                       for file in file_list],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+    out, err = md5.communicate()
+    checksums = {}
+    for line in out.splitlines():
+        checksum, path = line.split(maxsplit=1)
+        checksums[os.path.basename(path)] = checksum
+    return checksums
+
+def checksum_local_file(path):
+    """ Returns the md5 checksum of the (decompressed) content of a local file """
+    md5 = hashlib.md5()
+    with open_data_file(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024**2), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def read_manifest(local_data_path='data/'):
+    """
+    Returns the sync manifest {filename: {'size':, 'mtime':, ['md5':]}} of a
+    local directory, i.e. the remote state of the files when they were copied.
+    """
+    try:
+        with open(os.path.join(local_data_path, MANIFEST_FILENAME), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest, local_data_path='data/'):
+    """ Save the sync manifest of a local directory """
+    with atomic_write(os.path.join(local_data_path, MANIFEST_FILENAME), 'wt') as fh:
+        json.dump(manifest, fh, indent=0, sort_keys=True)
+
 def list_local_files(local_data_path='data/'):
     """ 
     Returns the list of local files 
@@ -31,35 +266,246 @@ def list_local_files(local_data_path='data/'):
     local_file_list = sorted(local_file_list, reverse=True)
     return local_file_list
 
+def print_progress(file, index, total):
+    """ Default progress report of the file transfers """
+    print('Copied file {} ({}/{})'.format(file, index, total))
+
+def copy_remote_files_batch(file_list, local_data_path='data/',
+                            remote_data_path='/home/dfci/media/ssd/Conditionnement/',
+                            ssh_command=None, progress=print_progress, cancel=None,
+                            compression=None, plain_files=()):
+    """
+    Copy a list of remote files into the local directory through a single ssh
+    connection, as a tar stream (by batches of BATCH_MAX_FILES files).
+
+    Each file is written into a temporary file first and renamed once complete.
+    With compression ('gzip' or 'zstd'), the files are compressed on the fly,
+    except plain_files (e.g. a file being followed).
+    progress(file, index, total) is called after each file. The transfer stops
+    after the current file when cancel (e.g. a threading.Event) is set.
+    Returns the list of the copied files.
+    """
+    ssh_command = ssh_command or SSH_COMMAND
+    copied_files = []
+    for start in range(0, len(file_list), BATCH_MAX_FILES):
+        if cancel and cancel.is_set():
+            break
+        batch = file_list[start:start+BATCH_MAX_FILES]
+        tar_process = subprocess.Popen(ssh_command + ['tar', '-C', shlex.quote(remote_data_path), '-cf', '-']
+                                       + [shlex.quote(file) for file in batch],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=tar_process.stdout, mode='r|') as tar:
+                for member in tar:
+                    # only accept the regular files which have been requested
+                    if not member.isfile() or member.name not in batch:
+                        continue
+                    file_compression = None if member.name in plain_files else compression
+                    path = os.path.join(local_data_path, compressed_name(member.name, file_compression))
+                    # the hidden temporary file is not listed by list_local_files()
+                    with tar.extractfile(member) as src, \
+                            atomic_write(path, 'wb', file_compression) as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.utime(path, (member.mtime, member.mtime))
+                    remove_other_copies(member.name, local_data_path, keep=path)
+                    copied_files.append(member.name)
+                    if progress:
+                        progress(member.name, len(copied_files), len(file_list))
+                    if cancel and cancel.is_set():
+                        tar_process.kill()
+                        break
+        except tarfile.ReadError as e:
+            print(f'Error in reading the tar stream: {e}')
+        _, err = tar_process.communicate()
+        if cancel and cancel.is_set():
+            pass
+        elif tar_process.returncode == 1:
+            # tar could read all the files, but some were modified meanwhile
+            # (e.g. still being written): they are copied again at next sync
+            print('Warning during the batch copy: {}'.format(err.decode(errors='replace').strip()))
+        elif tar_process.returncode != 0:
+            print('Error during the batch copy: {}'.format(err.decode(errors='replace').strip()))
+    return copied_files
+
+def copy_remote_files_scp(file_list, local_data_path='data/',
+                          remote_data_path='/home/dfci/media/ssd/Conditionnement/',
+                          scp_command=None, progress=print_progress, cancel=None,
+                          compression=None, remote_host=None, plain_files=()):
+    """
+    Copy a list of remote files into the local directory, with one scp per file,
+    from remote_host (default REMOTE_HOST, '' for a local copy).
+    With compression ('gzip' or 'zstd'), each file is compressed once copied,
+    except plain_files.
+    The copy stops after the current file when cancel is set.
+    Returns the list of the copied files.
+    """
+    scp_command = scp_command or SCP_COMMAND
+    remote_host = REMOTE_HOST if remote_host is None else remote_host
+    copied_files = []
+    for file in file_list:
+        if cancel and cancel.is_set():
+            break
+        print('Copying file {} to {}'.format(os.path.join(remote_data_path, file), local_data_path))
+        # Use call() instead of Popen() in order to block and not continue until end of copying
+        # -p preserves the modification time of the remote file
+        source = os.path.join(remote_data_path, file)
+        if remote_host:
+            source = remote_host + ':' + source
+        cp=subprocess.call(scp_command + ['-p', source, local_data_path],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+        if cp == 0:
+            path = os.path.join(local_data_path, file)
+            if compression and file not in plain_files:
+                path = compress_file(path, compression)
+            remove_other_copies(file, local_data_path, keep=path)
+            copied_files.append(file)
+            if progress:
+                progress(file, len(copied_files), len(file_list))
+    return copied_files
+
+def copied_fields(copied_files, arguments):
+    """ Instrumentation fields of a copy: number and size of the copied files """
+    return {'nb_files': len(copied_files),
+            'bytes': instrument.files_size([find_local_file(file, arguments['local_data_path'])
+                                            for file in copied_files])}
+
+@instrument.timed('copy', result_fields=copied_fields)
 def copy_remote_files_to_local(remote_file_list, local_data_path = 'data/', 
                                remote_data_path='/home/dfci/media/ssd/Conditionnement/', 
-                               nb_last_file_to_download=1000):
+                               nb_last_file_to_download=1000, batch=False,
+                               ssh_command=None, scp_command=None,
+                               progress=print_progress, compression=None, remote_host=None):
     """
     Copy a list of remote files into the local directory, only if the files do
-    not exist locally.
+    not exist locally (plain or compressed).
     Download only the last (most recent) nb_last_file_to_download files.
+
+    With batch=True, all the files are transferred through a single ssh
+    connection (see copy_remote_files_batch), instead of one scp per file.
+    With compression ('gzip' or 'zstd'), the local copies are compressed.
+    Returns the list of the copied files.
     """
     # List the files allready present in the local directory
-    local_file_list = list_local_files(local_data_path)
+    local_file_list = {uncompressed_name(file) for file in list_local_files(local_data_path)}
     # Copy files through scp when the file does not exist locally
     print('Looking for new files on dfci...')
-    for file in remote_file_list[:nb_last_file_to_download]:
-        if file not in local_file_list:
-            print('Copying file {} to {}'.format(os.path.join(remote_data_path, file), local_data_path))
-            # Use call() instead of Popen() in order to block and not continue until end of copying
-            cp=subprocess.call(['scp', 'dfci@dfci:'+os.path.join(remote_data_path, file), local_data_path],
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                              universal_newlines=True)
-            
+    new_files = [file for file in remote_file_list[:nb_last_file_to_download]
+                 if file not in local_file_list]
+    if batch:
+        copied_files = copy_remote_files_batch(new_files, local_data_path, remote_data_path,
+                                               ssh_command=ssh_command, progress=progress,
+                                               compression=compression)
+    else:
+        copied_files = copy_remote_files_scp(new_files, local_data_path, remote_data_path,
+                                             scp_command=scp_command, progress=progress,
+                                             compression=compression, remote_host=remote_host)
     print('OK, done.')
+    return copied_files
+
+@instrument.timed('sync', result_fields=copied_fields)
+def sync_remote_files(local_data_path='data/',
+                      remote_data_path='/home/dfci/media/ssd/Conditionnement/',
+                      nb_last_file_to_download=1000, batch=True, checksum=False,
+                      ssh_command=None, scp_command=None, progress=print_progress,
+                      cancel=None, compression=None, remote_host=None, plain_files=()):
+    """
+    Incremental synchronization of the remote directory into the local one.
+
+    The remote sizes and mtimes are compared to the ones recorded in the local
+    sync manifest: only the new or modified files (e.g. files which were still
+    being written during the previous sync) are copied. The local files which
+    are not in the manifest yet are recorded in it if their size matches the
+    remote one (uncompressed size for a compressed copy), instead of being
+    copied again. If the remote listing fails, an OSError is raised and
+    nothing is copied nor forgotten from the manifest. With checksum=True,
+    the copied files are also checked against their remote md5 checksum.
+    Download only the last (most recent) nb_last_file_to_download files.
+    The copy stops after the current file when cancel (e.g. a threading.Event)
+    is set: the manifest is then updated with the files already copied.
+    With compression ('gzip' or 'zstd'), the local copies are compressed,
+    except plain_files: a file being followed (see ConditioningFollower) is
+    read from its last offset, which a compressed copy can not do cheaply.
+    Returns the list of the copied files.
+    """
+    print('Looking for new or modified files on dfci...')
+    os.makedirs(local_data_path, exist_ok=True)
+    remote_files = stat_remote_files(remote_data_path, ssh_command=ssh_command)
+    manifest = read_manifest(local_data_path)
+    to_copy = []
+    for file in sorted(remote_files, reverse=True)[:nb_last_file_to_download]:
+        remote, known = remote_files[file], manifest.get(file, {})
+        local_path = find_local_file(file, local_data_path)
+        if file not in manifest and os.path.exists(local_path) and has_content_size(local_path, remote['size']):
+            # copied before the manifest existed (first sync after an upgrade):
+            # the complete local copies are recorded instead of copied again
+            manifest[file] = dict(remote)
+            continue
+        # the size of a compressed copy can not be compared to the remote one
+        if (known.get('size') != remote['size'] or known.get('mtime') != remote['mtime']
+                or not os.path.exists(local_path)
+                or (not is_compressed(local_path) and os.path.getsize(local_path) != remote['size'])):
+            to_copy.append(file)
+
+    if batch:
+        copied_files = copy_remote_files_batch(to_copy, local_data_path, remote_data_path,
+                                               ssh_command=ssh_command, progress=progress,
+                                               cancel=cancel, compression=compression,
+                                               plain_files=plain_files)
+    else:
+        copied_files = copy_remote_files_scp(to_copy, local_data_path, remote_data_path,
+                                             scp_command=scp_command, progress=progress,
+                                             cancel=cancel, compression=compression,
+                                             remote_host=remote_host, plain_files=plain_files)
+
+    checksums = checksum_remote_files(copied_files, remote_data_path, ssh_command) if checksum else {}
+    for file in copied_files:
+        manifest[file] = dict(remote_files[file])
+        if checksum:
+            local_checksum = checksum_local_file(find_local_file(file, local_data_path))
+            if checksums.get(file) != local_checksum:
+                print(f'Checksum mismatch for {file}: it will be copied again at next sync')
+                del manifest[file]
+                continue
+            manifest[file]['md5'] = local_checksum
+    # forget the files which no longer exist on the remote side
+    manifest = {file: entry for file, entry in manifest.items() if file in remote_files}
+    write_manifest(manifest, local_data_path)
+    print('OK, done.')
+    return copied_files
     
+def append_remote_file(file, local_data_path='data/',
+                       remote_data_path='/home/dfci/media/ssd/Conditionnement/',
+                       ssh_command=None):
+    """
+    Append to a local file the bytes written in the remote file since the
+    local copy was made (e.g. a conditioning run in progress), so that only
+    the new data are transferred. Returns the number of bytes appended.
+    """
+    ssh_command = ssh_command or SSH_COMMAND
+    local_path = find_local_file(file, local_data_path)
+    if is_compressed(local_path):
+        # a file still being written is kept uncompressed to be appended
+        local_path = decompress_file(local_path)
+    offset = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+    tail = subprocess.Popen(ssh_command + ['tail', '-c', '+{}'.format(offset + 1),
+                                           shlex.quote(os.path.join(remote_data_path, file))],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = tail.communicate()
+    if tail.returncode != 0:
+        print('Error in reading remote file {}: {}'.format(file, err.decode(errors='replace').strip()))
+        return 0
+    with open(local_path, 'ab') as fh:
+        fh.write(out)
+    return len(out)
+
 def delete_remote_files(remote_file_list, remote_data_path):
     """ delete a  list of files on the remote server """
     # TODO: deal properly with errors
     for file in remote_file_list:
         path=os.path.join(remote_data_path, file)
         print(f'Deleting remote file: {path}')
-        command = ["ssh", "dfci@dfci", 'rm', path]
+        command = SSH_COMMAND + ['rm', shlex.quote(path)]
         output=subprocess.call(command, 
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                                 universal_newlines=True)
@@ -73,8 +519,12 @@ def delete_local_files(local_file_list, local_data_path):
         os.remove(path)
 
 def is_empty(file, local_data_path=''):
-    ''' Return True is the file is empty '''
-    return os.stat(os.path.join(local_data_path, file)).st_size == 0
+    ''' Return True is the file is empty (once decompressed, for a compressed file) '''
+    path = os.path.join(local_data_path, file)
+    if is_compressed(file):
+        with open_data_file(path, 'rb') as fh:
+            return not fh.read(1)
+    return os.stat(path).st_size == 0
 
 def clean_empty_files(local_data_path=''):
     local_files = list_local_files(local_data_path)
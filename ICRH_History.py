@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Consolidated history of the conditioning runs.
+
+Each conditioning file (data/Cond_Data/YYYY-MM-DD_HH-MM-SS.csv) is ingested
+once into a columnar store partitioned by date:
+
+    data/Cond_History/catalog.json                  runs, file state and metadata
+    data/Cond_History/YYYY-MM-DD/<run>/<column>.npy one array per column
+
+so that a query over weeks of conditioning only reads the columns and the
+dates it needs, instead of parsing again hundreds of csv files. The store is
+updated incrementally (new or modified files only, runs deleted locally are
+dropped) after each sync:
+
+    python ICRH_History.py -p data/Cond_Data -s data/Cond_History
+"""
+import os
+import json
+import shutil
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import ICRH_Conditioning as condi
+import ICRH_FileIO as io
+
+HISTORY_PATH = 'data/Cond_History'
+CATALOG_FILENAME = 'catalog.json'
+
+# Columns stored (the last one comes from the trailing tab)
+COLUMNS = [column for column in condi.COLUMNS if column != '_']
+
+
+def get_run_date(filename):
+    '''Return the date YYYY-MM-DD of a conditioning file, from its name or else its modification time'''
+    name = os.path.basename(filename)
+    try:
+        return datetime.strptime(name[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return datetime.fromtimestamp(os.stat(filename).st_mtime).strftime('%Y-%m-%d')
+
+def get_run_name(filename):
+    '''Return the run name of a conditioning file: its name without extension(s)'''
+    return os.path.splitext(io.uncompressed_name(os.path.basename(filename)))[0]
+
+def read_catalog(store_path=HISTORY_PATH):
+    '''Return the catalog {run: {'date', 'size', 'mtime_ns', 'nb_rows', 'metadata'}} of the store'''
+    try:
+        with open(os.path.join(store_path, CATALOG_FILENAME), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def write_catalog(catalog, store_path=HISTORY_PATH):
+    with io.atomic_write(os.path.join(store_path, CATALOG_FILENAME), 'wt') as fh:
+        json.dump(catalog, fh, indent=0, sort_keys=True)
+
+def get_run_path(store_path, date, run):
+    return os.path.join(store_path, date, run)
+
+def write_run(filename, store_path=HISTORY_PATH):
+    '''
+    Parse a conditioning file and write its columns into the store.
+    Returns the catalog entry of the run.
+    '''
+    data, metadata = condi.read_conditioning_file(filename)
+    run = get_run_name(filename)
+    date = get_run_date(filename)
+    run_path = get_run_path(store_path, date, run)
+    # the whole run directory is swapped at once: a query never sees a partial
+    # run, and the previous version is only removed once replaced (see restore_runs)
+    tmp_path = run_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'Temps.npy'), data.index.values)
+    for column in COLUMNS[1:]:
+        np.save(os.path.join(tmp_path, column + '.npy'), data[column].values)
+    old_path = run_path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(run_path):
+        os.replace(run_path, old_path)
+    os.replace(tmp_path, run_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    stat = os.stat(filename)
+    return {'date': date, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'nb_rows': len(data), 'metadata': metadata}
+
+def restore_runs(catalog, store_path=HISTORY_PATH):
+    '''Restore the previous version of the runs whose swap was interrupted (see write_run)'''
+    for run, entry in catalog.items():
+        run_path = get_run_path(store_path, entry['date'], run)
+        if not os.path.exists(run_path) and os.path.exists(run_path + '.old'):
+            os.replace(run_path + '.old', run_path)
+
+def remove_run(run, entry, store_path=HISTORY_PATH):
+    shutil.rmtree(get_run_path(store_path, entry['date'], run), ignore_errors=True)
+
+def ingest(local_data_path='data/Cond_Data', store_path=HISTORY_PATH, progress=None):
+    '''
+    Add to the store the conditioning files which are new or have changed
+    since they were ingested (e.g. a run which was still being written), and
+    drop the runs whose file no longer exists locally.
+    Returns the list of the ingested runs.
+    '''
+    os.makedirs(store_path, exist_ok=True)
+    catalog = read_catalog(store_path)
+    restore_runs(catalog, store_path)
+    ingested = []
+    files = [file for file in io.list_local_files(local_data_path)
+             if io.uncompressed_name(file).endswith('.csv')]
+    # runs deleted locally (not when the directory is missing, e.g. not mounted)
+    removed = []
+    if os.path.isdir(local_data_path):
+        local_runs = {get_run_name(file) for file in files}
+        removed = [run for run in catalog if run not in local_runs]
+    for run in removed:
+        remove_run(run, catalog.pop(run), store_path)
+    for index, file in enumerate(files, 1):
+        filename = os.path.join(local_data_path, file)
+        run = get_run_name(file)
+        stat = os.stat(filename)
+        entry = catalog.get(run)
+        if io.is_empty(file, local_data_path) or (entry and entry['size'] == stat.st_size
+                                 and entry['mtime_ns'] == stat.st_mtime_ns):
+            continue
+        try:
+            catalog[run] = write_run(filename, store_path)
+        except Exception as e:
+            print(f'Error in ingesting file {file}: {e}')
+            continue
+        ingested.append(run)
+        if progress:
+            progress(file, index, len(files))
+    if ingested or removed:
+        write_catalog(catalog, store_path)
+    return ingested
+
+def select_runs(catalog, start=None, end=None):
+    '''Return the sorted runs of the catalog between the dates start and end (YYYY-MM-DD, included)'''
+    return sorted(run for run, entry in catalog.items()
+                  if (start is None or entry['date'] >= start)
+                  and (end is None or entry['date'] <= end))
+
+def get_catalog(start=None, end=None, store_path=HISTORY_PATH):
+    '''
+    Return a DataFrame of the runs between the dates start and end, with
+    their date, number of rows and metadata fields (one column per field).
+    '''
+    catalog = read_catalog(store_path)
+    rows = [dict(catalog[run]['metadata'], run=run, date=catalog[run]['date'],
+                 nb_rows=catalog[run]['nb_rows']) for run in select_runs(catalog, start, end)]
+    return pd.DataFrame(rows).set_index('run') if rows else pd.DataFrame()
+
+def query(columns=None, start=None, end=None, store_path=HISTORY_PATH):
+    '''
+    Return a DataFrame of the given columns (default: all) of the runs between
+    the dates start and end (YYYY-MM-DD, included), with the run name and the
+    time within the run ('Temps'). Only the requested columns are read.
+    '''
+    catalog = read_catalog(store_path)
+    columns = [column for column in (columns or COLUMNS[1:]) if column != 'Temps']
+    runs = select_runs(catalog, start, end)
+    parts = {column: [] for column in ['Temps'] + columns}
+    for run in runs:
+        run_path = get_run_path(store_path, catalog[run]['date'], run)
+        for column in parts:
+            parts[column].append(np.load(os.path.join(run_path, column + '.npy'), mmap_mode='r'))
+    data = pd.DataFrame({column: np.concatenate(arrays) if arrays else np.empty(0)
+                         for column, arrays in parts.items()})
+    data.insert(0, 'run', pd.Categorical(np.repeat(runs, [len(array) for array in parts['Temps']]),
+                                         categories=runs))
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest the conditioning files into the history store')
+    parser.add_argument('-p', '--path', default='data/Cond_Data', help='conditioning files directory')
+    parser.add_argument('-s', '--store', default=HISTORY_PATH, help='history store directory')
+    args = parser.parse_args()
+    runs = ingest(args.path, args.store, progress=lambda file, index, total: print(f'Ingested {file} ({index}/{total})'))
+    print(f'{len(runs)} runs ingested')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight timing and memory instrumentation.
+
+The instrumented steps (remote listing and copies, board reads, derived
+signals, plots) record their duration, the bytes processed, the current
+resident memory of the process at the end of the step (memory) and its
+change during the step (memory_increase), and the shot, as JSON records
+kept in memory and optionally appended to a log file (one JSON object per
+line). The board reads done in the parsing worker processes are returned to
+the calling process with collect() and recorded there.
+
+The instrumentation is disabled by default and then costs a single flag
+test per call. It is enabled with enable(), or with the environment
+variables (ICRH_INSTRUMENT=0, false, no or off leaves it disabled):
+
+    ICRH_INSTRUMENT=1 ICRH_INSTRUMENT_LOG=icrh_timings.jsonl python gui_fastacq.py
+"""
+import os
+import time
+import json
+import inspect
+import functools
+import threading
+from collections import deque
+
+
+def parse_flag(value):
+    '''Return the boolean value of an environment variable'''
+    return (value or '').strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+ENABLED = parse_flag(os.environ.get('ICRH_INSTRUMENT'))
+LOG_FILENAME = os.environ.get('ICRH_INSTRUMENT_LOG') or None
+
+# Number of records kept in memory
+MAX_RECORDS = 10000
+
+records = deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+# records of the calls run by collect(), per thread
+_collected = threading.local()
+
+
+def enable(log_filename=None):
+    '''Enable the instrumentation, also in the worker processes started afterwards'''
+    global ENABLED, LOG_FILENAME
+    ENABLED, LOG_FILENAME = True, log_filename
+    os.environ['ICRH_INSTRUMENT'] = '1'
+    if log_filename:
+        os.environ['ICRH_INSTRUMENT_LOG'] = log_filename
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    os.environ.pop('ICRH_INSTRUMENT', None)
+
+def is_enabled():
+    '''Return True if the instrumentation is enabled, or if run by collect() in this thread'''
+    return ENABLED or getattr(_collected, 'records', None) is not None
+
+def current_memory():
+    '''Return the current resident memory of the process [bytes], or None if unknown (not Linux)'''
+    try:
+        with open('/proc/self/statm', 'rb') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def emit(record):
+    '''Keep a record in memory and append it to the log file, if any'''
+    collected = getattr(_collected, 'records', None)
+    if collected is not None:
+        collected.append(record)
+        return
+    with _lock:
+        records.append(record)
+        if LOG_FILENAME:
+            with open(LOG_FILENAME, 'a') as fh:
+                fh.write(json.dumps(record, default=str) + '\n')
+
+class Measure():
+    '''
+    Context manager recording the duration of a step. Fields (shot, bytes,
+    ...) can be given at creation or added during the step with set().
+    '''
+    def __init__(self, name, fields=None):
+        self.name = name
+        self.fields = fields or {}
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.start_memory = current_memory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        memory = current_memory()
+        record = {'event': self.name, 'time': time.time(), 'duration': duration,
+                  'memory': memory,
+                  'memory_increase': None if memory is None else memory - self.start_memory,
+                  'pid': os.getpid()}
+        record.update(self.fields)
+        if exc_type is not None:
+            record['error'] = repr(exc_value)
+        emit(record)
+        return False
+
+class _NullMeasure():
+    ''' Measure doing nothing, used when the instrumentation is disabled '''
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_MEASURE = _NullMeasure()
+
+def measure(name, **fields):
+    '''Return a context manager recording the duration of a step named name'''
+    return Measure(name, fields) if is_enabled() else NULL_MEASURE
+
+def timed(name, fields=None, result_fields=None):
+    '''
+    Decorator recording the duration of each call of a function.
+    fields(arguments) and result_fields(result, arguments) return the fields
+    to record, arguments being the dictionary of the call arguments (with
+    their default values). They are only evaluated when enabled.
+    '''
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return function(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            with Measure(name, fields(bound.arguments) if fields else {}) as step:
+                result = function(*args, **kwargs)
+                if result_fields:
+                    step.set(**result_fields(result, bound.arguments))
+            return result
+        return wrapper
+    return decorator
+
+def collect(function, *args, **kwargs):
+    '''
+    Call function with the instrumentation enabled in this thread (ENABLED
+    is left unchanged) and return its result and the list of the records of
+    the call, which are not emitted. Used in the worker processes, the
+    calling process emitting the records with emit().
+    '''
+    _collected.records = []
+    try:
+        return function(*args, **kwargs), _collected.records
+    finally:
+        _collected.records = None
+
+def files_size(file_list, path=''):
+    '''Return the total size [bytes] of existing files'''
+    return sum(os.path.getsize(os.path.join(path, file)) for file in file_list
+               if os.path.exists(os.path.join(path, file)))
+
+def get_records(shot=None, event=None):
+    '''Return the records in memory, optionally of a shot and/or an event'''
+    with _lock:
+        return [record for record in records
+                if (shot is None or record.get('shot') == shot)
+                and (event is None or record['event'] == event)]
+
+def summary(shot):
+    '''
+    Return a one-line summary of the last load of a shot: the steps of the
+    load are added up, and only the last record of the later steps (plots) is
+    kept. The last sync is also given.
+    '''
+    records = get_records(shot)
+    loads = [record for record in records if record['event'] == 'load_shot']
+    start, end = -float('inf'), float('inf')
+    if loads:
+        start, end = loads[-1]['time'] - loads[-1]['duration'], loads[-1]['time']
+    totals = {}
+    for record in records:
+        if record['time'] - record['duration'] < start:
+            continue
+        if record['time'] > end:  # after the load: replaces the previous ones
+            totals.pop(record['event'], None)
+        total = totals.setdefault(record['event'], {'duration': 0, 'bytes': 0})
+        total['duration'] += record['duration']
+        total['bytes'] += record.get('bytes') or 0
+    syncs = [record for record in get_records() if record['event'] in ('sync', 'copy')]
+    if syncs:
+        totals = dict({'last sync': {'duration': syncs[-1]['duration'],
+                                     'bytes': syncs[-1].get('bytes') or 0}}, **totals)
+    items = [f'{event} {total["duration"]:.2f} s' + (f' ({total["bytes"]/1024**2:.1f} MB)' if total['bytes'] else '')
+             for event, total in totals.items()]
+    memory = current_memory()
+    if memory:
+        items.append(f'current memory {memory/1024**2:.0f} MB')
+    return f'Shot {shot}: ' + ', '.join(items)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Headless reports of the conditioning runs and of the Fast Data shots.
+
+For each conditioning file and each shot, a PNG figure and a small HTML page
+(figure and metadata) are rendered with the non-interactive Agg backend, in
+parallel worker processes. An index.html links all the reports. The names
+and sizes of the data files of each report are recorded in
+<report>.sources.json, and the reports whose data files have not changed
+are not rendered again (the mtimes can not be used: the sync keeps the
+remote ones, so a file arriving late can be older than the report):
+
+    python ICRH_Report.py -o reports                  # all the files
+    python ICRH_Report.py -o reports -d 2017-02-27    # files of a day only
+"""
+import os
+import html
+import json
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import ICRH_Conditioning as condi
+import ICRH_FastData as fast
+import ICRH_FileIO as io
+import ICRH_Derived as derived
+import ICRH_Decimation as decimation
+
+# Number of points per curve in the Fast Data figures (min/max decimation)
+PIXELS = 2000
+
+DPI = 100
+
+HTML_TEMPLATE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+<img src="{image}" alt="{title}">
+{table}
+</body></html>
+'''
+
+
+def get_sources(source_filenames):
+    '''Return {file name: size} of the source files of a report'''
+    return {os.path.basename(filename): os.stat(filename).st_size for filename in source_filenames}
+
+def is_up_to_date(name, source_filenames, output_path):
+    '''Return True if the report exists and its source files have not changed since it was rendered'''
+    try:
+        with open(os.path.join(output_path, name + '.sources.json'), 'r') as fh:
+            sources = json.load(fh)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(os.path.join(output_path, name + '.html')) and sources == get_sources(source_filenames)
+
+def get_file_date(filename):
+    '''Return the date YYYY-MM-DD of the last modification of a file'''
+    return datetime.fromtimestamp(os.stat(filename).st_mtime).strftime('%Y-%m-%d')
+
+def html_table(rows):
+    '''Return an HTML table of (key, value) rows'''
+    lines = ''.join(f'<tr><td>{html.escape(str(key))}</td><td>{html.escape(str(value))}</td></tr>\n'
+                    for key, value in rows)
+    return f'<table>\n{lines}</table>'
+
+def write_report(fig, name, title, rows, output_path, sources):
+    '''
+    Save a figure into name.png and its HTML page name.html, then close it,
+    and the sources {file name: size} of the report into name.sources.json
+    '''
+    fig.savefig(os.path.join(output_path, name + '.png'), dpi=DPI)
+    plt.close(fig)
+    with open(os.path.join(output_path, name + '.html'), 'w') as fh:
+        fh.write(HTML_TEMPLATE.format(title=html.escape(title), image=name + '.png',
+                                      table=html_table(rows)))
+    # written last: an interrupted report is rendered again
+    with io.atomic_write(os.path.join(output_path, name + '.sources.json'), 'wt') as fh:
+        json.dump(sources, fh, sort_keys=True)
+
+def plot_fast_data(signals, shot):
+    '''
+    Plot the powers, VSWR, voltages and phases of all the quadrants of a shot
+    (see ICRH_Derived.derive_fast_data) into a single figure, as in gui_fastacq.
+    Returns the figure.
+    '''
+    fig, ax = plt.subplots(4, len(derived.QUADRANTS), sharex='col', figsize=(18, 12))
+    rows = ((0, 'amplitude', ('PiG', 'PrG', 'PiD', 'PrD', 'Consigne'), 'Power [kW]'),
+            (1, 'amplitude', ('VSWR_G', 'VSWR_D'), 'VSWR'),
+            (2, 'amplitude', ('V1', 'V2', 'V3', 'V4'), 'Voltage'),
+            (3, 'phase', ('Ph_G', 'Ph_D'), 'Phase [deg]'))
+    for col, quadrant in enumerate(derived.QUADRANTS):
+        ax[0, col].set_title(f'{quadrant} - shot {shot}')
+        for row, board, names, label in rows:
+            board_signals = signals[quadrant].get(board)
+            if board_signals:
+                for name in names:
+                    # min/max decimation keeps the spikes visible with few points
+                    t, y = decimation.MinMaxPyramid(board_signals['t'], board_signals[name]).select(pixels=PIXELS)
+                    ax[row, col].plot(t, y, label=name, lw=0.8)
+                ax[row, col].legend(loc='upper right', fontsize='small')
+            ax[row, 0].set_ylabel(label)
+        ax[1, col].set_ylim(1, 5)
+        ax[3, col].set_xlabel('Time [s]')
+    fig.tight_layout()
+    return fig
+
+def report_conditioning(filename, output_path):
+    '''Render the report of a conditioning file. Returns the report name'''
+    name = os.path.splitext(io.uncompressed_name(os.path.basename(filename)))[0]
+    sources = get_sources([filename])
+    data, metadata = condi.read_conditioning_file(filename)
+    fig = condi.plot_conditionning_data(data)
+    fig.set_size_inches(12, 8)
+    write_report(fig, name, f'Conditioning {name}', metadata.items(), output_path, sources)
+    return name
+
+def report_shot(shot, shot_files, output_path):
+    '''Render the report of a Fast Data shot. Returns the report name'''
+    name = f'shot_{shot}'
+    sources = get_sources(shot_files)
+    data = fast.FastData(shot, shot_files=shot_files)
+    signals = derived.derive_fast_data(data)
+    fig = plot_fast_data(signals, shot)
+    rows = [(board, os.path.basename(filename)) for board, filename in data.board_files.items()]
+    rows += [(board, error) for board, error in data.board_errors.items()]
+    write_report(fig, name, f'Fast Data shot {shot}', rows, output_path, sources)
+    return name
+
+def get_report_tasks(cond_path, fast_path, output_path, date=None, force=False):
+    '''
+    Return the list of (report name, function, arguments) of the reports to
+    render, i.e. of the files of the given date (all if None) whose report
+    is missing or whose files have changed (see is_up_to_date), and the list
+    of all the report names.
+    '''
+    tasks, names = [], []
+    if cond_path and os.path.isdir(cond_path):
+        for file in io.list_local_files(cond_path):
+            filename = os.path.join(cond_path, file)
+            if not io.uncompressed_name(file).endswith('.csv') or io.is_empty(file, cond_path):
+                continue
+            if date and not file.startswith(date) and get_file_date(filename) != date:
+                continue
+            name = os.path.splitext(io.uncompressed_name(file))[0]
+            names.append(name)
+            if force or not is_up_to_date(name, [filename], output_path):
+                tasks.append((name, report_conditioning, (filename, output_path)))
+    if fast_path and os.path.isdir(fast_path):
+        files = [file for file in io.list_local_files(fast_path) if fast.is_fast_data_file(file)]
+        for shot in fast.get_shot_list(files):
+            shot_files = fast.get_shot_filenames(shot, fast_path)
+            if date and not any(get_file_date(filename) == date for filename in shot_files):
+                continue
+            name = f'shot_{shot}'
+            names.append(name)
+            if force or not is_up_to_date(name, shot_files, output_path):
+                tasks.append((name, report_shot, (shot, shot_files, output_path)))
+    return tasks, names
+
+def write_index(names, output_path):
+    '''Write index.html linking all the reports'''
+    links = ''.join(f'<li><a href="{name}.html">{name}</a></li>\n' for name in names)
+    with open(os.path.join(output_path, 'index.html'), 'w') as fh:
+        fh.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>ICRH reports</title></head>\n'
+                 f'<body>\n<h1>ICRH reports</h1>\n<ul>\n{links}</ul>\n</body></html>\n')
+
+def generate_reports(cond_path='data/Cond_Data', fast_path='data/Fast_Data', output_path='reports',
+                     date=None, max_workers=None, force=False):
+    '''
+    Render in parallel the reports which are not up to date and write the
+    index. Returns the names of the rendered reports.
+    '''
+    os.makedirs(output_path, exist_ok=True)
+    tasks, names = get_report_tasks(cond_path, fast_path, output_path, date, force)
+    print(f'{len(tasks)} reports to render ({len(names) - len(tasks)} up to date)')
+    rendered = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(function, *args): name for name, function, args in tasks}
+        for index, future in enumerate(as_completed(futures), 1):
+            try:
+                rendered.append(future.result())
+                print(f'Report {futures[future]} rendered ({index}/{len(tasks)})')
+            except Exception as e:
+                print(f'Error in rendering report {futures[future]}: {e}')
+    write_index(names, output_path)
+    return rendered
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless reports of the conditioning runs and Fast Data shots')
+    parser.add_argument('-c', '--cond-path', default='data/Cond_Data', help='conditioning files directory')
+    parser.add_argument('-p', '--fast-path', default='data/Fast_Data', help='Fast Data directory')
+    parser.add_argument('-o', '--output', default='reports', help='output directory')
+    parser.add_argument('-d', '--date', default=None, help='only the files of this day (YYYY-MM-DD)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-f', '--force', action='store_true', help='render again all the reports')
+    args = parser.parse_args()
+    generate_reports(args.cond_path, args.fast_path, args.output, args.date, args.workers, args.force)
+
+if __name__ == '__main__':
+    main()
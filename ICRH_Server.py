@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""
+Local shot data server, shared by the GUIs and the notebooks.
+
+A single server process owns the sync of the remote files and the parsing of
+the Fast Data shots and of the conditioning files. Each parsed board (or
+conditioning file) is written once into the shared memory directory
+SHARED_PATH (/dev/shm when available) as one 2D array (columns x rows) per
+dtype of its columns, so that the compact boards stay compact, and its index.
+The clients memory-map these arrays and get DataFrames which are views on
+them, without copy: a shot opened in one tool is instant in all the others.
+
+    python ICRH_Server.py            # start the server
+
+Clients use the functions of this module, which fall back to local parsing
+when no server is running:
+
+    import ICRH_Server as server
+    data = server.get_fast_data(shot)                        # like FastData(shot)
+    cond = server.read_conditoning_data('data/Cond_Data/2017-02-27_14-42-12.csv')
+
+The shared arrays are read-only. The least recently used ones are removed
+when they exceed SHARED_MAX_BYTES; removing a file does not affect the clients
+which have already mapped it.
+
+The server only accepts the clients knowing its key, a random key created
+once per user in KEY_FILENAME (readable by the user only). The port and the
+shared directory are per user too (suffixed by the uid), the directory being
+created readable by the user only and refused if owned by another user.
+"""
+import os
+import json
+import glob
+import stat
+import hashlib
+import secrets
+import argparse
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import pandas as pd
+
+import ICRH_FastData as fast
+import ICRH_Conditioning as condi
+import ICRH_FileIO as io
+
+# user id (None on Windows), suffix of the port and of the shared directory
+UID = os.getuid() if hasattr(os, 'getuid') else None
+
+ADDRESS = ('localhost', 6853 + (UID or 0) % 10000)
+# Random key of the connections, per user
+KEY_FILENAME = os.path.join(os.path.expanduser('~'), '.icrh_server_key')
+KEY_BYTES = 32
+
+# Directory of the shared arrays: in memory when possible
+SHARED_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                           'icrh_shared' if UID is None else f'icrh_shared_{UID}')
+# Prefix of the names of the shared arrays, the only files removed by the server
+SHARED_PREFIX = 'icrh_'
+
+# Memory budget of the shared arrays [bytes]
+SHARED_MAX_BYTES = 4 * 1024**3
+
+
+def get_authkey(key_filename=KEY_FILENAME):
+    '''
+    Return the key of the connections to the server, created at the first
+    call in key_filename, readable and writable by the user only.
+    '''
+    try:
+        with open(key_filename, 'rb') as fh:
+            return fh.read()
+    except FileNotFoundError:
+        pass
+    # written aside then linked into place: a concurrent call reads a complete key
+    part_filename = f'{key_filename}.{os.getpid()}.part'
+    fd = os.open(part_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(secrets.token_bytes(KEY_BYTES))
+        try:
+            os.link(part_filename, key_filename)
+        except FileExistsError:
+            pass  # created meanwhile by another process
+    finally:
+        os.remove(part_filename)
+    with open(key_filename, 'rb') as fh:
+        return fh.read()
+
+def check_shared_path(shared_path=SHARED_PATH):
+    '''
+    Create the shared directory, readable by the user only, or check that
+    an existing one is a directory of the user (made private if it was not).
+    Raises a PermissionError otherwise.
+    '''
+    os.makedirs(shared_path, mode=0o700, exist_ok=True)
+    path_stat = os.lstat(shared_path)
+    if not stat.S_ISDIR(path_stat.st_mode) or (UID is not None and path_stat.st_uid != UID):
+        raise PermissionError(f'Shared directory {shared_path} is not a directory of the user')
+    if UID is not None and path_stat.st_mode & 0o077:
+        os.chmod(shared_path, 0o700)
+
+def get_shared_name(filename):
+    '''
+    Return the name of the shared arrays of a data file. It changes with the
+    size and modification time of the file, so that a modified file is parsed again.
+    '''
+    stat = os.stat(filename)
+    key = f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+    return SHARED_PREFIX + os.path.basename(filename) + '_' + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def write_shared(df, name, shared_path=SHARED_PATH):
+    '''
+    Write a DataFrame into the shared directory: name.<dtype>.npy (columns x
+    rows, one array per dtype, so that the dtypes are not promoted to a
+    common one), name.index.npy and name.json.
+    Returns the descriptor of the arrays (see attach_shared).
+    '''
+    check_shared_path(shared_path)
+    dtypes = [np.dtype(dtype).name for dtype in df.dtypes]
+    descriptor = {'name': name, 'path': os.path.abspath(shared_path),
+                  'columns': [str(column) for column in df.columns], 'dtypes': dtypes,
+                  'index_name': df.index.name}
+    arrays = {'index': df.index.values}
+    for dtype in dict.fromkeys(dtypes):
+        positions = [position for position, column_dtype in enumerate(dtypes) if column_dtype == dtype]
+        arrays[dtype] = np.ascontiguousarray(df.iloc[:, positions].to_numpy().T)
+    for suffix, array in arrays.items():
+        with io.atomic_write(os.path.join(shared_path, f'{name}.{suffix}.npy')) as fh:
+            np.save(fh, array)
+    with io.atomic_write(os.path.join(shared_path, name + '.json'), 'wt') as fh:
+        json.dump(descriptor, fh)
+    return descriptor
+
+def attach_shared(descriptor):
+    '''
+    Return the (read-only) DataFrame of shared arrays, without copy, from the
+    shared directory of the server which wrote them (descriptor['path'])
+    '''
+    name, shared_path = descriptor['name'], descriptor['path']
+    arrays = {dtype: np.load(os.path.join(shared_path, f'{name}.{dtype}.npy'), mmap_mode='r')
+              for dtype in dict.fromkeys(descriptor['dtypes'])}
+    index = np.load(os.path.join(shared_path, f'{name}.index.npy'), mmap_mode='r')
+    # one view per column, in the order of the columns
+    rows = dict.fromkeys(arrays, 0)
+    columns = {}
+    for position, dtype in enumerate(descriptor['dtypes']):
+        columns[position] = arrays[dtype][rows[dtype]]
+        rows[dtype] += 1
+    df = pd.DataFrame(columns, index=pd.Index(index, name=descriptor['index_name'], copy=False), copy=False)
+    df.columns = descriptor['columns']
+    return df
+
+def read_shared_descriptor(name, shared_path=SHARED_PATH):
+    '''Return the descriptor of shared arrays already written, or None'''
+    try:
+        with open(os.path.join(shared_path, name + '.json'), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def remove_shared(name, shared_path=SHARED_PATH):
+    # the descriptor first: the arrays are no longer found by read_shared_descriptor
+    for filename in [os.path.join(shared_path, name + '.json')] + get_shared_arrays(name, shared_path):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+def get_shared_arrays(name, shared_path=SHARED_PATH):
+    '''Return the file names of the shared arrays name.*.npy'''
+    return glob.glob(os.path.join(glob.escape(shared_path), glob.escape(name) + '.*.npy'))
+
+def shared_size(name, shared_path=SHARED_PATH):
+    '''Return the size [bytes] of shared arrays'''
+    return sum(os.path.getsize(filename) for filename in get_shared_arrays(name, shared_path))
+
+
+class DataServer():
+    '''
+    Server of the parsed shots and conditioning files.
+
+    Each request is handled in its own thread. A file is parsed only once,
+    even when several clients ask for it at the same time (one lock per
+    file), and the remote syncs of a directory are serialized.
+    '''
+    def __init__(self, address=ADDRESS, authkey=None, shared_path=SHARED_PATH,
+                 max_bytes=SHARED_MAX_BYTES, max_workers=None):
+        self.address = address
+        self.authkey = authkey or get_authkey()
+        self.shared_path = shared_path
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        # shared arrays, in least recently used order: {name: size}
+        self.shared = OrderedDict()
+        self._lock = threading.Lock()
+        self._locks = {}
+        # arrays left by a previous server are not trusted (the other files
+        # of the directory are not the server's)
+        check_shared_path(shared_path)
+        for file in os.listdir(shared_path):
+            if file.startswith((SHARED_PREFIX, '.' + SHARED_PREFIX)) and file.endswith(('.npy', '.json', '.part')):
+                os.remove(os.path.join(shared_path, file))
+
+    def key_lock(self, key):
+        '''Return the lock of a file or directory'''
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def touch(self, name, size=None):
+        '''Mark shared arrays as recently used, and evict the oldest ones over the budget'''
+        with self._lock:
+            if size is None:
+                size = self.shared.pop(name, 0)
+            self.shared[name] = size
+            self.shared.move_to_end(name)
+            while sum(self.shared.values()) > self.max_bytes and len(self.shared) > 1:
+                old_name, _ = self.shared.popitem(last=False)
+                remove_shared(old_name, self.shared_path)
+
+    def share(self, filename, parse):
+        '''
+        Return the descriptor of the shared arrays of a data file, parsing it
+        with parse(filename) (which returns a DataFrame) if not done yet.
+        '''
+        name = get_shared_name(filename)
+        with self.key_lock(name):
+            descriptor = read_shared_descriptor(name, self.shared_path) if name in self.shared else None
+            if descriptor is None:
+                descriptor = write_shared(parse(filename), name, self.shared_path)
+                self.touch(name, shared_size(name, self.shared_path))
+            else:
+                self.touch(name)
+        return descriptor
+
+    def fast_data(self, shot, shot_files):
+        '''
+        Return {'shot', 'shot_files', 'boards': {board: descriptor}, 'board_errors'}
+        of a shot, its boards being parsed (compact, see ICRH_FastData) if needed
+        '''
+        data = fast.FastData(shot, shot_files=shot_files, compact=True)
+        missing = [board for board, filename in data.board_files.items()
+                   if get_shared_name(filename) not in self.shared]
+        if missing:
+            # all the missing boards parsed at once, in parallel
+            data.load(missing, max_workers=self.max_workers)
+        boards = {}
+        for board, filename in data.board_files.items():
+            if board in data.board_errors:
+                continue
+            boards[board] = self.share(filename, lambda filename, board=board: getattr(data, board))
+        return {'shot': shot, 'shot_files': data.shot_files, 'boards': boards,
+                'board_errors': data.board_errors}
+
+    def conditioning(self, filename):
+        '''Return {'data': descriptor, 'metadata'} of a conditioning file'''
+        metadata = {}
+
+        def parse(filename):
+            data, file_metadata = condi.read_conditioning_file(filename)
+            metadata.update(file_metadata)
+            return data
+        descriptor = self.share(filename, parse)
+        if not metadata:
+            metadata = condi.read_conditioning_metadata(filename)
+        return {'data': descriptor, 'metadata': metadata}
+
+    def sync(self, local_data_path, remote_data_path, compression=None, plain_files=(), connection=None):
+        '''
+        Sync a local directory with the remote one. Returns the new files.
+        The progress of the copy is sent to the client connection as
+        ('progress', (file, index, total)) messages, and the copy is cancelled
+        when the client sends 'cancel' (see request).
+        '''
+        progress, cancel = None, None
+        if connection is not None:
+            progress = lambda file, index, total: connection.send(('progress', (file, index, total)))
+            cancel = ClientCancel(connection)
+        with self.key_lock(os.path.abspath(local_data_path)):
+            return io.sync_remote_files(local_data_path=local_data_path,
+                                        remote_data_path=remote_data_path,
+                                        compression=compression, plain_files=plain_files,
+                                        progress=progress, cancel=cancel)
+
+    def stats(self):
+        with self._lock:
+            return {'nb_shared': len(self.shared), 'nbytes': sum(self.shared.values()),
+                    'max_bytes': self.max_bytes, 'shared_path': self.shared_path}
+
+    def handle(self, connection):
+        '''Answer a request (command, kwargs) with ('ok', result) or ('error', message)'''
+        with connection:
+            try:
+                command, kwargs = connection.recv()
+                if command not in ('fast_data', 'conditioning', 'sync', 'stats'):
+                    raise ValueError(f'Unknown command {command}')
+                if command == 'sync':
+                    kwargs['connection'] = connection
+                connection.send(('ok', getattr(self, command)(**kwargs)))
+            except EOFError:
+                pass
+            except Exception as e:
+                print(f'Error in request: {type(e).__name__}: {e}')
+                try:
+                    connection.send(('error', f'{type(e).__name__}: {e}'))
+                except OSError:
+                    pass
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f'ICRH data server listening on {self.address}, shared arrays in {self.shared_path}')
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:  # e.g. client with a wrong authkey
+                    print(f'Connection refused: {e}')
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+
+class ClientCancel():
+    '''
+    Cancel flag of a request, set when the client sends 'cancel' or has
+    disconnected. Used as the threading.Event of ICRH_FileIO.sync_remote_files.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.cancelled = False
+
+    def is_set(self):
+        try:
+            if not self.cancelled and self.connection.poll():
+                self.cancelled = self.connection.recv() == 'cancel'
+        except (EOFError, OSError):
+            self.cancelled = True
+        return self.cancelled
+
+
+class ServerError(Exception):
+    pass
+
+def request(command, address=ADDRESS, authkey=None, progress=None, cancel=None, **kwargs):
+    '''
+    Send a request to the server and return its result. Raises a
+    ConnectionError if no server is running (or a server of another user),
+    or a ServerError.
+
+    The ('progress', args) messages sent by the server while handling the
+    request are passed to progress(*args), and 'cancel' is sent to the server
+    once cancel (e.g. a threading.Event) is set.
+    '''
+    try:
+        connection = Client(address, authkey=authkey or get_authkey())
+    except AuthenticationError as e:
+        raise ConnectionError(f'Server on {address} not accessible: {e}')
+    with connection:
+        connection.send((command, kwargs))
+        cancel_sent = False
+        while True:
+            if cancel is not None and cancel.is_set() and not cancel_sent:
+                connection.send('cancel')
+                cancel_sent = True
+            if not connection.poll(0.1):
+                continue
+            status, result = connection.recv()
+            if status != 'progress':
+                break
+            if progress:
+                progress(*result)
+    if status != 'ok':
+        raise ServerError(result)
+    return result
+
+def is_running(address=ADDRESS):
+    try:
+        request('stats', address)
+        return True
+    except ConnectionError:
+        return False
+
+def get_fast_data(shot, shot_files=None, address=ADDRESS, **kwargs):
+    '''
+    Return a FastData object of a shot whose boards are attached from the
+    server, or a local FastData(shot, shot_files=shot_files, **kwargs) if no
+    server is running. The shared boards are compact and read-only: they are
+    only used with compact=True, and not with use_cache=False or decimation.
+    '''
+    if shot_files is None:
+        shot_files = fast.get_shot_filenames(shot)
+    if not kwargs.get('compact') or not kwargs.get('use_cache', True) or kwargs.get('decimation'):
+        return fast.FastData(shot, shot_files=shot_files, **kwargs)
+    try:
+        result = request('fast_data', address, shot=shot,
+                         shot_files=[os.path.abspath(filename) for filename in shot_files])
+    except ConnectionError:
+        return fast.FastData(shot, shot_files=shot_files, **kwargs)
+    data = fast.FastData(shot, shot_files=result['shot_files'], compact=True)
+    data.board_errors.update(result['board_errors'])
+    for board, descriptor in result['boards'].items():
+        try:
+            data._set_board(board, attach_shared(descriptor))
+        except OSError:
+            pass  # evicted meanwhile: read locally on first access
+    return data
+
+def read_conditioning_file(filename, address=ADDRESS):
+    '''Return the conditioning (data, metadata) of a file, from the server if running'''
+    try:
+        result = request('conditioning', address, filename=os.path.abspath(filename))
+        return attach_shared(result['data']), result['metadata']
+    except (ConnectionError, FileNotFoundError):
+        return condi.read_conditioning_file(filename)
+
+def read_conditoning_data(filename, address=ADDRESS):
+    '''Return the conditioning data of a file, from the server if running'''
+    data, _ = read_conditioning_file(filename, address)
+    return data
+
+def sync_remote_files(local_data_path, remote_data_path, compression=None, plain_files=(),
+                      address=ADDRESS, **kwargs):
+    '''
+    Sync a local directory through the server, or locally if no server is
+    running (kwargs are then passed to ICRH_FileIO.sync_remote_files). The
+    progress and cancel kwargs are also honoured by the server (see request).
+    Returns the new files.
+    '''
+    try:
+        return request('sync', address, progress=kwargs.get('progress'), cancel=kwargs.get('cancel'),
+                       local_data_path=os.path.abspath(local_data_path),
+                       remote_data_path=remote_data_path, compression=compression,
+                       plain_files=list(plain_files))
+    except ConnectionError:
+        return io.sync_remote_files(local_data_path=local_data_path, remote_data_path=remote_data_path,
+                                    compression=compression, plain_files=plain_files, **kwargs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local server of the parsed ICRH shots and conditioning files')
+    parser.add_argument('-P', '--port', type=int, default=ADDRESS[1],
+                        help='port of the server (localhost), per user by default')
+    parser.add_argument('-s', '--shared-path', default=SHARED_PATH, help='directory of the shared arrays')
+    parser.add_argument('-m', '--max-memory', type=float, default=SHARED_MAX_BYTES/1024**3,
+                        help='memory budget of the shared arrays [GB]')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of parsing processes')
+    args = parser.parse_args()
+    server = DataServer(('localhost', args.port), shared_path=args.shared_path,
+                        max_bytes=int(args.max_memory*1024**3), max_workers=args.workers)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
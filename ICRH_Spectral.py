@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Spectral analysis of the Fast Data boards: power spectral densities (Welch
+method) and spectrograms, to spot oscillations of the RF powers and probe
+voltages before arcs.
+
+All the channels of a board are processed in one call, directly on the raw
+arrays: the signals are cut into overlapping segments (strided views, without
+copy) which are windowed and Fourier transformed by chunks of CHUNK_SEGMENTS
+segments, so that the memory used does not depend on the pulse length.
+The results are kept with the shot in FastData.derived['spectra'].
+"""
+import numpy as np
+
+# default number of samples per segment and overlap between segments
+NPERSEG = 4096
+OVERLAP = 0.5
+
+# number of segments Fourier transformed at once
+CHUNK_SEGMENTS = 64
+
+# default dtype of the spectra
+DTYPE = np.float32
+
+
+def get_sampling_frequency(t):
+    '''Return the sampling frequency [Hz] from a time array [µs]'''
+    return 1e6 / np.median(np.diff(t[:10001]))
+
+def iter_spectra(values, fs, nperseg=NPERSEG, overlap=OVERLAP, chunk_segments=CHUNK_SEGMENTS):
+    '''
+    Iterate over the one-sided power spectral densities of the segments of
+    values (array of shape (nb_channels, nb_samples)), by chunks of segments.
+    Yields (segment start indices, array of shape (nb_channels, nb_segments, nb_frequencies)).
+    '''
+    values = np.atleast_2d(values)
+    nperseg = min(nperseg, values.shape[-1])
+    step = max(int(nperseg * (1 - overlap)), 1)
+    window = np.hanning(nperseg).astype(DTYPE)
+    scale = 1 / (fs * np.sum(window**2))
+    segments = np.lib.stride_tricks.sliding_window_view(values, nperseg, axis=-1)[:, ::step]
+    for first in range(0, segments.shape[1], chunk_segments):
+        chunk = np.array(segments[:, first:first + chunk_segments], dtype=DTYPE)
+        chunk -= chunk.mean(axis=-1, keepdims=True)  # constant detrend
+        chunk *= window
+        spectrum = np.fft.rfft(chunk, axis=-1)
+        power = np.square(np.abs(spectrum), dtype=DTYPE)
+        power *= scale
+        # one-sided: double all but the DC (and Nyquist) frequencies
+        power[..., 1:(nperseg + 1) // 2] *= 2
+        starts = (first + np.arange(chunk.shape[1])) * step
+        yield starts, power
+
+def welch(values, fs, nperseg=NPERSEG, overlap=OVERLAP, chunk_segments=CHUNK_SEGMENTS):
+    '''
+    Return (f, psd) the Welch power spectral densities of all the channels of
+    values (array of shape (nb_channels, nb_samples)) sampled at fs [Hz].
+    psd is of shape (nb_channels, nb_frequencies), in unit**2/Hz.
+    '''
+    values = np.atleast_2d(values)
+    nperseg = min(nperseg, values.shape[-1])
+    psd = np.zeros((values.shape[0], nperseg // 2 + 1), dtype=np.float64)
+    nb_segments = 0
+    for starts, power in iter_spectra(values, fs, nperseg, overlap, chunk_segments):
+        psd += power.sum(axis=1)
+        nb_segments += len(starts)
+    psd /= max(nb_segments, 1)
+    return np.fft.rfftfreq(nperseg, 1 / fs), psd.astype(DTYPE)
+
+def spectrogram(values, fs, nperseg=NPERSEG, overlap=OVERLAP, chunk_segments=CHUNK_SEGMENTS):
+    '''
+    Return (f, t, S) the spectrograms of all the channels of values (array
+    of shape (nb_channels, nb_samples)) sampled at fs [Hz]. t is the time of
+    the segment centers [s] from the first sample and S is of shape
+    (nb_channels, nb_frequencies, nb_segments).
+    '''
+    values = np.atleast_2d(values)
+    nperseg = min(nperseg, values.shape[-1])
+    starts, powers = zip(*iter_spectra(values, fs, nperseg, overlap, chunk_segments))
+    S = np.concatenate(powers, axis=1).transpose(0, 2, 1)
+    t = (np.concatenate(starts) + nperseg / 2) / fs
+    return np.fft.rfftfreq(nperseg, 1 / fs), t, S
+
+def board_spectra(fast_data, board, kind='psd', nperseg=NPERSEG, overlap=OVERLAP):
+    '''
+    Return the spectra of all the channels of a board of a FastData object,
+    computed once and kept with the shot:
+        - kind='psd': (columns, f, psd), see welch()
+        - kind='spectrogram': (columns, f, t, S), see spectrogram(), t being
+          the time of the segment centers [s] in the shot
+    Raises an AttributeError if the board is missing or empty.
+    '''
+    spectra = fast_data.derived.setdefault('spectra', {})
+    key = (kind, board, nperseg, overlap)
+    if key not in spectra:
+        df = getattr(fast_data, board)
+        t = df.index.values
+        fs = get_sampling_frequency(t)
+        # the empty column comes from the trailing tab of the files
+        columns = [column for column in df.columns if column != '']
+        values = df[columns].to_numpy(dtype=DTYPE).T
+        if kind == 'psd':
+            spectra[key] = (columns,) + welch(values, fs, nperseg, overlap)
+        elif kind == 'spectrogram':
+            f, t_segments, S = spectrogram(values, fs, nperseg, overlap)
+            spectra[key] = (columns, f, t_segments + t[0] / 1e6, S)
+        else:
+            raise ValueError(f'Unknown spectrum kind {kind}')
+    return spectra[key]
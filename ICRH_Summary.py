@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Campaign summary of the Fast Data shots.
+
+Walk all the local Fast Data shots and compute, per quadrant, the peak
+incident/reflected powers, the maximum VSWR, the peak probe voltages, the
+pulse duration and the sample counts. The shots are processed in parallel
+worker processes, and the shots already present in the output table are
+skipped (unless their files have changed), so that the table can be updated
+after each sync:
+
+    python ICRH_Summary.py -p data/Fast_Data -o summary.csv
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+import ICRH_FastData as fast
+import ICRH_Derived as derived
+
+# Power above which the RF is considered on [kW]
+POWER_THRESHOLD = 1
+
+def get_shot_sizes(path='data/Fast_Data'):
+    '''
+    Return {shot: total size of the shot files [bytes]} from a single scan of the directory
+    '''
+    sizes = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and fast.is_fast_data_file(entry.name):
+                shot = int(entry.name.split('_')[1])
+                sizes[shot] = sizes.get(shot, 0) + entry.stat().st_size
+    return sizes
+
+def summarize_shot(shot, path='data/Fast_Data', files_size=None):
+    '''
+    Return the summary of a shot as a list of rows (dictionaries), one per quadrant.
+    files_size, the total size of the shot files, is recorded in order to
+    detect the shots which have changed since they were summarized.
+    '''
+    data = fast.FastData(shot, shot_files=fast.get_shot_filenames(shot, path))
+    signals = derived.derive_fast_data(data)
+    rows = []
+    for quadrant in derived.QUADRANTS:
+        row = {'shot': shot, 'quadrant': quadrant, 'files_size': files_size}
+        amplitude = signals[quadrant].get('amplitude')
+        if amplitude:
+            for name in derived.POWERS + ['VSWR_G', 'VSWR_D'] + derived.VOLTAGES:
+                row[name + '_max'] = float(np.max(amplitude[name]))
+            rf_on = np.flatnonzero(np.maximum(amplitude['PiG'], amplitude['PiD']) > POWER_THRESHOLD)
+            row['duration'] = float(amplitude['t'][rf_on[-1]] - amplitude['t'][rf_on[0]]) if len(rf_on) else 0.0
+            row['nb_samples_amplitude'] = len(amplitude['t'])
+        phase = signals[quadrant].get('phase')
+        row['nb_samples_phase'] = len(phase['t']) if phase else 0
+        rows.append(row)
+    return rows
+
+def read_summary(filename):
+    '''Return the summary table saved in a .csv or .parquet file (empty if it does not exist)'''
+    if not os.path.exists(filename):
+        return pd.DataFrame()
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    return pd.read_csv(filename)
+
+def write_summary(summary, filename):
+    '''Save the summary table into a .csv or .parquet file'''
+    if filename.endswith('.parquet'):
+        summary.to_parquet(filename, index=False)
+    else:
+        summary.to_csv(filename, index=False)
+
+def summarize_shots(path='data/Fast_Data', output='summary.csv', max_workers=None, force=False):
+    '''
+    Update the summary table of all the shots of a directory, computing in
+    parallel only the shots which are not already in the table, or whose
+    files have changed since (all the shots if force is True).
+    Returns the summary table.
+    '''
+    summary = pd.DataFrame() if force else read_summary(output)
+    sizes = get_shot_sizes(path)
+    done = dict(zip(summary['shot'], summary['files_size'])) if 'shot' in summary else {}
+    shots = sorted((shot for shot in sizes if done.get(shot) != sizes[shot]), reverse=True)
+    # forget the previous summary of the shots to update
+    if len(summary):
+        summary = summary[~summary['shot'].isin(shots)]
+    print(f'{len(shots)} shots to summarize')
+
+    rows = []
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(summarize_shot, shot, path, sizes[shot]): shot for shot in shots}
+            for index, future in enumerate(as_completed(futures), 1):
+                try:
+                    rows.extend(future.result())
+                    print(f'Shot {futures[future]} summarized ({index}/{len(shots)})')
+                except Exception as e:
+                    print(f'Error in summarizing shot {futures[future]}: {e}')
+    finally:
+        # keep what has been computed, even if interrupted
+        if rows:
+            summary = pd.concat([summary, pd.DataFrame(rows)], ignore_index=True)
+            summary = summary.sort_values(['shot', 'quadrant'], ascending=[False, True])
+            write_summary(summary, output)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Summary statistics of the Fast Data shots')
+    parser.add_argument('-p', '--path', default='data/Fast_Data', help='Fast Data directory')
+    parser.add_argument('-o', '--output', default='summary.csv', help='output table (.csv or .parquet)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('-f', '--force', action='store_true', help='summarize again all the shots')
+    args = parser.parse_args()
+    summarize_shots(args.path, args.output, args.workers, args.force)
+
+if __name__ == '__main__':
+    main()
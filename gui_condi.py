@@ -9,7 +9,8 @@ try:
     import PyQt5.QtGui as QtGui
     import PyQt5.QtWidgets as QtWidgets
     from PyQt5.QtWidgets import (QMainWindow, QApplication, QWidget, QPushButton, 
-                                 QHBoxLayout, QVBoxLayout, QTableWidget, QTableWidgetItem)
+                                 QHBoxLayout, QVBoxLayout, QTableWidget, QTableWidgetItem,
+                                 QStatusBar, QSpinBox)
     from matplotlib.backends.backend_qt5agg import (
             FigureCanvasQTAgg as FigureCanvas,
             NavigationToolbar2QT as NavigationToolbar)
@@ -19,7 +20,8 @@ except ImportError:
     import PyQt4.QtGui as QtGui
     import PyQt4.QtGui as QtWidgets
     from PyQt4.QtGui import (QMainWindow, QApplication, QWidget, QPushButton, 
-                                 QHBoxLayout, QVBoxLayout, QTableWidget, QTableWidgetItem)
+                                 QHBoxLayout, QVBoxLayout, QTableWidget, QTableWidgetItem,
+                                 QStatusBar, QSpinBox)
     from matplotlib.backends.backend_qt4agg import (
             FigureCanvasQTAgg as FigureCanvas,
             NavigationToolbar2QT as NavigationToolbar)
@@ -28,6 +30,20 @@ import pyqtgraph as pg
 
 import ICRH_Conditioning as condi
 import ICRH_FileIO as io
+import ICRH_Derived as derived
+import ICRH_History as history
+import ICRH_Server as server
+import gui_workers
+
+# Remote (on dfci) path of the conditioning files
+REMOTE_PATH = '/home/dfci/media/ssd/Conditionnement/'
+
+# Compression of the local copies: None, 'gzip' or 'zstd' (see ICRH_FileIO).
+# A followed run is decompressed to be appended.
+LOCAL_COMPRESSION = None
+
+# default refresh period of the follow mode [ms]
+FOLLOW_PERIOD = 1000
 
 # switch default plotting scheme to white
 pg.setConfigOption('background', 'w')
@@ -39,14 +55,22 @@ class AppForm(QMainWindow):
         self.create_main_frame()
         self.setGeometry(0, 0, 1600, 600)
         self.setWindowTitle("WEST ICRH Conditoning Data Analysis")
-        # sync remote files to local
-        self.sync_files()
-        # fill the shot table with the date of the last shots
+        # background workers for the sync, the file loading and the follow mode
+        self.sync_worker = None
+        self.load_worker = None
+        self.follow_worker = None
+        # file displayed, and its follower in follow mode
+        self.current_file = None
+        self.follower = None
+        self.curves = []
+        # fill the shot table with the date of the last shots available locally
+        self.local_files = self.get_local_file_list()
         self.update_shot_table()
         # default plotted data are from last shot file
-        self.data = self.get_conditioning_data(0)
-        self.update_metadata_table()
-        self.update_plot()
+        if self.local_files:
+            self.load_conditioning_data(0)
+        # then sync remote files to local in background
+        self.refresh()
 
     def create_main_frame(self):
         self.main_frame = QWidget()
@@ -83,6 +107,19 @@ class AppForm(QMainWindow):
         self.refresh_button.setFont(button_default_font)
         self.refresh_button.setIcon(self.style().standardIcon(QtWidgets.QStyle.SP_BrowserReload))
         self.refresh_button.clicked.connect(self.refresh)
+        # Follow button: plot the rows appended to the displayed file
+        self.follow_button = QPushButton('Follow', parent=self.main_frame)
+        self.follow_button.setFont(button_default_font)
+        self.follow_button.setCheckable(True)
+        self.follow_button.toggled.connect(self.on_follow_toggled)
+        self.follow_period = QSpinBox(parent=self.main_frame)
+        self.follow_period.setRange(100, 60000)
+        self.follow_period.setSingleStep(100)
+        self.follow_period.setSuffix(' ms')
+        self.follow_period.setValue(FOLLOW_PERIOD)
+        self.follow_period.valueChanged.connect(lambda period: self.follow_timer.setInterval(period))
+        self.follow_timer = QtCore.QTimer(self)
+        self.follow_timer.timeout.connect(self.follow)
         # Conditioning Shots Table
         self.shot_table = QTableWidget(10, 1, parent=self.main_frame)
         self.shot_table.setFont(item_default_font)
@@ -100,6 +137,10 @@ class AppForm(QMainWindow):
         # Layout construction
         vbox_shots = QVBoxLayout()
         vbox_shots.addWidget(self.refresh_button)
+        hbox_follow = QHBoxLayout()
+        hbox_follow.addWidget(self.follow_button)
+        hbox_follow.addWidget(self.follow_period)
+        vbox_shots.addLayout(hbox_follow)
         vbox_shots.addWidget(self.shot_table)
 
         vbox_metadata = QVBoxLayout()
@@ -116,17 +157,40 @@ class AppForm(QMainWindow):
         self.main_frame.setLayout(hbox)
         self.setCentralWidget(self.main_frame)
 
+        # Status bar
+        self.statusBar = QStatusBar()
+        self.setStatusBar(self.statusBar)
+
     def get_local_file_list(self):
         return io.list_local_files(local_data_path='data/Cond_Data/')
 
     def get_remote_file_list(self):
-        return io.list_remote_files()
+        return io.list_remote_files(remote_path=REMOTE_PATH)
 
-    def sync_files(self):
-        self.remote_files = self.get_remote_file_list()
-        io.copy_remote_files_to_local(self.remote_files,
-                                      local_data_path='data/Cond_Data/')
-        self.local_files = self.get_local_file_list()
+    def sync_files(self, worker=None):
+        '''
+        Synchronize remote files to local directory. When run by a background
+        worker, the progress is reported to it and the copy can be cancelled.
+        '''
+        kwargs = {}
+        if worker:
+            kwargs = dict(progress=lambda file, index, total: worker.report(f'Copied {file} ({index}/{total})'),
+                          cancel=worker.cancelled)
+        # the followed file is kept uncompressed: it is read from its last offset
+        follower = self.follower
+        plain_files = [io.uncompressed_name(os.path.basename(follower.filename))] if follower else []
+        # only new or modified remote files are copied (see the sync manifest),
+        # by the data server if it is running
+        new_files = server.sync_remote_files(local_data_path='data/Cond_Data/',
+                                             remote_data_path=REMOTE_PATH,
+                                             compression=LOCAL_COMPRESSION,
+                                             plain_files=plain_files, **kwargs)
+        # keep the consolidated conditioning history up to date
+        progress = None
+        if worker:
+            progress = lambda file, index, total: worker.report(f'Ingested {file} in history ({index}/{total})')
+        history.ingest('data/Cond_Data/', progress=progress)
+        return new_files, self.get_local_file_list()
 
     def update_shot_table(self):
         # reduce the number of rows to the current number of local files
@@ -135,9 +199,8 @@ class AppForm(QMainWindow):
         for row, filename in enumerate(self.local_files):
             self.shot_table.setItem(row, 0, QTableWidgetItem(filename))
 
-    def update_metadata_table(self, idx=-1):
-        self.metadata = condi.read_conditioning_metadata(
-            os.path.join('data', 'Cond_Data', self.local_files[idx]))
+    def update_metadata_table(self):
+        # metadata of the current file, read together with its data
         # reduce the number of rows to the actual metadata number
         self.metadata_table.setRowCount(len(self.metadata))
 
@@ -147,94 +210,231 @@ class AppForm(QMainWindow):
         #self.metadata_table.horizontalHeader().setSectionResizeMode(0,QtWidgets.QHeaderView.Stretch)
 
     def refresh(self):
-        self.sync_files()
+        ''' Sync the remote files in background, then display the most recent one '''
+        if self.sync_worker and self.sync_worker.is_running():
+            return
+        self.statusBar.showMessage('Looking for new files on dfci...')
+        self.sync_worker = gui_workers.Worker(self.sync_files)
+        self.sync_worker.signals.progress.connect(self.statusBar.showMessage)
+        self.sync_worker.signals.finished.connect(self.on_sync_finished)
+        self.sync_worker.signals.error.connect(self.on_worker_error)
+        self.sync_worker.start()
+
+    def on_sync_finished(self, result):
+        self.new_files, self.local_files = result
+        self.statusBar.showMessage(f'{len(self.new_files)} new file(s) copied from dfci')
         # select the first row (most recent) and display its associated data
         self.shot_table.selectRow(0)
         self.update_shot_table()
-        self.data = self.get_conditioning_data(0)
-        self.update_metadata_table(0)
-        self.update_plot()
+        if self.local_files and not self.follow_button.isChecked():
+            self.load_conditioning_data(0)
+
+    def on_worker_error(self, message):
+        print(message)
+        self.statusBar.showMessage(message)
 
     def on_shot_table_clicked(self, row, col):
-        self.data = self.get_conditioning_data(row)
-        self.metadata = self.update_metadata_table(row)
+        # stop following the previous file
+        self.follow_button.setChecked(False)
+        self.load_conditioning_data(row)
+
+    def load_conditioning_data(self, idx=-1):
+        ''' Read a file in background, then update the metadata table and the plots '''
+        # only the last requested file is displayed
+        if self.load_worker and self.load_worker.is_running():
+            self.load_worker.cancel()
+        filename = os.path.join('data', 'Cond_Data', self.local_files[idx])
+        self.current_file = filename
+        print(filename)
+        # shared with the other tools by the data server if it is running
+        self.load_worker = gui_workers.Worker(lambda worker: (filename,) + server.read_conditioning_file(filename))
+        self.load_worker.signals.finished.connect(self.on_conditioning_data_loaded)
+        self.load_worker.signals.error.connect(self.on_worker_error)
+        self.load_worker.start()
+
+    def on_conditioning_data_loaded(self, result):
+        filename, data, metadata = result
+        # a file no longer displayed, or displayed by the follow mode meanwhile
+        if filename != self.current_file or self.follower:
+            return
+        self.data, self.metadata = data, metadata
+        self.update_metadata_table()
         self.update_plot()
 
-    def get_conditioning_data(self, idx=-1):
-        print(self.local_files[idx])
-        self.data = condi.read_conditoning_data(
-                os.path.join('data', 'Cond_Data', self.local_files[idx]))
-        return self.data
+    def closeEvent(self, event):
+        self.follow_timer.stop()
+        for worker in (self.sync_worker, self.load_worker, self.follow_worker):
+            if worker:
+                worker.cancel()
+        # let the cancelled tasks end before the window is destroyed
+        QtCore.QThreadPool.globalInstance().waitForDone(30000)
+        QMainWindow.closeEvent(self, event)
+
+    def curve_definitions(self):
+        """
+        Return the (plot, pen, name, y values as a function of the data)
+        of each curve, in drawing order
+        """
+        return [
+            # Pi,Pr Gauche
+            (self.PG, pg.mkPen('k', width=2, style=QtCore.Qt.DashLine), 'Consigne',
+             lambda data: data.Consigne_mes.values/2), # kW
+            (self.PG, pg.mkPen('b', width=2), 'Pi_G', lambda data: data.PiG.values/10), # kW
+            (self.PG, pg.mkPen('r', width=2), 'Pr_G', lambda data: data.PrG.values/10), # kW
+            # Pi,Pr Droite
+            (self.PD, pg.mkPen('k', width=2, style=QtCore.Qt.DashLine), 'Consigne',
+             lambda data: data.Consigne_mes.values/2), # kW
+            (self.PD, pg.mkPen('b', width=2), 'Pi_D', lambda data: data.PiD.values/10), # kW
+            (self.PD, pg.mkPen('r', width=2), 'Pr_D', lambda data: data.PrD.values/10), # kW
+            # Phase Gauche et Droite
+            (self.PhG, 'b', None, lambda data: data['Ph(V1-V3)'].values), # degres
+            (self.PhD, 'b', None, lambda data: data['Ph(V2-V4)'].values), # degres
+            # Tensions Gauche
+            (self.VG, pg.mkPen('b', width=2), 'V1', lambda data: data.V1.values/1000), # kV
+            (self.VG, pg.mkPen('r', width=2), 'V2', lambda data: data.V2.values/1000), # kV
+            # Tensions Droite
+            (self.VD, pg.mkPen('b', width=2), 'V3', lambda data: data.V3.values/1000), # kV
+            (self.VD, pg.mkPen('r', width=2), 'V4', lambda data: data.V4.values/1000), # kV
+            # Pression dans le transfo gauche et droit
+            (self.pTransG, 'b', None, lambda data: derived.transformer_pressure(data.Vide_droit.values)), # Pa
+            (self.pTransD, 'b', None, lambda data: derived.transformer_pressure(data.Vide_droit.values)), # Pa
+            ]
 
     def update_plot(self):
         data = self.data
         if data.empty:
             print('Empty data!')
+            # do not leave the curves of the previous file
+            for plot in dict.fromkeys(plot for plot, _, _, _ in self.curve_definitions()):
+                plot.clear()
+            self.curves = []
         else:
             # NB: pandas -> np arrays for pyqtgraph compatibility
             time = data.index.values/1e3  # display time in ms
-            
-            # Pi,Pr Gauche
-            self.PG.plot(pen=pg.mkPen('k', width=2, style=QtCore.Qt.DashLine),
-                         clear=True, name='Consigne',
-                         x=time, y=data.Consigne_mes.values/2) # kW
-            self.PG.plot(pen=pg.mkPen('b', width=2), clear=False, name='Pi_G',
-                         x=time, y=data.PiG.values/10) # kW
-            self.PG.plot(pen=pg.mkPen('r', width=2), clear=False, name='Pr_G',
-                         x=time, y=data.PrG.values/10) # kW
+            # curves and their data buffers, kept to append rows in follow mode
+            self.curves = []
+            cleared_plots = []
+            for plot, pen, name, values in self.curve_definitions():
+                y = values(data)
+                curve = plot.plot(pen=pen, name=name, x=time, y=y,
+                                  clear=plot not in cleared_plots)
+                cleared_plots.append(plot)
+                self.curves.append((curve, values, CurveBuffer(time, y)))
+
             self.PG.setLabel('left', 'Power', units='kW')
-            
-            # Pi,Pr Droite
-            self.PD.plot(pen=pg.mkPen('k', width=2, style=QtCore.Qt.DashLine),
-                         clear=True, name='Consigne',
-                         x=time, y=data.Consigne_mes.values/2) # k
-            self.PD.plot(pen=pg.mkPen('b', width=2), 
-                         clear=False, name='Pi_D',
-                         x=time, y=data.PiD.values/10) # kW
-            self.PD.plot(pen=pg.mkPen('r', width=2), 
-                         clear=False, name='Pr_D',
-                         x=time, y=data.PrD.values/10) # kW
             self.PD.setLabel('left', 'Power', units='kW')
-            
-            # Phase Gauche
-            self.PhG.plot(pen='b', clear=True, 
-                          x=time, y=data['Ph(V1-V3)'].values) # degres
             self.PhG.setLabel('left', 'Phase [left]', units='deg')
-            
-            # Phase Droite
-            self.PhD.plot(pen='b', clear=True, 
-                          x=time, y=data['Ph(V2-V4)'].values) # degres
             self.PhD.setLabel('left', 'Phase [right]', units='deg')
-            
-            # Tensions Gauche
-            self.VG.plot(pen=pg.mkPen('b', width=2), 
-                         clear=True, name='V1',
-                         x=time, y=data.V1.values/1000) # kV
-            self.VG.plot(pen=pg.mkPen('r', width=2), 
-                         clear=False, name='V2',
-                         x=time, y=data.V2.values/1000) # kV
             self.VG.setLabel('left','Probe Voltage', units='V')
-            
-            # Tensions Droite
-            self.VD.plot(pen=pg.mkPen('b', width=2), 
-                         clear=True, name='V3', 
-                         x=time, y=data.V3.values/1000) # kV
-            self.VD.plot(pen=pg.mkPen('r', width=2), 
-                         clear=False, name='V4',
-                         x=time, y=data.V4.values/1000) # kV
             self.VD.setLabel('left','Probe Voltage', units='V')
-            
-            # Pression dans le transfo gauche et droit
-            self.pTransG.plot(pen='b', x=time, y=np.power(10, 1.667*data.Vide_droit.values*1e-3-9.333), clear=True)
-            self.pTransG.setLogMode(y=True)
-            self.pTransG.showGrid(y=True)
-            self.pTransG.setLabel('bottom','time', units='ms')
-            self.pTransG.setLabel('left', 'Pressure [left]', units='Pa')
-            self.pTransD.plot(pen='b', x=time, y=np.power(10, 1.667*data.Vide_droit.values*1e-3-9.333), clear=True)
-            self.pTransD.setLogMode(y=True)
-            self.pTransD.showGrid(y=True)
-            self.pTransD.setLabel('bottom','time', units='ms')
-            self.pTransD.setLabel('left', 'Pressure [right]', units='Pa')
+            for plot, side in ((self.pTransG, 'left'), (self.pTransD, 'right')):
+                plot.setLogMode(y=True)
+                plot.showGrid(y=True)
+                plot.setLabel('bottom','time', units='ms')
+                plot.setLabel('left', f'Pressure [{side}]', units='Pa')
+
+    def append_to_plot(self, new_data):
+        """ Append new rows to the existing curves (follow mode) """
+        if new_data.empty:
+            return
+        if not self.curves:
+            # nothing plotted yet, e.g. the file was empty when the follow started
+            self.data = new_data
+            self.update_plot()
+            return
+        time = new_data.index.values/1e3  # display time in ms
+        for curve, values, buffer in self.curves:
+            buffer.append(time, values(new_data))
+            curve.setData(x=buffer.x, y=buffer.y)
+
+    def on_follow_toggled(self, checked):
+        """ Start or stop following the displayed file while it is written """
+        if checked:
+            if self.current_file is None:
+                self.statusBar.showMessage('No file to follow')
+                self.follow_button.setChecked(False)
+                return
+            # the followed rows replace the pending load of the file
+            if self.load_worker:
+                self.load_worker.cancel()
+            self.follower = condi.ConditioningFollower(self.current_file)
+            # the whole file is read in background, then only the new rows
+            self.follow_worker = gui_workers.Worker(self.start_following, self.follower)
+            self.follow_worker.signals.finished.connect(self.on_follow_started)
+            self.follow_worker.signals.error.connect(self.on_worker_error)
+            self.follow_worker.start()
+        else:
+            self.follow_timer.stop()
+            # a pending update must not be appended to the next file displayed
+            if self.follow_worker:
+                self.follow_worker.cancel()
+            self.follower = None
+
+    def start_following(self, worker, follower):
+        if io.is_compressed(follower.filename):
+            # the rows appended to the file are read from a plain copy
+            follower.filename = io.decompress_file(follower.filename)
+        return follower, follower.read_new_rows()
+
+    def on_follow_started(self, result):
+        follower, data = result
+        if follower is not self.follower:
+            return  # follow mode stopped meanwhile
+        self.current_file = follower.filename
+        self.data, self.metadata = data, follower.metadata
+        self.update_metadata_table()
+        self.update_plot()
+        self.follow_timer.start(self.follow_period.value())
+
+    def follow(self):
+        """ Fetch and plot the rows appended to the followed file """
+        if self.follow_worker and self.follow_worker.is_running():
+            return  # previous update not finished yet
+        self.follow_worker = gui_workers.Worker(self.read_followed_file, self.follower)
+        self.follow_worker.signals.finished.connect(self.on_followed_rows)
+        self.follow_worker.signals.error.connect(self.on_worker_error)
+        self.follow_worker.start()
+
+    def read_followed_file(self, worker, follower):
+        io.append_remote_file(io.uncompressed_name(os.path.basename(follower.filename)),
+                              local_data_path=os.path.dirname(follower.filename),
+                              remote_data_path=REMOTE_PATH)
+        return follower, follower.read_new_rows()
+
+    def on_followed_rows(self, result):
+        follower, new_data = result
+        # ignore the rows of a file which is no longer followed
+        if follower is self.follower:
+            self.append_to_plot(new_data)
+
+
+class CurveBuffer():
+    """
+    x and y values of a curve, with a capacity doubled when full so that
+    appending rows does not copy the whole curve each time
+    """
+    def __init__(self, x, y):
+        self.size = len(x)
+        self._x = np.array(x, dtype=float)
+        self._y = np.array(y, dtype=float)
+
+    @property
+    def x(self):
+        return self._x[:self.size]
+
+    @property
+    def y(self):
+        return self._y[:self.size]
+
+    def append(self, x, y):
+        size = self.size + len(x)
+        if size > len(self._x):
+            capacity = max(size, 2*len(self._x))
+            self._x = np.resize(self._x, capacity)
+            self._y = np.resize(self._y, capacity)
+        self._x[self.size:size] = x
+        self._y[self.size:size] = y
+        self.size = size
 
 def main():
     # Hack to be able to run the code from spyder
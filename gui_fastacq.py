@@ -1,4 +1,5 @@
 import sys
+import os
 
 # Qt5/Qt4 compatibility
 try: 
@@ -6,7 +7,7 @@ try:
     import PyQt5.QtGui as QtGui 
     import PyQt5.QtWidgets as QtWidgets
     from PyQt5.QtWidgets import (QMainWindow, QApplication, QWidget, QPushButton, QListWidget,
-                                 QHBoxLayout, QVBoxLayout, QStatusBar, QMessageBox)
+                                 QHBoxLayout, QVBoxLayout, QStatusBar, QMessageBox, QLabel, QCheckBox)
     from matplotlib.backends.backend_qt5agg import (
             FigureCanvasQTAgg as FigureCanvas,
             NavigationToolbar2QT as NavigationToolbar)
@@ -15,7 +16,7 @@ except ImportError:
     import PyQt4.QtGui as QtGui
     import PyQt4.QtGui as QtWidgets
     from PyQt4.QtGui import (QMainWindow, QApplication, QWidget, QPushButton, QListWidget,
-                                 QHBoxLayout, QVBoxLayout, QStatusBar, QMessageBox)
+                                 QHBoxLayout, QVBoxLayout, QStatusBar, QMessageBox, QLabel, QCheckBox)
     from matplotlib.backends.backend_qt4agg import (
             FigureCanvasQTAgg as FigureCanvas,
             NavigationToolbar2QT as NavigationToolbar)
@@ -24,13 +25,38 @@ import pyqtgraph as pg
 
 import ICRH_FastData as fast
 import ICRH_FileIO as io
-
-import numpy as np
+import ICRH_Derived as derived
+import ICRH_Decimation as decimation
+import ICRH_Spectral as spectral
+import ICRH_Instrument as instrument
+import ICRH_Server as server
+import gui_workers
 
 # Remote (on dfci) and local (linux) absolute path
 REMOTE_PATH = '/home/dfci/media/ssd/Fast_Data/'
 LOCAL_PATH = '/Home/dfci/DATA_DFCI/Acqui_Cond_and_Fast/data/Fast_Data'
 
+# Compression of the local copies: None, 'gzip' or 'zstd' (see ICRH_FileIO)
+LOCAL_COMPRESSION = None
+
+# Keep the boards in memory as raw integers (see ICRH_FastData.compact_frame)
+COMPACT_BOARDS = True
+
+# Memory budget of the loaded shots [bytes]
+CACHE_MAX_BYTES = 2*1024**3
+
+# Prefetch in background the PREFETCH_SHOTS next and previous shots of the
+# list (and the newly synced shots), at most PREFETCH_WORKERS at a time, each
+# parsed by PREFETCH_PARSE_WORKERS processes (1 would parse in the GUI process),
+# while the cache is below PREFETCH_MAX_BYTES (so that the shots already
+# viewed are not evicted)
+PREFETCH_SHOTS = 2
+PREFETCH_WORKERS = 1
+PREFETCH_PARSE_WORKERS = 2
+PREFETCH_MAX_BYTES = CACHE_MAX_BYTES // 2
+# Priority in the thread pool, below the loading of the selected shot (0)
+PREFETCH_PRIORITY = -1
+
 # switch default plotting scheme to white
 pg.setConfigOption('background', 'w')
 pg.setConfigOption('foreground', 'k')
@@ -62,14 +88,23 @@ class AppForm(QMainWindow):
         self.create_main_frame()
         self.setGeometry(0, 0, 2000, 600)
         self.setWindowTitle("WEST ICRH Fast Data Acquisition Analysis")
-        # Fast data dictionnary
-        self.data = dict()
-        # sync remote files to local
-        self.sync_files() 
-        # fill the shot list with the list of available shots
-        self.update_shot_list()        
-        # default plotted data are from last shot file
-        self.update_plot()
+        # Fast data of the loaded shots (LRU cache)
+        self.data = fast.ShotCache(CACHE_MAX_BYTES)
+        # background workers for the sync and the shot loading
+        self.sync_worker = None
+        self.load_worker = None
+        self.selected_shot = None
+        # shots waiting to be prefetched, and the prefetch workers {shot: worker}
+        self.prefetch_queue = []
+        self.prefetch_workers = {}
+        self.new_files = []
+        # index of the local shot files, checked against the directory content
+        self.shot_index = fast.ShotIndex(LOCAL_PATH)
+        self.shot_index.update()
+        # fill the shot list with the shots already available locally
+        self.update_shot_list()
+        # then sync remote files to local in background
+        self.refresh()
 
     def create_main_frame(self):
         self.main_frame = QWidget()
@@ -86,11 +121,21 @@ class AppForm(QMainWindow):
         self.delete_button.setFont(button_default_font)
         self.delete_button.setIcon(self.style().standardIcon(QtWidgets.QStyle.SP_TrashIcon))
         self.delete_button.clicked.connect(self.delete_selected_shot)    
+        # Cancel button (background sync and loading)
+        self.cancel_button = QPushButton('Cancel', parent=self.main_frame)
+        self.cancel_button.setFont(button_default_font)
+        self.cancel_button.setIcon(self.style().standardIcon(QtWidgets.QStyle.SP_BrowserStop))
+        self.cancel_button.clicked.connect(self.cancel_background_tasks)
+        self.cancel_button.setEnabled(False)
         # Plot button
         self.plot_button = QPushButton('Plot', parent=self.main_frame)
         self.plot_button.setFont(button_default_font)
         self.plot_button.clicked.connect(self.update_plot)
         self.plot_button.setIcon(self.style().standardIcon(QtWidgets.QStyle.SP_MediaPlay))                                  
+        # Optional row of spectra (PSD of the probe voltages)
+        self.spectra_checkbox = QCheckBox('Spectra', parent=self.main_frame)
+        self.spectra_checkbox.setFont(item_default_font)
+        self.spectra_checkbox.toggled.connect(self.show_spectra)
 
         # Shots List
         self.shot_list_widget = QListWidget()
@@ -100,9 +145,11 @@ class AppForm(QMainWindow):
         # Layout construction
         vbox_shots = QVBoxLayout()
         vbox_shots.addWidget(self.refresh_button)
+        vbox_shots.addWidget(self.cancel_button)
         vbox_shots.addWidget(self.delete_button)
         vbox_shots.addWidget(self.shot_list_widget)
         vbox_shots.addWidget(self.plot_button)
+        vbox_shots.addWidget(self.spectra_checkbox)
         
         self.l = pg.GraphicsLayoutWidget(border=(100,100,100))
         # 1st row : RF power
@@ -134,6 +181,9 @@ class AppForm(QMainWindow):
         self.PhaQ2.setXLink(self.PowQ2)
         self.PhaQ4.setXLink(self.PowQ4)        
 
+        # 5th row (optional) : spectra, see show_spectra()
+        self.spectra_plots = {}
+
         # Layout assembly
         vbox_canvas = QVBoxLayout()            
         vbox_canvas.addWidget(self.l)
@@ -148,7 +198,16 @@ class AppForm(QMainWindow):
         # Status bar
         self.statusBar = QStatusBar()
         self.setStatusBar(self.statusBar)
+        self.cache_label = QLabel()
+        self.statusBar.addPermanentWidget(self.cache_label)
         
+        # curves drawn from decimation pyramids, per ViewBox. Zooming reloads
+        # the matching level (the X axes of a quadrant are linked)
+        self.lod_curves = {}
+        for plot in (self.PowQ1, self.PowQ2, self.PowQ4, self.VSWRQ1, self.VSWRQ2, self.VSWRQ4,
+                     self.VolQ1, self.VolQ2, self.VolQ4, self.PhaQ1, self.PhaQ2, self.PhaQ4):
+            plot.vb.sigXRangeChanged.connect(self.update_lod)
+
         self.cross = CrossHairManager()
         self.cross.linkWithPlotItem(self.PowQ2)
         self.cross.linkWithPlotItem(self.VolQ2)
@@ -157,35 +216,78 @@ class AppForm(QMainWindow):
     def get_local_file_list(self):
         return io.list_local_files(local_data_path=LOCAL_PATH)
 
-    def get_remote_file_list(self):
-        return io.list_remote_files(remote_path=REMOTE_PATH)
-
-    def sync_files(self):
-        '''Synchronize remote files to local directory'''
-        self.remote_files = self.get_remote_file_list()
-        io.copy_remote_files_to_local(self.remote_files,
-                                      local_data_path = LOCAL_PATH,
-                                      remote_data_path= REMOTE_PATH)
-        self.local_files = self.get_local_file_list()
+    def sync_files(self, worker=None):
+        '''
+        Synchronize remote files to local directory. When run by a background
+        worker, the progress is reported to it and the copy can be cancelled.
+        '''
+        kwargs = {}
+        if worker:
+            kwargs = dict(progress=lambda file, index, total: worker.report(f'Copied {file} ({index}/{total})'),
+                          cancel=worker.cancelled)
+        # only new or modified remote files are copied (see the sync manifest),
+        # by the data server if it is running
+        new_files = server.sync_remote_files(local_data_path = LOCAL_PATH,
+                                             remote_data_path= REMOTE_PATH,
+                                             compression=LOCAL_COMPRESSION, **kwargs)
+        # index only the files which have just been copied
+        self.shot_index.update(new_files)
+        return new_files
 
     def update_shot_list(self):
         '''Update the list widget '''
-        self.shot_list = fast.get_shot_list(self.local_files)
+        shots = self.shot_index.shots()
+        self.shot_list = [shot for shot, empty in shots]
         self.shot_list_widget.clear()
-        for shot in self.shot_list:
-            self.shot_list_widget.addItem(str(shot))
-        # look for empty shots
-        self.empty_shots = self.list_empty_shots()
+        self.shot_list_widget.addItems([str(shot) for shot in self.shot_list])
+        # gray the empty shots
+        self.empty_shots = self.list_empty_shots(shots)
+        for row, (shot, empty) in enumerate(shots):
+            if empty:
+                self.shot_list_widget.item(row).setForeground(QtGui.QColor('gray'))
         
     def refresh(self):
-        """ Refresh the shot list """
-        # change the mouse cursor to indicate the user should wait until the file is processed
-        QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        # refresh files and update the shot list
-        self.sync_files() 
+        """ Refresh the shot list, the remote files being synced in background """
+        if self.sync_worker and self.sync_worker.is_running():
+            return
+        self.statusBar.showMessage('Looking for new files on dfci...')
+        self.sync_worker = gui_workers.Worker(self.sync_files)
+        self.sync_worker.signals.progress.connect(self.statusBar.showMessage)
+        self.sync_worker.signals.finished.connect(self.on_sync_finished)
+        self.sync_worker.signals.error.connect(self.on_worker_error)
+        self.sync_worker.signals.done.connect(self.update_cancel_button)
+        self.sync_worker.start()
+        self.update_cancel_button()
+
+    def on_sync_finished(self, new_files):
+        """ Update the shot list once the remote files have been synced """
+        self.new_files = new_files
         self.update_shot_list()
-        # back the cursor to normal
-        QtGui.QApplication.restoreOverrideCursor()
+        self.statusBar.showMessage(f'{len(new_files)} new file(s) copied from dfci')
+        self.prefetch_shots()
+
+    def on_worker_error(self, message):
+        print(message)
+        self.statusBar.showMessage(message)
+
+    def cancel_background_tasks(self):
+        """ Cancel the sync and the shot loading running in background """
+        self.cancel_prefetch()
+        for worker in (self.sync_worker, self.load_worker):
+            if worker:
+                worker.cancel()
+        self.statusBar.showMessage('Cancelled')
+
+    def update_cancel_button(self):
+        self.cancel_button.setEnabled(any(worker and worker.is_running()
+                                          for worker in (self.sync_worker, self.load_worker)))
+
+    def closeEvent(self, event):
+        self.cancel_background_tasks()
+        # a parse cannot be interrupted: let the cancelled ones end before
+        # the interpreter shuts down their process pools
+        QtCore.QThreadPool.globalInstance().waitForDone(30000)
+        QMainWindow.closeEvent(self, event)
         
         
     def delete_selected_shot(self):
@@ -202,225 +304,265 @@ class AppForm(QMainWindow):
             reply = msgBox.exec_()
             if reply == QMessageBox.Yes:
                 # change the mouse cursor to indicate the user should wait until the file are deleted
-                QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+                QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
                 # delete the files
                 self.delete_shot_files(selected_shot)
                 # back the cursor to normal
-                QtGui.QApplication.restoreOverrideCursor()
+                QApplication.restoreOverrideCursor()
             
     def delete_shot_files(self, shot=None):
         """ Delete the local and remote files associated to the given shot number """
         if shot:
             print(f'Suppression du choc {shot}!!')
-            shot_filenames = fast.get_shot_filenames(shot, path='data/Fast_Data')
-            # remove the relative path of the filenames   
-            shot_filenames = [file.replace('data/Fast_Data/', '') for file in shot_filenames]
+            shot_filenames = self.shot_index.shot_files(int(shot))
+            # the binary cache of the parsed boards goes with the files
+            fast.delete_cache(shot_filenames)
+            # remove the path of the filenames
+            shot_filenames = [os.path.basename(file) for file in shot_filenames]
             print(f'Les fichiers suivant vont etre supprimes: {shot_filenames}')
-            io.delete_remote_files(shot_filenames, remote_data_path=REMOTE_PATH)
+            io.delete_remote_files([io.uncompressed_name(file) for file in shot_filenames],
+                                   remote_data_path=REMOTE_PATH)
             io.delete_local_files(shot_filenames, local_data_path=LOCAL_PATH)
+            self.shot_index.remove(shot_filenames)
+            self.data.pop(int(shot), None)
+            self.update_cache_label()
             # update the shot list in order to supress the shot number we just had removed
             self.refresh()
 
-    def color_shot(self, shot=None, color=QtGui.QColor('gray')):
-        """ Change the shot number font color """
-        if shot:
-            res_list = self.shot_list_widget.findItems(str(shot), QtCore.Qt.MatchRegExp)
-            res_list[0].setForeground(color)
-
-    def list_empty_shots(self):
+    def list_empty_shots(self, shots=None):
         ''' List the shot numbers which (at least one of the) associated files are empty '''
-        empty_shots = []
-        
-        for shot in self.shot_list:
-            shot_filenames = fast.get_shot_filenames(shot)
-            for file in shot_filenames:
-                if io.is_empty(file, local_data_path=''):
-                    self.color_shot(shot)
-                    empty_shots.append(shot)       
-
-        return set(empty_shots)  # convert the list into a set to get unique values
+        if shots is None:
+            shots = self.shot_index.shots()
+        return {shot for shot, empty in shots if empty}
 
     def on_shot_list_clicked(self, item):
-        ''' Convert into DF when user select a shot number, essentially to speed-up the later plot'''
-        # change the mouse cursor to indicate the user should wait until the file is processed
-        QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        
+        ''' Convert into DF in background when user select a shot number, essentially to speed-up the later plot'''
         # Convert the shot item label into shot number
         selected_shot = item.text()
         try:
-            self.shot = int(selected_shot)
-            print('Shot #{}'.format(self.shot))
+            self.selected_shot = int(selected_shot)
+            print('Shot #{}'.format(self.selected_shot))
         except ValueError:
             print('Bad shot number ! Something went wrong somewhere !!')     
-     
-        # Then convert the data into DF
-        try:
-            self.convert_to_DF(self.shot)
-            print(f'Shot {self.shot} converted into DataFrame')
-            
-        except Exception as ex:
-            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            print(message)
-        # back the cursor to normal
-        QtGui.QApplication.restoreOverrideCursor()
-    
-    def convert_to_DF(self, shot):
-        ''' Convert a shot Fast Data into Pandas DataFrame '''
-        # convert only if not been made before
-        if not self.data.get(shot):
-            print(f'Converting data of shot {shot}')
-            self.data[shot] = fast.FastData(shot)
+            return
+
+        if self.data.get(self.selected_shot) is not None:
+            self.shot = self.selected_shot
+            self.update_cache_label()
+            # prefetch the neighbouring shots, the previous ones are cancelled
+            self.prefetch_shots()
+            return
+        # Then convert the data into DF, cancelling the shot previously requested
+        if self.load_worker and self.load_worker.is_running():
+            self.load_worker.cancel()
+        self.update_cancel_button()
+        prefetch_worker = self.prefetch_workers.get(self.selected_shot)
+        if prefetch_worker and not prefetch_worker.cancelled.is_set():
+            # already being prefetched: delivered by on_shot_loaded
+            self.prefetch_shots()
+            self.statusBar.showMessage(f'Loading shot {self.selected_shot}...')
+            return
+        # the running prefetches are cancelled too, so that they do not slow
+        # down the load: they are started again once the shot is loaded
+        self.cancel_prefetch()
+        self.statusBar.showMessage(f'Loading shot {self.selected_shot}...')
+        self.load_worker = gui_workers.Worker(self.load_shot, self.selected_shot)
+        self.load_worker.signals.finished.connect(self.on_shot_loaded)
+        self.load_worker.signals.error.connect(self.on_worker_error)
+        self.load_worker.signals.done.connect(self.update_cancel_button)
+        self.load_worker.signals.done.connect(self.prefetch_shots)
+        self.load_worker.start()
+        self.update_cancel_button()
+
+    def on_shot_loaded(self, result):
+        shot, data = result
+        self.data.put(shot, data)
+        self.update_cache_label()
+        print(f'Shot {shot} converted into DataFrame')
+        if shot == self.selected_shot:
+            self.shot = shot
+            self.statusBar.showMessage(instrument.summary(shot) if instrument.ENABLED
+                                       else f'Shot {shot} loaded')
+
+    def load_shot(self, worker, shot, max_workers=None):
+        ''' Convert a shot Fast Data into Pandas DataFrames and return (shot, data) '''
+        print(f'Converting data of shot {shot}')
+        shot_files = self.shot_index.shot_files(shot)
+        with instrument.measure('load_shot', shot=shot, bytes=instrument.files_size(shot_files)):
+            # shared by the data server if it is running, else parsed here
+            # a cancelled load stops after the boards being parsed (when parsed here)
+            data = server.get_fast_data(shot, shot_files, preload=True, compact=COMPACT_BOARDS,
+                                        max_workers=max_workers, cancel=worker.cancelled)
+        # record which board files could be parsed
+        board_files = data.board_files
+        errors = data.board_errors
+        self.shot_index.set_parse_status([board_files[name] for name in board_files if name not in errors])
+        self.shot_index.set_parse_status([board_files[name] for name in errors], ok=False)
+        return shot, data
+
+    def get_prefetch_shots(self):
+        '''
+        Return the shots to prefetch: the next and previous shots around the
+        selected one in the list order (closest first), then the newly synced
+        shots, without the empty and already cached ones
+        '''
+        shots = []
+        if self.selected_shot in self.shot_list:
+            row = self.shot_list.index(self.selected_shot)
+            for distance in range(1, PREFETCH_SHOTS + 1):
+                shots += [self.shot_list[index] for index in (row + distance, row - distance)
+                          if 0 <= index < len(self.shot_list)]
+        shots += [shot for shot in fast.get_shot_list(self.new_files) if shot in self.shot_list]
+        prefetch = []
+        for shot in shots:
+            if (shot not in prefetch and shot != self.selected_shot and shot not in self.empty_shots
+                    and shot not in self.data):
+                prefetch.append(shot)
+        return prefetch
+
+    def prefetch_shots(self):
+        ''' Prefetch in background the shots around the selected one, cancelling the others '''
+        self.prefetch_queue = self.get_prefetch_shots()
+        for shot, worker in self.prefetch_workers.items():
+            # the selected shot is kept: it is delivered by on_shot_loaded
+            if shot not in self.prefetch_queue and shot != self.selected_shot:
+                worker.cancel()
+        self.prefetch_queue = [shot for shot in self.prefetch_queue
+                               if shot not in self.prefetch_workers or self.prefetch_workers[shot].cancelled.is_set()]
+        self.start_prefetch()
+
+    def start_prefetch(self):
+        '''
+        Start the next prefetch workers, within the concurrency and memory
+        limits, unless a shot selected by the user is being loaded
+        '''
+        # the cancelled workers still running count in the limit: they stop
+        # once the boards being parsed are done (see FastData.load)
+        self.prefetch_workers = {shot: worker for shot, worker in self.prefetch_workers.items()
+                                 if worker.is_running()}
+        if self.load_worker and self.load_worker.is_running():
+            return
+        while self.prefetch_queue and len(self.prefetch_workers) < PREFETCH_WORKERS:
+            if self.data.nbytes >= PREFETCH_MAX_BYTES:
+                self.prefetch_queue = []
+                break
+            shot = self.prefetch_queue.pop(0)
+            # a cancelled worker of the shot may still be running
+            if shot in self.data or shot in self.prefetch_workers:
+                continue
+            worker = gui_workers.Worker(self.load_shot, shot, PREFETCH_PARSE_WORKERS)
+            worker.signals.finished.connect(self.on_shot_loaded)
+            worker.signals.error.connect(print)
+            worker.signals.done.connect(self.start_prefetch)
+            self.prefetch_workers[shot] = worker.start(PREFETCH_PRIORITY)
+
+    def cancel_prefetch(self):
+        self.prefetch_queue = []
+        for worker in self.prefetch_workers.values():
+            worker.cancel()
+
+    def update_cache_label(self):
+        self.cache_label.setText(self.data.stats())
 
     def update_plot(self):
         # Update the graph with the data. 
-        # Check first if the data are not empty before plotting
-        try:
-            # Q1
-            if not self.data[self.shot].Q1_amplitude.empty:
-                tG = self.data[self.shot].Q1_amplitude['PiG'].index/1e6
-                tD = self.data[self.shot].Q1_amplitude['PiD'].index/1e6
-                PiG = self.data[self.shot].Q1_amplitude['PiG'].values/10
-                PiD = self.data[self.shot].Q1_amplitude['PiD'].values/10
-                PrG = self.data[self.shot].Q1_amplitude['PrG'].values/10
-                PrD = self.data[self.shot].Q1_amplitude['PrD'].values/10
-                try:
-                    # filter unphysical values
-                    VSWR_Q1_G = np.abs((1 + np.sqrt(PrG/PiG))/(1 - np.sqrt(PrG/PiG)))
-                    VSWR_Q1_G = np.where(VSWR_Q1_G<40, VSWR_Q1_G, 0)
-                    VSWR_Q1_D = np.abs((1 + np.sqrt(PrD/PiD))/(1 - np.sqrt(PrD/PiD)))
-                    VSWR_Q1_D = np.where(VSWR_Q1_D<40, VSWR_Q1_D, 0)
-                except ValueError as e:
-                    VSWR_Q1_G = np.zeros_like(PiG)
-                    VSWR_Q1_D = np.zeros_like(PiD)
-                               
-                self.PowQ1.plot(pen='b', x=tG, y=PiG, clear=True)
-                self.PowQ1.plot(pen='r', x=tG, y=PrG)
-                self.PowQ1.plot(pen='g', x=tD, y=PiD)
-                self.PowQ1.plot(pen='m', x=tD, y=PrD)
-                self.PowQ1.plot(pen='k', x=self.data[self.shot].Q1_amplitude['Consigne'].index/1e6, 
-                              y=self.data[self.shot].Q1_amplitude['Consigne'].values/10/2) 
-                
-                self.VSWRQ1.plot(pen='b', x=tG, y=VSWR_Q1_G, clear=True)
-                self.VSWRQ1.plot(pen='r', x=tD, y=VSWR_Q1_D)
-                self.VSWRQ1.setYRange(1, 5)
-                
-                self.VolQ1.plot(pen='b', x=self.data[self.shot].Q1_amplitude['V1'].index/1e6,
-                               y=self.data[self.shot].Q1_amplitude['V1'].values, clear=True)
-                self.VolQ1.plot(pen='r', x=self.data[self.shot].Q1_amplitude['V2'].index/1e6,
-                               y=self.data[self.shot].Q1_amplitude['V2'].values)
-                self.VolQ1.plot(pen='g', x=self.data[self.shot].Q1_amplitude['V3'].index/1e6,
-                               y=self.data[self.shot].Q1_amplitude['V3'].values)
-                self.VolQ1.plot(pen='m', x=self.data[self.shot].Q1_amplitude['V4'].index/1e6,
-                               y=self.data[self.shot].Q1_amplitude['V4'].values)
-
-            if not self.data[self.shot].Q1_phase.empty:               
-                self.PhaQ1.plot(pen='b', x=self.data[self.shot].Q1_phase['Ph1'].index/1e6, 
-                              y=(self.data[self.shot].Q1_phase['Ph4'].values/100 +
-                                 self.data[self.shot].Q1_phase['Ph1'].values/100 -
-                                 self.data[self.shot].Q1_phase['Ph6'].values/100) % 360, clear=True)
-                self.PhaQ1.plot(pen='r', x=self.data[self.shot].Q1_phase['Ph2'].index/1e6, 
-                              y=(self.data[self.shot].Q1_phase['Ph5'].values/100 +
-                                 self.data[self.shot].Q1_phase['Ph1'].values/100 -  
-                                 self.data[self.shot].Q1_phase['Ph7'].values/100) % 360)
-
-            # Q2 
-            if not self.data[self.shot].Q2_amplitude.empty:
-                tG = self.data[self.shot].Q2_amplitude['PiG'].index/1e6
-                tD = self.data[self.shot].Q2_amplitude['PiD'].index/1e6
-                PiG = self.data[self.shot].Q2_amplitude['PiG'].values/10
-                PiD = self.data[self.shot].Q2_amplitude['PiD'].values/10
-                PrG = self.data[self.shot].Q2_amplitude['PrG'].values/10
-                PrD = self.data[self.shot].Q2_amplitude['PrD'].values/10
-                try:
-                    # filter unphysical values
-                    VSWR_Q2_G = np.abs((1 + np.sqrt(PrG/PiG))/(1 - np.sqrt(PrG/PiG)))
-                    VSWR_Q2_G = np.where(VSWR_Q2_G<40, VSWR_Q2_G, 0)
-                    VSWR_Q2_D = np.abs((1 + np.sqrt(PrD/PiD))/(1 - np.sqrt(PrD/PiD)))
-                    VSWR_Q2_D = np.where(VSWR_Q2_D<40, VSWR_Q2_D, 0)
-                except ValueError as e:
-                    VSWR_Q2_G = np.zeros_like(PiG)
-                    VSWR_Q2_D = np.zeros_like(PiD)
-                               
-                self.PowQ2.plot(pen='b', x=tG, y=PiG, clear=True)
-                self.PowQ2.plot(pen='r', x=tG, y=PrG)
-                self.PowQ2.plot(pen='g', x=tD, y=PiD)
-                self.PowQ2.plot(pen='m', x=tD, y=PrD)
-                self.PowQ2.plot(pen='k', x=self.data[self.shot].Q2_amplitude['Consigne'].index/1e6, 
-                              y=self.data[self.shot].Q2_amplitude['Consigne'].values/10/2) 
-                
-                self.VSWRQ2.plot(pen='b', x=tG, y=VSWR_Q2_G, clear=True)
-                self.VSWRQ2.plot(pen='r', x=tD, y=VSWR_Q2_D)
-                self.VSWRQ2.setYRange(1, 5)
-                
-                self.VolQ2.plot(pen='b', x=self.data[self.shot].Q2_amplitude['V1'].index/1e6,
-                               y=self.data[self.shot].Q2_amplitude['V1'].values, clear=True)
-                self.VolQ2.plot(pen='r', x=self.data[self.shot].Q2_amplitude['V2'].index/1e6,
-                               y=self.data[self.shot].Q2_amplitude['V2'].values)
-                self.VolQ2.plot(pen='g', x=self.data[self.shot].Q2_amplitude['V3'].index/1e6,
-                               y=self.data[self.shot].Q2_amplitude['V3'].values)
-                self.VolQ2.plot(pen='m', x=self.data[self.shot].Q2_amplitude['V4'].index/1e6,
-                               y=self.data[self.shot].Q2_amplitude['V4'].values)
-
-            if not self.data[self.shot].Q2_phase.empty:               
-                self.PhaQ2.plot(pen='b', x=self.data[self.shot].Q2_phase['Ph1'].index/1e6, 
-                              y=(self.data[self.shot].Q2_phase['Ph4'].values/100 +
-                                 self.data[self.shot].Q2_phase['Ph1'].values/100 -
-                                 self.data[self.shot].Q2_phase['Ph6'].values/100) % 360, clear=True)
-                self.PhaQ2.plot(pen='r', x=self.data[self.shot].Q2_phase['Ph2'].index/1e6, 
-                              y=(self.data[self.shot].Q2_phase['Ph5'].values/100 +
-                                 self.data[self.shot].Q2_phase['Ph1'].values/100 -  
-                                 self.data[self.shot].Q2_phase['Ph7'].values/100) % 360)
-
-            # Q4
-            if not self.data[self.shot].Q4_amplitude.empty:
-                tG = self.data[self.shot].Q4_amplitude['PiG'].index/1e6
-                tD = self.data[self.shot].Q4_amplitude['PiD'].index/1e6
-                PiG = self.data[self.shot].Q4_amplitude['PiG'].values/10
-                PiD = self.data[self.shot].Q4_amplitude['PiD'].values/10
-                PrG = self.data[self.shot].Q4_amplitude['PrG'].values/10
-                PrD = self.data[self.shot].Q4_amplitude['PrD'].values/10
-                #try:
-                    #VSWR_Q4_G = (1 + np.sqrt(PrG/PiG))/(1 - np.sqrt(PrG/PiG))
-                    #VSWR_Q4_D = (1 + np.sqrt(PrD/PiD))/(1 - np.sqrt(PrD/PiD))
-
-                #except Exception as e:
-                VSWR_Q4_G = np.zeros_like(PiG)
-                VSWR_Q4_D = np.zeros_like(PiD)
- 
-                self.PowQ4.plot(pen='b', x=tG, y=PiG, clear=True)
-                self.PowQ4.plot(pen='r', x=tG, y=PrG)
-                self.PowQ4.plot(pen='g', x=tD, y=PiD)
-                self.PowQ4.plot(pen='m', x=tD, y=PrD)               
-                
-                self.PowQ4.plot(pen='k', x=self.data[self.shot].Q4_amplitude['Consigne'].index/1e6, 
-                              y=self.data[self.shot].Q4_amplitude['Consigne'].values/10/2)
-                              
-                self.VSWRQ4.plot(pen='b', x=tG, y=VSWR_Q4_G)
-                self.VSWRQ4.plot(pen='r', x=tD, y=VSWR_Q4_D)
-                self.VSWRQ4.setYRange(1, 5)
-                                                             
-                self.VolQ4.plot(pen='b', x=self.data[self.shot].Q4_amplitude['V1'].index/1e6,
-                               y=self.data[self.shot].Q4_amplitude['V1'].values, clear=True)
-                self.VolQ4.plot(pen='r', x=self.data[self.shot].Q4_amplitude['V2'].index/1e6,
-                               y=self.data[self.shot].Q4_amplitude['V2'].values)
-                self.VolQ4.plot(pen='g', x=self.data[self.shot].Q4_amplitude['V3'].index/1e6,
-                               y=self.data[self.shot].Q4_amplitude['V3'].values)
-                self.VolQ4.plot(pen='m', x=self.data[self.shot].Q4_amplitude['V4'].index/1e6,
-                               y=self.data[self.shot].Q4_amplitude['V4'].values)
-            if not self.data[self.shot].Q4_phase.empty:               
-                self.PhaQ4.plot(pen='b', x=self.data[self.shot].Q4_phase['Ph1'].index/1e6, 
-                              y=(self.data[self.shot].Q4_phase['Ph4'].values/100 +
-                                 self.data[self.shot].Q4_phase['Ph1'].values/100 -
-                                 self.data[self.shot].Q4_phase['Ph6'].values/100) % 360, clear=True)
-                self.PhaQ4.plot(pen='r', x=self.data[self.shot].Q4_phase['Ph2'].index/1e6, 
-                              y=(self.data[self.shot].Q4_phase['Ph5'].values/100 +
-                                 self.data[self.shot].Q4_phase['Ph1'].values/100 -  
-                                 self.data[self.shot].Q4_phase['Ph7'].values/100) % 360)
-                    
-        except AttributeError as e:
+        # Missing or empty boards are skipped
+        data = self.data.get(getattr(self, 'shot', None))
+        if data is None:
             print('No data or error in data in the shot!')
-            print(e)
+            return
+        self.plotted_data = data
+        # derived signals are computed once and kept with the shot
+        if 'signals' not in data.derived:
+            data.derived['signals'] = derived.derive_fast_data(data)
+        signals = data.derived['signals']
+        plots = {'Q1': (self.PowQ1, self.VSWRQ1, self.VolQ1, self.PhaQ1),
+                 'Q2': (self.PowQ2, self.VSWRQ2, self.VolQ2, self.PhaQ2),
+                 'Q4': (self.PowQ4, self.VSWRQ4, self.VolQ4, self.PhaQ4)}
+        # the derived signals are timed by ICRH_Derived
+        with instrument.measure('plot', shot=self.shot):
+            for quadrant, (Pow, VSWR, Vol, Pha) in plots.items():
+                amplitude = signals[quadrant].get('amplitude')
+                if amplitude:
+                    for name, pen in (('PiG', 'b'), ('PrG', 'r'), ('PiD', 'g'), ('PrD', 'm'), ('Consigne', 'k')):
+                        self.plot_lod(Pow, pen, amplitude, quadrant, name, clear=name == 'PiG')
+
+                    self.plot_lod(VSWR, 'b', amplitude, quadrant, 'VSWR_G', clear=True)
+                    self.plot_lod(VSWR, 'r', amplitude, quadrant, 'VSWR_D')
+                    VSWR.setYRange(1, 5)
+
+                    for name, pen in (('V1', 'b'), ('V2', 'r'), ('V3', 'g'), ('V4', 'm')):
+                        self.plot_lod(Vol, pen, amplitude, quadrant, name, clear=name == 'V1')
+
+                phase = signals[quadrant].get('phase')
+                if phase:
+                    self.plot_lod(Pha, 'b', phase, quadrant, 'Ph_G', clear=True)
+                    self.plot_lod(Pha, 'r', phase, quadrant, 'Ph_D')
+
+            for quadrant, plot in self.spectra_plots.items():
+                self.plot_spectra(plot, data, quadrant)
+
+        # account for the derived signals and pyramids now kept with the shot
+        self.data.update_size(self.shot)
+        self.update_cache_label()
+        if instrument.ENABLED:
+            self.statusBar.showMessage(instrument.summary(self.shot))
+
+    def show_spectra(self, checked):
+        ''' Add or remove the row of spectra, computed only when shown '''
+        if checked:
+            for col, quadrant in enumerate(('Q1', 'Q2', 'Q4')):
+                plot = self.l.addPlot(row=4, col=col, name=f'Spe{quadrant[1]}', title=f'{quadrant} Voltages PSD (<font color="blue">V1</font>, <font color="red">V2</font>, <font color="green">V3</font>, <font color="magenta">V4</font>)')
+                plot.setLogMode(x=True, y=True)
+                plot.setLabel('bottom', 'Frequency', units='Hz')
+                self.spectra_plots[quadrant] = plot
+            if getattr(self, 'plotted_data', None) is not None:
+                for quadrant, plot in self.spectra_plots.items():
+                    self.plot_spectra(plot, self.plotted_data, quadrant)
+                self.data.update_size(self.shot)
+                self.update_cache_label()
+        else:
+            for plot in self.spectra_plots.values():
+                self.l.removeItem(plot)
+            self.spectra_plots = {}
+
+    def plot_spectra(self, plot, data, quadrant):
+        ''' Plot the PSD of the probe voltages of a quadrant (kept with the shot) '''
+        plot.clear()
+        try:
+            columns, f, psd = spectral.board_spectra(data, f'{quadrant}_amplitude')
+        except AttributeError:
+            return
+        for name, pen in (('V1', 'b'), ('V2', 'r'), ('V3', 'g'), ('V4', 'm')):
+            # DC excluded from the log scale
+            plot.plot(pen=pen, x=f[1:], y=psd[columns.index(name), 1:])
+
+    def plot_lod(self, plot, pen, signals, quadrant, name, clear=False):
+        '''
+        Plot a signal through its min/max decimation pyramid, built once and
+        kept with the shot. Only the level matching the visible range is drawn.
+        '''
+        pyramids = self.plotted_data.derived.setdefault('pyramids', {})
+        if (quadrant, name) not in pyramids:
+            pyramids[(quadrant, name)] = decimation.MinMaxPyramid(signals['t'], signals[name])
+        pyramid = pyramids[(quadrant, name)]
+        if clear:
+            plot.clear()
+            self.lod_curves[plot.vb] = []
+        x, y = pyramid.select(pixels=self.view_width(plot.vb))
+        curve = plot.plot(pen=pen, x=x, y=y)
+        self.lod_curves.setdefault(plot.vb, []).append((curve, pyramid))
+
+    def view_width(self, viewbox):
+        ''' Width of a plot in pixels '''
+        return int(viewbox.width()) or 1000
+
+    def update_lod(self, viewbox, x_range):
+        ''' Redraw the curves of a plot with the level matching its new X range '''
+        x0, x1 = x_range
+        for curve, pyramid in self.lod_curves.get(viewbox, []):
+            x, y = pyramid.select(x0, x1, self.view_width(viewbox))
+            curve.setData(x=x, y=y)
 
 def main():
     # Hack to be able to run the code from spyder
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Background workers for the GUIs: the remote sync and the data parsing are run
+in threads of the Qt thread pool, so that the event loop is never blocked.
+Progress, results and errors are delivered back to the UI thread by signals.
+"""
+import threading
+
+# Qt5/Qt4 compatibility
+try:
+    import PyQt5.QtCore as QtCore
+except ImportError:
+    import PyQt4.QtCore as QtCore
+
+
+class WorkerSignals(QtCore.QObject):
+    '''
+    Signals of a Worker. As they are emitted from the worker thread, the
+    connected slots are called in the UI thread (queued connections).
+    '''
+    progress = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal(object)
+    error = QtCore.pyqtSignal(str)
+    # always emitted at the end, even if the task failed or was cancelled
+    done = QtCore.pyqtSignal()
+
+
+class Worker(QtCore.QRunnable):
+    '''
+    Run fn(worker, *args, **kwargs) in a thread of the global QThreadPool.
+
+    The task can report its progress with worker.report(message) and should
+    stop early when worker.cancelled is set. The result of a cancelled task
+    is not delivered.
+    '''
+    def __init__(self, fn, *args, **kwargs):
+        QtCore.QRunnable.__init__(self)
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.cancelled = threading.Event()
+        self._done = threading.Event()
+
+    def report(self, message):
+        self.signals.progress.emit(message)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_running(self):
+        return not self._done.is_set()
+
+    def run(self):
+        try:
+            result = self.fn(self, *self.args, **self.kwargs)
+        except Exception as ex:
+            self.signals.error.emit(f'{type(ex).__name__}: {ex}')
+        else:
+            if not self.cancelled.is_set():
+                self.signals.finished.emit(result)
+        finally:
+            self._done.set()
+            self.signals.done.emit()
+
+    def start(self, priority=0):
+        '''Queue the worker in the global thread pool and return it'''
+        QtCore.QThreadPool.globalInstance().start(self, priority)
+        return self
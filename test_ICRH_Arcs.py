@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the arc detection: the events found chunk by chunk must be the same
+as the ones found on the whole signals.
+
+    python -m pytest test_ICRH_Arcs.py
+"""
+import numpy as np
+import pandas as pd
+
+import ICRH_Arcs as arcs
+import ICRH_Benchmark as benchmark
+
+
+def detect(t, Pi, Pr, VSWR, chunksize=None, **thresholds):
+    '''Return the events of the signals, processed by chunks of chunksize samples'''
+    detector = arcs.ArcDetector(**thresholds)
+    chunksize = chunksize or len(t)
+    events = []
+    for start in range(0, len(t), chunksize):
+        chunk = slice(start, start + chunksize)
+        events += detector.process(t[chunk], Pi[chunk], Pr[chunk], VSWR[chunk])
+    return events + detector.flush()
+
+
+def signals(nb_rows=200, seed=0):
+    '''Noisy signals with events of 1 to 10 samples'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(nb_rows, dtype=float)
+    Pi = 500 + rng.standard_normal(nb_rows)
+    Pr = 10 + rng.standard_normal(nb_rows)
+    VSWR = 1.5 + 0.1*rng.standard_normal(nb_rows)
+    for start in rng.integers(0, nb_rows, 20):
+        length = rng.integers(1, 10)
+        VSWR[start:start + length] = 5 + rng.random(len(VSWR[start:start + length]))
+    return t, Pi, Pr, VSWR
+
+
+def test_event_ending_at_chunk_start():
+    t = np.arange(20, dtype=float)
+    Pi = np.full(20, 500.)
+    Pr = np.full(20, 10.)
+    VSWR = np.full(20, 1.5)
+    VSWR[5:10] = 5
+    expected = detect(t, Pi, Pr, VSWR)
+    assert [(event['t_start'], event['t_end']) for event in expected] == [(5., 9.)]
+    assert detect(t, Pi, Pr, VSWR, chunksize=10) == expected
+
+
+def test_chunked_detection():
+    t, Pi, Pr, VSWR = signals()
+    expected = detect(t, Pi, Pr, VSWR)
+    assert len(expected) > 0
+    for chunksize in range(1, 30):
+        assert detect(t, Pi, Pr, VSWR, chunksize=chunksize) == expected
+
+
+def test_chunked_shot_events(tmp_path):
+    benchmark.generate_shot(str(tmp_path), 1, 20000)
+    expected = arcs.detect_shot_events(1, str(tmp_path))
+    assert len(expected) > 0
+    for chunksize in (777, 5000):
+        pd.testing.assert_frame_equal(arcs.detect_shot_events(1, str(tmp_path), chunksize=chunksize),
+                                      expected)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the incremental sync of a local mirror, the "remote" commands being
+run on the local machine.
+
+    python -m pytest test_ICRH_FileIO.py
+"""
+import os
+import pytest
+
+import ICRH_FileIO as io
+
+LOCAL_SSH_COMMAND = ['env']
+
+
+def make_remote(path, nb_files=3):
+    '''Write nb_files remote files and return their names'''
+    os.makedirs(path)
+    files = [f'2017-02-2{index}_10-00-00.csv' for index in range(nb_files)]
+    for index, file in enumerate(files):
+        with open(os.path.join(path, file), 'w') as fh:
+            fh.write(f'{index}\t1\t2\n' * (100 + index))
+    return files
+
+def sync(local_path, remote_path, **kwargs):
+    return io.sync_remote_files(local_path, remote_path, ssh_command=LOCAL_SSH_COMMAND,
+                                progress=None, **kwargs)
+
+
+def test_failed_listing_keeps_manifest(tmp_path):
+    remote_path, local_path = str(tmp_path / 'remote') + '/', str(tmp_path / 'local')
+    files = make_remote(remote_path)
+    os.makedirs(local_path)
+    assert sorted(sync(local_path, remote_path)) == sorted(files)
+    manifest = io.read_manifest(local_path)
+    with pytest.raises(OSError):
+        sync(local_path, str(tmp_path / 'unreachable') + '/')
+    assert io.read_manifest(local_path) == manifest
+    assert sync(local_path, remote_path) == []
+
+def test_compressed_mirror_without_manifest(tmp_path):
+    remote_path, local_path = str(tmp_path / 'remote') + '/', str(tmp_path / 'local')
+    files = make_remote(remote_path)
+    os.makedirs(local_path)
+    sync(local_path, remote_path)
+    # mirror copied and compressed before the manifest existed
+    os.remove(os.path.join(local_path, io.MANIFEST_FILENAME))
+    io.migrate_local_files(local_path, 'gzip')
+    # a modified remote file is still copied
+    with open(os.path.join(remote_path, files[0]), 'a') as fh:
+        fh.write('0\t1\t2\n')
+    assert sync(local_path, remote_path, compression='gzip') == [files[0]]
+    assert sorted(io.read_manifest(local_path)) == sorted(files)
+    assert sync(local_path, remote_path, compression='gzip') == []
+
+def test_plain_files_not_compressed(tmp_path):
+    remote_path, local_path = str(tmp_path / 'remote') + '/', str(tmp_path / 'local')
+    files = make_remote(remote_path)
+    os.makedirs(local_path)
+    sync(local_path, remote_path)
+    # the followed file is modified remotely while the mirror is compressed
+    with open(os.path.join(remote_path, files[0]), 'a') as fh:
+        fh.write('0\t1\t2\n')
+    io.migrate_local_files(local_path, 'gzip')
+    io.decompress_file(os.path.join(local_path, io.compressed_name(files[0], 'gzip')))
+    assert sync(local_path, remote_path, compression='gzip', plain_files=[files[0]]) == [files[0]]
+    assert io.find_local_file(files[0], local_path) == os.path.join(local_path, files[0])